@@ -0,0 +1,57 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import time
+
+import numpy as np
+
+import xobjects as xo
+import xpart as xp
+import xfields as xf
+
+# Tracking through frozen space-charge maps with the transverse derivatives
+# of the potential stored in separate arrays and interleaved. The particles
+# fill the whole grid, which is much larger than the CPU caches, hence the
+# kick is limited by the gather of the field values.
+
+context = xo.ContextCpu()
+
+n_macroparticles = int(1e6)
+n_repetitions = 10
+
+nx, ny, nz = 256, 256, 100
+x_grid = np.linspace(-5e-3, 5e-3, nx)
+y_grid = np.linspace(-5e-3, 5e-3, ny)
+z_grid = np.linspace(-0.3, 0.3, nz)
+phi = (np.exp(-(x_grid[:, None, None]**2 + y_grid[None, :, None]**2)
+              / (2*1e-3**2))
+       * np.exp(-z_grid[None, None, :]**2/(2*0.08**2)))
+
+particles = xp.Particles(_context=context, p0c=25.92e9,
+        x=np.random.uniform(-5e-3, 5e-3, n_macroparticles),
+        y=np.random.uniform(-5e-3, 5e-3, n_macroparticles),
+        zeta=np.random.uniform(-0.3, 0.3, n_macroparticles))
+
+elements = {}
+for packed_gradient in [False, True]:
+    elements[packed_gradient] = xf.SpaceCharge3D(_context=context, length=1.,
+            update_on_track=False, apply_z_kick=False,
+            x_range=(-5e-3, 5e-3), y_range=(-5e-3, 5e-3),
+            z_range=(-0.3, 0.3), nx=nx, ny=ny, nz=nz,
+            phi=phi, packed_gradient=packed_gradient)
+    elements[packed_gradient].track(particles) # compile and warm up
+
+# The two layouts are timed alternately to reduce the effect of fluctuations
+# of the machine load
+t_kick = {False: [], True: []}
+for _ in range(n_repetitions):
+    for packed_gradient, spch in elements.items():
+        t1 = time.perf_counter()
+        spch.track(particles)
+        t_kick[packed_gradient].append(time.perf_counter() - t1)
+
+for packed_gradient, tt in t_kick.items():
+    print(f'packed_gradient={packed_gradient}: '
+          f'{min(tt)*1e3:.1f} ms per kick')
@@ -0,0 +1,60 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import time
+
+import numpy as np
+
+import xobjects as xo
+import xpart as xp
+import xfields as xf
+
+# Space-charge kick from the full 2.5D solution and from the factorized
+# model (single transverse solve scaled by the line density) for a bunch
+# whose transverse distribution does not depend on z
+
+context = xo.ContextCpu()
+
+n_macroparticles = int(1e6)
+sigma_x = 3e-3
+sigma_y = 2e-3
+sigma_z = 0.3
+n_repetitions = 5
+
+particles = xp.Particles(_context=context, p0c=25.92e9,
+        x=np.random.normal(0, sigma_x, n_macroparticles),
+        y=np.random.normal(0, sigma_y, n_macroparticles),
+        zeta=np.random.normal(0, sigma_z, n_macroparticles),
+        weight=2.5e11/n_macroparticles)
+
+elements = {}
+for factorized in [False, True]:
+    spch = xf.SpaceCharge3D(_context=context, length=1.,
+            update_on_track=True, apply_z_kick=False,
+            x_range=(-4*sigma_x, 4*sigma_x), y_range=(-4*sigma_y, 4*sigma_y),
+            z_range=(-4*sigma_z, 4*sigma_z), nx=256, ny=256, nz=100,
+            solver='FFTSolver2p5D', factorized=factorized)
+    spch.fieldmap.update_from_particles(particles=particles) # warm up
+
+    t_update = []
+    for _ in range(n_repetitions):
+        t1 = time.perf_counter()
+        spch.fieldmap.update_from_particles(particles=particles)
+        t_update.append(time.perf_counter() - t1)
+    print(f'factorized={factorized}: update from particles '
+          f'{min(t_update)*1e3:.1f} ms')
+    elements[factorized] = spch
+
+# Comparison of the fields at the particles of the core of the bunch
+x_test = np.random.normal(0, sigma_x, 10000)
+y_test = np.random.normal(0, sigma_y, 10000)
+z_test = np.random.normal(0, sigma_z, 10000)
+dphi_dx = {}
+for factorized, spch in elements.items():
+    dphi_dx[factorized] = spch.fieldmap.get_values_at_points(
+            x=x_test, y=y_test, z=z_test, return_rho=False,
+            return_phi=False, return_dphi_dy=False, return_dphi_dz=False)[0]
+print('Relative r.m.s. difference of dphi_dx: '
+      f'{np.std(dphi_dx[True] - dphi_dx[False])/np.std(dphi_dx[False]):.2e}')
@@ -0,0 +1,68 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import time
+
+import numpy as np
+
+import xobjects as xo
+import xpart as xp
+import xfields as xf
+
+# Space charge of a coasting beam, computed on a 3D grid with the 2.5D
+# solver and on a single transverse slice with the 2D solver
+
+context = xo.ContextCpu()
+
+n_macroparticles = int(1e6)
+sigma_x = 3e-3
+sigma_y = 2e-3
+circumference = 100.
+n_repetitions = 5
+
+particles = xp.Particles(_context=context, p0c=25.92e9,
+        x=np.random.normal(0, sigma_x, n_macroparticles),
+        y=np.random.normal(0, sigma_y, n_macroparticles),
+        zeta=np.random.uniform(-circumference/2, circumference/2,
+                               n_macroparticles),
+        weight=1e12/n_macroparticles)
+
+elements = {}
+for solver, nz in [('FFTSolver2p5D', 50), ('FFTSolver2D', 1)]:
+    spch = xf.SpaceCharge3D(_context=context, length=1.,
+            update_on_track=True, apply_z_kick=False,
+            x_range=(-5*sigma_x, 5*sigma_x), y_range=(-5*sigma_y, 5*sigma_y),
+            # The 3D grid needs margins to contain all the particles
+            z_range=((-0.51*circumference, 0.51*circumference) if nz > 1
+                     else (-circumference/2, circumference/2)),
+            nx=256, ny=256, nz=nz, solver=solver)
+    spch.fieldmap.update_from_particles(particles=particles) # warm up
+
+    t_update = []
+    for _ in range(n_repetitions):
+        t1 = time.perf_counter()
+        spch.fieldmap.update_from_particles(particles=particles)
+        t_update.append(time.perf_counter() - t1)
+    fmap = spch.fieldmap
+    nbytes_map = fmap._buffer.capacity
+    nbytes_solver = (fmap.solver._workspace_dev.nbytes
+                     + fmap.solver._gint_rep_transf_dev.nbytes)
+    print(f'{solver} (nz={nz}): update from particles '
+          f'{min(t_update)*1e3:.1f} ms, field map {nbytes_map/1e6:.1f} MB, '
+          f'solver {nbytes_solver/1e6:.1f} MB')
+    elements[solver] = spch
+
+# Comparison of the fields at the particles of the core of the beam
+x_test = np.random.normal(0, sigma_x, 10000)
+y_test = np.random.normal(0, sigma_y, 10000)
+z_test = np.random.uniform(-0.4*circumference, 0.4*circumference, 10000)
+dphi_dx = {}
+for solver, spch in elements.items():
+    dphi_dx[solver] = spch.fieldmap.get_values_at_points(
+            x=x_test, y=y_test, z=z_test, return_rho=False,
+            return_phi=False, return_dphi_dy=False, return_dphi_dz=False)[0]
+diff = dphi_dx['FFTSolver2D'] - dphi_dx['FFTSolver2p5D']
+print('Relative r.m.s. difference of dphi_dx: '
+      f'{np.std(diff)/np.std(dphi_dx["FFTSolver2p5D"]):.2e}')
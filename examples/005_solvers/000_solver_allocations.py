@@ -0,0 +1,93 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import time
+import tracemalloc
+
+import numpy as np
+
+import xobjects as xo
+from xfields.solvers import FFTSolver3D, FFTSolver2p5D
+
+###################
+# Choose context #
+###################
+
+context = xo.ContextCpu()
+#context = xo.ContextCupy(default_block_size=256)
+#context = xo.ContextPyopencl('0.0')
+
+print(repr(context))
+
+#############################################
+# Solvers for many kicks with the same grid #
+#############################################
+
+n_kicks_per_turn = 20
+n_turns = 3
+
+nx = 128
+ny = 128
+nz = 10
+dx = 1e-4
+dy = 1e-4
+dz = 1e-2
+
+rho_dev = context.nparray_to_context_array(np.random.rand(nx, ny, nz))
+
+# Count the workspaces allocated by the solvers on the context
+n_allocations = 0
+zeros = context.zeros
+def counting_zeros(*args, **kwargs):
+    global n_allocations
+    n_allocations += 1
+    return zeros(*args, **kwargs)
+context.zeros = counting_zeros
+
+# On CPU the temporary arrays allocated by numpy during the solve are
+# measured with tracemalloc. The complex transforms of the CPU context are
+# executed with numpy.fft (without threads), which returns new arrays, while
+# the real-to-complex transforms (rfft=True) write into the workspace when
+# pyfftw is installed.
+trace_host = isinstance(context, xo.ContextCpu)
+
+for solver_class in [FFTSolver2p5D, FFTSolver3D]:
+    for rfft in ([False, True] if trace_host else [False]):
+
+        name = f'{solver_class.__name__} (rfft={rfft})'
+        n_allocations = 0
+        fftplan = None
+        solvers = []
+        for _ in range(n_kicks_per_turn):
+            solvers.append(solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny,
+                                        nz=nz, context=context, rfft=rfft,
+                                        fftplan=fftplan, share_workspace=True))
+            fftplan = solvers[0].fftplan
+        workspace_nbytes = solvers[0]._workspace_dev.nbytes
+        print(f'{name}: {n_allocations} workspace allocations to build '
+              f'{n_kicks_per_turn} solvers')
+
+        for iturn in range(n_turns):
+            n_allocations = 0
+            if trace_host:
+                tracemalloc.start()
+            t1 = time.time()
+            for solver in solvers:
+                solver.solve(rho_dev)
+            context.synchronize()
+            t2 = time.time()
+            if trace_host:
+                _, peak_nbytes = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                temporaries = (f', {peak_nbytes/1e6:.2f} MB peak of temporary '
+                               f'arrays (workspace {workspace_nbytes/1e6:.2f} '
+                               f'MB)')
+            else:
+                temporaries = ''
+            print(f'{name}: turn {iturn}, {n_allocations} workspace '
+                  f'allocations per turn{temporaries}, '
+                  f'{(t2-t1)/n_kicks_per_turn*1e3:.2f} ms per solve')
+
+del context.zeros
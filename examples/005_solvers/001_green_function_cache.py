@@ -0,0 +1,43 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import time
+
+import xobjects as xo
+import xfields as xf
+
+###################
+# Choose context #
+###################
+
+context = xo.ContextCpu()
+#context = xo.ContextCupy(default_block_size=256)
+#context = xo.ContextPyopencl('0.0')
+
+print(repr(context))
+
+#############################################
+# Many space-charge lenses on the same grid #
+#############################################
+
+n_lenses = 20
+
+for use_green_function_cache in [False, True]:
+
+    xf.solvers.default_green_function_cache.clear()
+
+    t1 = time.time()
+    solvers = []
+    for _ in range(n_lenses):
+        solvers.append(xf.FFTSolver3D(dx=1e-4, dy=1e-4, dz=1e-2,
+                          nx=64, ny=64, nz=32, context=context,
+                          use_green_function_cache=use_green_function_cache))
+    t2 = time.time()
+
+    gint_ids = set(id(ss._gint_rep_transf_dev) for ss in solvers)
+    nbytes = sum(ss._gint_rep_transf_dev.nbytes for ss in solvers)/len(solvers)
+    print(f'use_green_function_cache={use_green_function_cache}: '
+          f'{(t2-t1)/n_lenses*1e3:.1f} ms per solver, '
+          f'{len(gint_ids)*nbytes/1e6:.1f} MB of green functions')
@@ -0,0 +1,57 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import time
+
+import numpy as np
+
+import xobjects as xo
+from xfields.solvers import FFTSolver3D, FFTSolver2p5D
+
+###################
+# Choose context #
+###################
+
+context = xo.ContextCpu()
+#context = xo.ContextCupy(default_block_size=256)
+#context = xo.ContextPyopencl('0.0')
+
+print(repr(context))
+
+#################################################
+# Many bunches solved on the same grid geometry #
+#################################################
+
+n_bunches = 12
+n_rep = 5
+
+nx = 64
+ny = 64
+nz = 16
+
+rho_batch = context.nparray_to_context_array(
+                            np.random.rand(n_bunches, nx, ny, nz))
+
+for solver_class in [FFTSolver2p5D, FFTSolver3D]:
+
+    solver = solver_class(dx=1e-4, dy=1e-4, dz=1e-2, nx=nx, ny=ny, nz=nz,
+                          context=context)
+
+    solver.solve_batch(rho_batch) # allocate the batch workspace
+
+    t1 = time.time()
+    for _ in range(n_rep):
+        for ib in range(n_bunches):
+            solver.solve(rho_batch[ib])
+    context.synchronize()
+    t2 = time.time()
+    for _ in range(n_rep):
+        solver.solve_batch(rho_batch)
+    context.synchronize()
+    t3 = time.time()
+
+    print(f'{solver_class.__name__}: '
+          f'{(t2-t1)/n_rep/n_bunches*1e3:.2f} ms per bunch (one by one), '
+          f'{(t3-t2)/n_rep/n_bunches*1e3:.2f} ms per bunch (batched)')
@@ -0,0 +1,52 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import time
+
+import numpy as np
+
+import xobjects as xo
+from xfields.solvers import FFTSolver2p5D, FFTSolver2p5DSliced
+
+###################
+# Choose context #
+###################
+
+context = xo.ContextCpu()
+#context = xo.ContextCupy(default_block_size=256)
+
+print(repr(context))
+
+########################################################
+# Bunch with long tails (most of the slices are empty) #
+########################################################
+
+n_rep = 5
+
+nx = 128
+ny = 128
+nz = 100
+n_filled = 20
+
+rho = np.zeros((nx, ny, nz))
+rho[:, :, (nz-n_filled)//2:(nz+n_filled)//2] = np.random.rand(
+                                                        nx, ny, n_filled)
+rho_dev = context.nparray_to_context_array(rho)
+
+for solver_class in [FFTSolver2p5D, FFTSolver2p5DSliced]:
+
+    solver = solver_class(dx=1e-4, dy=1e-4, dz=1e-2, nx=nx, ny=ny, nz=nz,
+                          context=context)
+
+    solver.solve(rho_dev)
+    context.synchronize()
+    t1 = time.time()
+    for _ in range(n_rep):
+        solver.solve(rho_dev)
+    context.synchronize()
+    t2 = time.time()
+
+    print(f'{solver_class.__name__}: {(t2-t1)/n_rep*1e3:.2f} ms per solve, '
+          f'workspace {solver._workspace_dev.nbytes/1e6:.1f} MB')
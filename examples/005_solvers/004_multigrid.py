@@ -0,0 +1,60 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import time
+
+import numpy as np
+from scipy.constants import epsilon_0
+
+import xobjects as xo
+from xfields.solvers import FFTSolver2p5D, MultigridSolver2p5D
+from xfields.solvers import elliptical_chamber_mask
+
+context = xo.ContextCpu()
+
+####################################################
+# Round beam in an elliptical chamber, turn by turn #
+####################################################
+
+nx = 256
+ny = 256
+nz = 20
+x_grid = np.linspace(-0.06, 0.06, nx)
+y_grid = np.linspace(-0.04, 0.04, ny)
+dx = x_grid[1] - x_grid[0]
+dy = y_grid[1] - y_grid[0]
+dz = 1e-2
+
+mask = elliptical_chamber_mask(x_grid, y_grid, a=0.055, b=0.035)
+
+# The previous solution is used as initial guess, hence only a few V-cycles
+# are needed when the beam changes slowly from turn to turn
+solver_mg = MultigridSolver2p5D(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                                context=context, chamber_mask=mask,
+                                warm_start=True, tol=1e-4)
+solver_fft = FFTSolver2p5D(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                           context=context)
+
+sigma = 5e-3
+rho_xy = np.exp(-x_grid[:, None]**2/(2*sigma**2)
+                - y_grid[None, :]**2/(2*sigma**2))
+
+n_turns = 10
+for iturn in range(n_turns):
+    # Slowly changing beam
+    rho = (rho_xy[:, :, None] * (1 + 0.01*iturn)
+           * np.linspace(0.5, 1.5, nz)[None, None, :])
+
+    t1 = time.time()
+    phi_mg = solver_mg.solve(rho)
+    t2 = time.time()
+    solver_fft.solve(rho)
+    t3 = time.time()
+
+    print(f'Turn {iturn}: multigrid {(t2-t1)*1e3:.1f} ms '
+          f'({solver_mg.n_cycles_last} V-cycles), '
+          f'FFT (free space) {(t3-t2)*1e3:.1f} ms')
+
+print(f'Potential on the chamber: {np.max(np.abs(phi_mg[~mask, :]))} V')
@@ -0,0 +1,53 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import time
+
+import numpy as np
+
+import xobjects as xo
+import xpart as xp
+import xfields as xf
+
+# Update of the field map from the particles, with the potential written by
+# the solver directly into the field map (update_phi_from_rho) and with the
+# potential returned by the solver and then copied into the field map
+
+context = xo.ContextCpu()
+
+n_macroparticles = int(1e6)
+n_repetitions = 5
+
+particles = xp.Particles(_context=context, p0c=25.92e9,
+        x=np.random.normal(0, 1e-3, n_macroparticles),
+        y=np.random.normal(0, 1e-3, n_macroparticles),
+        zeta=np.random.normal(0, 0.08, n_macroparticles))
+
+for solver in ['FFTSolver2p5D', 'FFTSolver2p5DSliced', 'FFTSolver3D']:
+    for nx, ny, nz in [(64, 64, 32), (128, 128, 64), (256, 256, 64)]:
+        if solver == 'FFTSolver3D' and nx > 128:
+            continue
+        fmap = xf.TriLinearInterpolatedFieldMap(_context=context,
+                x_range=(-5e-3, 5e-3), y_range=(-5e-3, 5e-3),
+                z_range=(-0.3, 0.3), nx=nx, ny=ny, nz=nz,
+                solver=solver, scale_coordinates_in_solver=(1, 1, 27.7))
+
+        fmap.update_from_particles(particles=particles) # warm up
+
+        t_direct = []
+        t_copy = []
+        for _ in range(n_repetitions):
+            t1 = time.perf_counter()
+            fmap.update_from_particles(particles=particles)
+            t2 = time.perf_counter()
+            fmap.update_from_particles(particles=particles, update_phi=False)
+            fmap.update_phi(fmap.solver.solve(fmap.rho))
+            t3 = time.perf_counter()
+            t_direct.append(t2 - t1)
+            t_copy.append(t3 - t2)
+
+        print(f'{solver} {nx}x{ny}x{nz}: '
+              f'direct {min(t_direct)*1e3:.1f} ms, '
+              f'with copy {min(t_copy)*1e3:.1f} ms')
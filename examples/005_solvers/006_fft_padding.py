@@ -0,0 +1,37 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import time
+
+import numpy as np
+
+import xobjects as xo
+from xfields.solvers import FFTSolver2p5D, FFTSolver3D
+
+# Grids whose doubled sizes have large prime factors, solved with the minimal
+# padding, with the padding enlarged to the next 2,3,5-smooth size and with
+# the padding chosen by the autotuner
+
+context = xo.ContextCpu()
+n_repetitions = 5
+
+for solver_class, (nx, ny, nz) in [(FFTSolver2p5D, (131, 131, 20)),
+                                   (FFTSolver2p5D, (127, 113, 20)),
+                                   (FFTSolver2p5D, (128, 128, 20)),
+                                   (FFTSolver3D, (53, 47, 59))]:
+    rho = np.random.rand(nx, ny, nz)
+    print(f'{solver_class.__name__} ({nx}, {ny}, {nz}):')
+    for fft_padding in ['minimal', 'smooth', 'autotune']:
+        solver = solver_class(dx=1e-3, dy=1e-3, dz=1e-2, nx=nx, ny=ny, nz=nz,
+                              context=context, fft_padding=fft_padding)
+        solver.solve(rho) # warm up
+
+        t_solve = []
+        for _ in range(n_repetitions):
+            t1 = time.perf_counter()
+            solver.solve(rho)
+            t_solve.append(time.perf_counter() - t1)
+        print(f'    {fft_padding:>8s} FFT shape {solver.fft_shape}: '
+              f'{min(t_solve)*1e3:.1f} ms')
@@ -0,0 +1,49 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import os
+import time
+
+import numpy as np
+
+import xobjects as xo
+from xfields.solvers import FFTSolver2p5D, FFTSolver3D, FFTBackendCpu
+from xfields.solvers.fft_backends import pyfftw_available
+
+# Time of a Poisson solve with the plans of the context (numpy, single
+# threaded) and with the available CPU FFT backends, for different grid sizes
+# and thread counts
+
+context = xo.ContextCpu()
+n_repetitions = 5
+
+n_cores = os.cpu_count() or 1
+thread_counts = sorted({min(2**ii, n_cores) for ii in range(8)})
+
+backends = {'context': None}
+for n_threads in thread_counts:
+    backends[f'scipy, {n_threads} threads'] = FFTBackendCpu(
+                                        'scipy', n_threads=n_threads)
+    if pyfftw_available:
+        backends[f'pyfftw, {n_threads} threads'] = FFTBackendCpu(
+                                        'pyfftw', n_threads=n_threads)
+
+for solver_class, (nx, ny, nz) in [(FFTSolver2p5D, (128, 128, 50)),
+                                   (FFTSolver2p5D, (256, 256, 50)),
+                                   (FFTSolver3D, (64, 64, 64)),
+                                   (FFTSolver3D, (128, 128, 64))]:
+    rho = np.random.rand(nx, ny, nz)
+    print(f'{solver_class.__name__} ({nx}, {ny}, {nz}):')
+    for name, fft_backend in backends.items():
+        solver = solver_class(dx=1e-3, dy=1e-3, dz=1e-2, nx=nx, ny=ny, nz=nz,
+                              context=context, fft_backend=fft_backend)
+        solver.solve(rho) # warm up
+
+        t_solve = []
+        for _ in range(n_repetitions):
+            t1 = time.perf_counter()
+            solver.solve(rho)
+            t_solve.append(time.perf_counter() - t1)
+        print(f'    {name:>20s}: {min(t_solve)*1e3:.1f} ms')
@@ -0,0 +1,84 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import os
+import time
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+import xobjects as xo
+import xpart as xp
+import xfields as xf
+
+# Strong scaling of the charge deposition on OpenMP contexts, comparing the
+# atomic additions to the deposition into private grids (one per thread).
+# The thread counts above the number of available cores are skipped, as the
+# oversubscribed timings are not meaningful.
+
+n_threads_list = [nn for nn in [1, 2, 4, 8, 16, 32, 64]
+                  if nn <= len(os.sched_getaffinity(0))]
+n_macroparticles = int(5e6)
+n_repetitions = 5
+
+# Beam core concentrated in a few cells
+sigma_x = 1e-3
+sigma_y = 1e-3
+sigma_z = 0.1
+nx = 256
+ny = 256
+nz = 50
+
+t_atomic = []
+t_private = []
+for n_threads in n_threads_list:
+
+    context = xo.ContextCpu(omp_num_threads=n_threads)
+
+    fmap = xf.TriLinearInterpolatedFieldMap(_context=context,
+            x_range=(-20*sigma_x, 20*sigma_x),
+            y_range=(-20*sigma_y, 20*sigma_y),
+            z_range=(-5*sigma_z, 5*sigma_z),
+            nx=nx, ny=ny, nz=nz)
+
+    particles = xp.Particles(_context=context, p0c=7e12,
+            x=np.random.normal(0, sigma_x, n_macroparticles),
+            y=np.random.normal(0, sigma_y, n_macroparticles),
+            zeta=np.random.normal(0, sigma_z, n_macroparticles))
+
+    for deposition_mode, timings in [('atomic', t_atomic),
+                                     ('private', t_private)]:
+        # Warm up (compilation, allocation of the private grids)
+        fmap.update_from_particles(particles=particles, update_phi=False,
+                                   deposition_mode=deposition_mode)
+        t1 = time.time()
+        for _ in range(n_repetitions):
+            fmap.update_from_particles(particles=particles, update_phi=False,
+                                       deposition_mode=deposition_mode)
+        context.synchronize()
+        t2 = time.time()
+        timings.append((t2 - t1)/n_repetitions)
+
+    print(f'{n_threads} threads: atomic {t_atomic[-1]*1e3:.1f} ms, '
+          f'private {t_private[-1]*1e3:.1f} ms')
+
+t_atomic = np.array(t_atomic)
+t_private = np.array(t_private)
+
+fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(10, 4))
+ax1.loglog(n_threads_list, t_atomic*1e3, 'o-', label='atomic')
+ax1.loglog(n_threads_list, t_private*1e3, 's-', label='private grids')
+ax1.set_xlabel('Number of threads')
+ax1.set_ylabel('Deposition time [ms]')
+ax1.legend()
+ax2.plot(n_threads_list, t_atomic[0]/t_atomic, 'o-', label='atomic')
+ax2.plot(n_threads_list, t_atomic[0]/t_private, 's-', label='private grids')
+ax2.plot(n_threads_list, n_threads_list, 'k--', label='ideal')
+ax2.set_xlabel('Number of threads')
+ax2.set_ylabel('Speed-up w.r.t. 1 thread (atomic)')
+ax2.legend()
+fig.tight_layout()
+fig.savefig('deposition_scaling.png')
+plt.show()
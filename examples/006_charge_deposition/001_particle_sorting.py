@@ -0,0 +1,55 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import time
+
+import numpy as np
+
+import xobjects as xo
+import xpart as xp
+import xfields as xf
+
+# Charge deposition and field interpolation with the particles in random
+# order and sorted by grid cell
+
+context = xo.ContextCpu()
+
+n_macroparticles = int(2e6)
+n_kicks = 5
+
+spch = xf.SpaceCharge3D(_context=context, length=1., update_on_track=True,
+                        x_range=(-5e-3, 5e-3), y_range=(-5e-3, 5e-3),
+                        z_range=(-0.3, 0.3), nx=256, ny=256, nz=100,
+                        solver='FFTSolver2p5D')
+
+particles = xp.Particles(_context=context, p0c=25.92e9,
+        x=np.random.normal(0, 1e-3, n_macroparticles),
+        y=np.random.normal(0, 1e-3, n_macroparticles),
+        zeta=np.random.normal(0, 0.08, n_macroparticles))
+
+fmap = spch.fieldmap
+sorter = xf.ParticleSorter(fmap, sort_every_n_turns=10)
+
+for label in ['random order', 'sorted by cell']:
+    if label == 'sorted by cell':
+        t1 = time.time()
+        sorter.track(particles)
+        print(f'Sorting: {(time.time() - t1)*1e3:.1f} ms')
+
+    t_dep = 0
+    t_int = 0
+    for _ in range(n_kicks):
+        t1 = time.time()
+        fmap.update_from_particles(particles=particles, update_phi=False)
+        t2 = time.time()
+        fmap.get_values_at_points(x=particles.x, y=particles.y,
+                                  z=particles.zeta, return_rho=False,
+                                  return_phi=False)
+        t3 = time.time()
+        t_dep += t2 - t1
+        t_int += t3 - t2
+
+    print(f'{label}: deposition {t_dep/n_kicks*1e3:.1f} ms, '
+          f'interpolation {t_int/n_kicks*1e3:.1f} ms')
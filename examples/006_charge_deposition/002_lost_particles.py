@@ -0,0 +1,54 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import time
+
+import numpy as np
+
+import xobjects as xo
+import xpart as xp
+import xfields as xf
+
+# Time per space-charge kick as a function of the fraction of surviving
+# particles, for a fixed capacity of the particles object
+
+context = xo.ContextCpu()
+
+n_macroparticles = int(2e6)
+n_kicks = 5
+
+spch = xf.SpaceCharge3D(_context=context, length=1., update_on_track=True,
+                        x_range=(-5e-3, 5e-3), y_range=(-5e-3, 5e-3),
+                        z_range=(-0.3, 0.3), nx=128, ny=128, nz=50,
+                        solver='FFTSolver2p5D')
+
+for surviving_fraction in [1., 0.5, 0.2, 0.1, 0.01]:
+    particles = xp.Particles(_context=context, p0c=25.92e9,
+            x=np.random.normal(0, 1e-3, n_macroparticles),
+            y=np.random.normal(0, 1e-3, n_macroparticles),
+            zeta=np.random.normal(0, 0.08, n_macroparticles))
+    particles.state[np.random.uniform(size=n_macroparticles)
+                    > surviving_fraction] = 0
+    # Done by xtrack at each turn
+    particles.reorganize()
+
+    # Warm up
+    spch.track(particles)
+
+    t1 = time.time()
+    for _ in range(n_kicks):
+        spch.fieldmap.update_from_particles(particles=particles,
+                                            update_phi=False)
+    t_deposit = (time.time() - t1)/n_kicks
+
+    t1 = time.time()
+    for _ in range(n_kicks):
+        spch.track(particles)
+    t_kick = (time.time() - t1)/n_kicks
+
+    print(f'Surviving {surviving_fraction*100:5.1f}% '
+          f'({particles._num_active_particles} of {particles._capacity}): '
+          f'deposition {t_deposit*1e3:.1f} ms, '
+          f'full kick {t_kick*1e3:.1f} ms (including the Poisson solve)')
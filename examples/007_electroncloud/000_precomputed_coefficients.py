@@ -0,0 +1,65 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import time
+
+import numpy as np
+
+import xobjects as xo
+import xpart as xp
+import xfields as xf
+
+# Electron cloud kick with the tricubic coefficients rebuilt at each
+# interpolation and with the coefficients precomputed once per cell
+
+context = xo.ContextCpu()
+
+nx, ny, nz = 101, 101, 51
+n_macroparticles = int(1e6)
+n_repetitions = 5
+
+x_grid = np.linspace(-0.02, 0.02, nx)
+y_grid = np.linspace(-0.02, 0.02, ny)
+z_grid = np.linspace(-0.5, 0.5, nz)
+XX, YY, ZZ = np.meshgrid(x_grid, y_grid, z_grid, indexing='ij')
+phi = (XX**2 - YY**2) * np.cos(np.pi * ZZ) + XX * YY * ZZ
+
+p0c = 450e9
+beta0 = xp.Particles(p0c=p0c).beta0[0]
+x = np.random.normal(0, 4e-3, n_macroparticles)
+y = np.random.normal(0, 4e-3, n_macroparticles)
+zeta = beta0 * np.random.uniform(-0.45, 0.45, n_macroparticles)
+
+results = {}
+for precompute in [False, True]:
+    fieldmap = xf.TriCubicInterpolatedFieldMap(_context=context,
+            x_grid=x_grid, y_grid=y_grid, z_grid=z_grid, mirror_x=1,
+            phi=phi, precompute_coefficients=precompute)
+    ecloud = xf.ElectronCloud(length=1, fieldmap=fieldmap,
+                              _buffer=fieldmap._buffer)
+
+    t1 = time.perf_counter()
+    fieldmap.update_coefficients()
+    t_precompute = time.perf_counter() - t1
+
+    t_track = []
+    for _ in range(n_repetitions + 1): # first call is a warm up
+        particles = xp.Particles(_context=context, x=x, y=y, zeta=zeta,
+                                 p0c=p0c)
+        t1 = time.perf_counter()
+        ecloud.track(particles)
+        t_track.append(time.perf_counter() - t1)
+    results[precompute] = particles
+
+    nbytes = (len(fieldmap._phi_taylor) * 8
+              + len(fieldmap._coefs) * 8)
+    print(f'precompute_coefficients={precompute}: '
+          f'track {np.median(t_track[1:])*1e3:.1f} ms, '
+          f'precompute {t_precompute*1e3:.1f} ms, '
+          f'map {nbytes/1e6:.0f} MB')
+
+for nn in ['px', 'py', 'ptau']:
+    assert np.allclose(getattr(results[True], nn), getattr(results[False], nn),
+                       rtol=1e-14, atol=0)
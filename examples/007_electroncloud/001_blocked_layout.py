@@ -0,0 +1,73 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import time
+
+import numpy as np
+
+import xobjects as xo
+import xpart as xp
+import xfields as xf
+
+# Electron cloud kick from a map much larger than the caches, with phi_taylor
+# stored in the linear and in the blocked layout
+
+context = xo.ContextCpu()
+
+nx, ny, nz = 201, 201, 101
+n_macroparticles = int(1e6)
+n_repetitions = 10
+
+x_grid = np.linspace(-0.02, 0.02, nx)
+y_grid = np.linspace(-0.02, 0.02, ny)
+z_grid = np.linspace(-0.5, 0.5, nz)
+XX, YY, ZZ = np.meshgrid(x_grid, y_grid, z_grid, indexing='ij')
+phi = (XX**2 - YY**2) * np.cos(np.pi * ZZ) + XX * YY * ZZ
+del XX, YY, ZZ
+
+p0c = 450e9
+beta0 = xp.Particles(p0c=p0c).beta0[0]
+x = np.random.normal(0, 5e-3, n_macroparticles)
+y = np.random.normal(0, 5e-3, n_macroparticles)
+zeta = beta0 * np.random.uniform(-0.45, 0.45, n_macroparticles)
+
+ecloud = {}
+for layout in ['linear', 'blocked']:
+    fieldmap = xf.TriCubicInterpolatedFieldMap(_context=context,
+            x_grid=x_grid, y_grid=y_grid, z_grid=z_grid, mirror_x=1,
+            phi=phi, phi_taylor_layout=layout)
+    ecloud[layout] = xf.ElectronCloud(length=1, fieldmap=fieldmap,
+                                      _buffer=fieldmap._buffer)
+    # The values on the grid do not depend on the layout
+    phi_taylor = fieldmap.get_phi_taylor()
+    if layout == 'linear':
+        phi_taylor_linear = phi_taylor
+    else:
+        assert np.all(phi_taylor == phi_taylor_linear)
+    print(f'phi_taylor_layout={layout}: '
+          f'phi_taylor {phi_taylor.nbytes/1e6:.0f} MB on the grid')
+del phi_taylor, phi_taylor_linear
+
+# The two layouts are timed alternately to reduce the effect of fluctuations
+# of the machine load
+results = {}
+t_track = {layout: [] for layout in ecloud}
+for _ in range(n_repetitions + 1): # first call is a warm up
+    for layout in ecloud:
+        particles = xp.Particles(_context=context, x=x, y=y, zeta=zeta,
+                                 p0c=p0c)
+        t1 = time.perf_counter()
+        ecloud[layout].track(particles)
+        t_track[layout].append(time.perf_counter() - t1)
+        results[layout] = particles
+
+for layout in ecloud:
+    print(f'phi_taylor_layout={layout}: '
+          f'track {np.min(t_track[layout][1:])*1e3:.1f} ms (best of '
+          f'{n_repetitions})')
+
+for nn in ['px', 'py', 'ptau']:
+    assert np.allclose(getattr(results['blocked'], nn),
+                       getattr(results['linear'], nn), rtol=1e-14, atol=0)
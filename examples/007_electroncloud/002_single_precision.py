@@ -0,0 +1,105 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import time
+
+import numpy as np
+
+import xobjects as xo
+import xpart as xp
+import xfields as xf
+
+# Accuracy, memory and speed of field maps stored in single precision,
+# compared to double precision, for an electron cloud (tricubic map) and for
+# space charge (trilinear map)
+
+context = xo.ContextCpu()
+
+n_macroparticles = int(1e6)
+n_repetitions = 5
+p0c = 450e9
+beta0 = xp.Particles(p0c=p0c).beta0[0]
+
+def time_track(element, x, y, zeta):
+    t_track = []
+    for _ in range(n_repetitions + 1): # first call is a warm up
+        particles = xp.Particles(_context=context, x=x, y=y, zeta=zeta,
+                                 p0c=p0c)
+        t1 = time.perf_counter()
+        element.track(particles)
+        t_track.append(time.perf_counter() - t1)
+    return particles, np.min(t_track[1:])
+
+def report(name, results):
+    part64, t64, mem64 = results['float64']
+    part32, t32, mem32 = results['float32']
+    print(f'{name}:')
+    print(f'    memory {mem64/1e6:.0f} MB -> {mem32/1e6:.0f} MB, '
+          f'track {t64*1e3:.1f} ms -> {t32*1e3:.1f} ms')
+    for nn in ['px', 'py', 'ptau']:
+        kk64 = getattr(part64, nn)
+        kk32 = getattr(part32, nn)
+        scale = np.max(np.abs(kk64))
+        if scale == 0:
+            continue
+        err = np.abs(kk32 - kk64) / scale
+        print(f'    {nn}: max error {np.max(err):.1e}, '
+              f'r.m.s. error {np.sqrt(np.mean(err**2)):.1e} '
+              f'(relative to the max kick)')
+
+# Electron cloud
+nx, ny, nz = 101, 101, 51
+x_grid = np.linspace(-0.02, 0.02, nx)
+y_grid = np.linspace(-0.02, 0.02, ny)
+z_grid = np.linspace(-0.5, 0.5, nz)
+XX, YY, ZZ = np.meshgrid(x_grid, y_grid, z_grid, indexing='ij')
+phi = (XX**2 - YY**2) * np.cos(np.pi * ZZ) + XX * YY * ZZ
+
+x = np.random.normal(0, 4e-3, n_macroparticles)
+y = np.random.normal(0, 4e-3, n_macroparticles)
+zeta = beta0 * np.random.uniform(-0.45, 0.45, n_macroparticles)
+
+results = {}
+for dtype in ['float64', 'float32']:
+    fieldmap = xf.TriCubicInterpolatedFieldMap(_context=context,
+            x_grid=x_grid, y_grid=y_grid, z_grid=z_grid, mirror_x=1,
+            phi=phi, phi_taylor_dtype=dtype)
+    ecloud = xf.ElectronCloud(length=1, fieldmap=fieldmap,
+                              _buffer=fieldmap._buffer)
+    particles, t_track = time_track(ecloud, x, y, zeta)
+    nbytes = len(fieldmap._phi_taylor_storage) * np.dtype(dtype).itemsize
+    results[dtype] = (particles, t_track, nbytes)
+report('TriCubicInterpolatedFieldMap (electron cloud)', results)
+
+# Space charge
+nx, ny, nz = 256, 256, 100
+sigma_x, sigma_y, sigma_z = 3e-3, 2e-3, 0.1
+x = np.random.normal(0, sigma_x, n_macroparticles)
+y = np.random.normal(0, sigma_y, n_macroparticles)
+zeta = np.random.normal(0, sigma_z, n_macroparticles)
+
+# Potential of the bunch
+fieldmap = xf.TriLinearInterpolatedFieldMap(_context=context,
+        x_range=(-5*sigma_x, 5*sigma_x), y_range=(-5*sigma_y, 5*sigma_y),
+        z_range=(-5*sigma_z, 5*sigma_z), nx=nx, ny=ny, nz=nz,
+        solver='FFTSolver2p5D')
+fieldmap.update_from_particles(x_p=x, y_p=y, z_p=zeta,
+        ncharges_p=np.ones(n_macroparticles)*1e11/n_macroparticles,
+        q0_coulomb=1.602176634e-19)
+phi = fieldmap.phi.copy()
+
+results = {}
+for dtype in ['float64', 'float32']:
+    spcharge = xf.SpaceCharge3D(_context=context, length=1.,
+            update_on_track=False, apply_z_kick=False,
+            x_range=(-5*sigma_x, 5*sigma_x), y_range=(-5*sigma_y, 5*sigma_y),
+            z_range=(-5*sigma_z, 5*sigma_z), nx=nx, ny=ny, nz=nz,
+            phi=phi, gradient_dtype=dtype)
+    particles, t_track = time_track(spcharge, x, y, zeta)
+    nbytes = sum(getattr(spcharge.fieldmap, nn).nbytes
+                 for nn in ['dphi_dx', 'dphi_dy', 'dphi_dz'])
+    results[dtype] = (particles, t_track, nbytes)
+report('TriLinearInterpolatedFieldMap (space charge, derivatives only)',
+       results)
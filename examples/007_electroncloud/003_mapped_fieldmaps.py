@@ -0,0 +1,92 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import gc
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import xobjects as xo
+import xpart as xp
+import xfields as xf
+
+# Loading time and resident memory of an electron cloud field map saved with
+# save_fieldmaps, read into memory or memory-mapped. When mapped, only the
+# longitudinal slices crossed by the particles are read from disk.
+
+context = xo.ContextCpu()
+
+n_macroparticles = int(1e5)
+p0c = 450e9
+beta0 = xp.Particles(p0c=p0c).beta0[0]
+
+def resident_memory():
+    with open('/proc/self/status') as fid:
+        for line in fid:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1e3
+    return np.nan
+
+nx, ny, nz = 151, 151, 301
+x_grid = np.linspace(-0.02, 0.02, nx)
+y_grid = np.linspace(-0.02, 0.02, ny)
+z_grid = np.linspace(-0.5, 0.5, nz)
+
+# Bunch occupying the central 10% of the map
+x = np.random.normal(0, 4e-3, n_macroparticles)
+y = np.random.normal(0, 4e-3, n_macroparticles)
+zeta = beta0 * np.random.uniform(-0.05, 0.05, n_macroparticles)
+
+# Compile the kernels in advance
+fieldmap = xf.TriCubicInterpolatedFieldMap(_context=context,
+        x_grid=x_grid[:4], y_grid=y_grid[:4], z_grid=z_grid[:4])
+ecloud = xf.ElectronCloud(length=1, fieldmap=fieldmap,
+                          _buffer=fieldmap._buffer)
+ecloud.track(xp.Particles(_context=context, p0c=p0c))
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    filename = os.path.join(tmpdir, 'ecloud.xfm')
+
+    XX, YY, ZZ = np.meshgrid(x_grid, y_grid, z_grid, indexing='ij')
+    fieldmap = xf.TriCubicInterpolatedFieldMap(_context=context,
+            x_grid=x_grid, y_grid=y_grid, z_grid=z_grid,
+            phi=(XX**2 - YY**2) * np.cos(np.pi * ZZ) + XX * YY * ZZ)
+    del XX, YY, ZZ
+    xf.save_fieldmaps(filename, {'ecloud': fieldmap})
+    del fieldmap
+    gc.collect()
+    print(f'Field map file: {os.path.getsize(filename)/1e6:.0f} MB '
+          f'(of which {os.stat(filename).st_blocks*512/1e6:.0f} MB on disk)')
+
+    for use_mmap in [True, False]:
+        # The file is in the page cache, the loading time does not include
+        # the disk access
+        mem0 = resident_memory()
+        t1 = time.perf_counter()
+        # The checksums are not verified, as it would read the whole file
+        fieldmap = xf.load_fieldmaps(filename, context=context,
+                                     use_mmap=use_mmap,
+                                     verify_checksums=False)['ecloud']
+        t_load = time.perf_counter() - t1
+        mem_load = resident_memory() - mem0
+
+        ecloud = xf.ElectronCloud(length=1, fieldmap=fieldmap,
+                                  _buffer=fieldmap._buffer)
+        particles = xp.Particles(_context=context, x=x, y=y, zeta=zeta,
+                                 p0c=p0c)
+        t1 = time.perf_counter()
+        ecloud.track(particles)
+        t_track = time.perf_counter() - t1
+        mem_track = resident_memory() - mem0 - particles._buffer.capacity
+
+        print(f'use_mmap={use_mmap}: load {t_load*1e3:.1f} ms, '
+              f'first track {t_track*1e3:.1f} ms, resident memory '
+              f'{mem_load/1e6:.0f} MB after loading, '
+              f'{mem_track/1e6:.0f} MB after tracking')
+
+        del fieldmap, ecloud, particles
+        gc.collect()
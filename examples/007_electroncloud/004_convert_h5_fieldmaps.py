@@ -0,0 +1,74 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+import xobjects as xo
+import xfields as xf
+
+# Loading time of an electron cloud field map from the h5 format (one
+# dataset per slice, rescaled and reordered at loading) and from the native
+# format written by convert_electroncloud_fieldmaps_from_h5 (bulk read or
+# memory-mapped)
+
+context = xo.context_default
+
+nx, ny, nz = 151, 151, 201
+x_grid = np.linspace(-0.02, 0.02, nx)
+y_grid = np.linspace(-0.02, 0.02, ny)
+z_grid = np.linspace(-0.5, 0.5, nz)
+
+# Compile the kernels in advance
+xf.TriCubicInterpolatedFieldMap(_context=context, x_grid=x_grid[:4],
+                                y_grid=y_grid[:4], z_grid=z_grid[:4])
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    h5_filename = os.path.join(tmpdir, 'ecloud.h5')
+    with h5py.File(h5_filename, 'w') as ff:
+        ff['grid/xg'] = x_grid
+        ff['grid/yg'] = y_grid
+        ff['grid/zg'] = z_grid
+        ff['settings/symmetric2D'] = 1
+        for iz in range(nz):
+            ff[f'slices/slice{iz}/phi'] = np.random.rand(nx, ny, 8)
+    print(f'h5 file: {os.path.getsize(h5_filename)/1e6:.0f} MB')
+
+    # The files are in the page cache, the timings do not include the disk
+    # access
+    t1 = time.perf_counter()
+    fieldmap = xf.config_tools.get_electroncloud_fieldmap_from_h5(
+            filename=h5_filename, buffer=context.new_buffer())
+    t_h5 = time.perf_counter() - t1
+    phi_taylor_ref = fieldmap.get_phi_taylor()
+    del fieldmap
+
+    filename = os.path.join(tmpdir, 'ecloud.xfm')
+    t1 = time.perf_counter()
+    xf.convert_electroncloud_fieldmaps_from_h5(
+            filenames={'ecloud': h5_filename}, output_filename=filename)
+    t_convert = time.perf_counter() - t1
+
+    timings = {}
+    for use_mmap in [False, True]:
+        for verify_checksums in [False, True]:
+            t1 = time.perf_counter()
+            fieldmap = xf.load_fieldmaps(filename, context=context,
+                                         use_mmap=use_mmap,
+                                         verify_checksums=verify_checksums
+                                         )['ecloud']
+            timings[use_mmap, verify_checksums] = time.perf_counter() - t1
+            assert np.all(fieldmap.get_phi_taylor() == phi_taylor_ref)
+            del fieldmap
+
+print(f'Loading from h5: {t_h5*1e3:.0f} ms '
+      f'(conversion to the native format: {t_convert*1e3:.0f} ms)')
+for (use_mmap, verify_checksums), tt in timings.items():
+    print(f'Loading from the native format (use_mmap={use_mmap}, '
+          f'verify_checksums={verify_checksums}): {tt*1e3:.1f} ms')
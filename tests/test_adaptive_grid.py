@@ -0,0 +1,109 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import numpy as np
+
+import xobjects as xo
+import xfields as xf
+
+
+def test_adaptive_grid():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        n_part = 1000000
+        sigma_x = 1e-3
+        sigma_y = 2e-3
+        sigma_z = 1e-1
+        x_lim = 2e-2
+        y_lim = 4e-2
+        z_lim = 2.
+
+        def make_bunch(scale):
+            x = np.random.normal(0, scale*sigma_x, n_part) + 1e-3
+            y = np.random.normal(0, scale*sigma_y, n_part)
+            z = np.random.normal(0, scale*sigma_z, n_part)
+            return [context.nparray_to_context_array(vv) for vv in (x, y, z)]
+
+        ncharges = context.nparray_to_context_array(np.ones(n_part) * 1e5)
+
+        # Coarse adaptive grid
+        fmap = xf.TriLinearInterpolatedFieldMap(_context=context,
+                x_range=(-x_lim, x_lim), y_range=(-y_lim, y_lim),
+                z_range=(-z_lim, z_lim), nx=32, ny=32, nz=16,
+                solver='FFTSolver2p5D', adaptive_grid=True)
+        solver_0 = fmap.solver
+
+        x, y, z = make_bunch(1.)
+        fmap.update_from_particles(x_p=x, y_p=y, z_p=z, ncharges_p=ncharges,
+                                   q0_coulomb=1.)
+
+        # The grid follows the beam
+        n_sigmas = fmap.adaptive_grid.n_sigmas[0]
+        step = fmap.adaptive_grid.step
+        for grid, sigma, mean in [(fmap.x_grid, sigma_x, 1e-3),
+                                  (fmap.y_grid, sigma_y, 0.),
+                                  (fmap.z_grid, sigma_z, 0.)]:
+            half_width = (grid[-1] - grid[0])/2
+            assert n_sigmas*sigma*0.98 < half_width < n_sigmas*sigma*step*1.02
+            assert np.isclose((grid[-1] + grid[0])/2, mean,
+                              rtol=0, atol=0.01*sigma)
+        assert fmap._xobject.dx == fmap.dx
+        assert fmap._xobject.x_min == fmap.x_grid[0]
+        assert fmap.solver is not solver_0
+        solver_1 = fmap.solver
+        levels_1 = fmap._adaptive_grid_levels
+
+        # Same accuracy as a fine fixed grid
+        fmap_fine = xf.TriLinearInterpolatedFieldMap(_context=context,
+                x_range=(-x_lim, x_lim), y_range=(-y_lim, y_lim),
+                z_range=(-z_lim, z_lim), nx=256, ny=256, nz=64,
+                solver='FFTSolver2p5D')
+        fmap_fine.update_from_particles(x_p=x, y_p=y, z_p=z,
+                                        ncharges_p=ncharges, q0_coulomb=1.)
+
+        x_probes = np.linspace(-sigma_x, 3*sigma_x, 20)
+        y_probes = np.linspace(-2*sigma_y, sigma_y, 20)
+        z_probes = np.zeros(20)
+        probes = [context.nparray_to_context_array(vv)
+                  for vv in (x_probes, y_probes, z_probes)]
+        # Fixed grid with the same number of cells
+        fmap_fixed = xf.TriLinearInterpolatedFieldMap(_context=context,
+                x_range=(-x_lim, x_lim), y_range=(-y_lim, y_lim),
+                z_range=(-z_lim, z_lim), nx=32, ny=32, nz=16,
+                solver='FFTSolver2p5D')
+        fmap_fixed.update_from_particles(x_p=x, y_p=y, z_p=z,
+                                         ncharges_p=ncharges, q0_coulomb=1.)
+
+        for nn in ['dphi_dx', 'dphi_dy']:
+            kwargs = {f'return_{qq}': qq == nn for qq in
+                      ['rho', 'phi', 'dphi_dx', 'dphi_dy', 'dphi_dz']}
+            val, val_fine, val_fixed = [context.nparray_from_context_array(
+                    ff.get_values_at_points(*probes, **kwargs)[0])
+                    for ff in (fmap, fmap_fine, fmap_fixed)]
+            err = np.max(np.abs(val - val_fine))
+            err_fixed = np.max(np.abs(val_fixed - val_fine))
+            assert err < 0.1*np.max(np.abs(val_fine))
+            assert err < 0.3*err_fixed
+
+        # Small changes of the beam size do not change the cell size
+        x, y, z = make_bunch(0.97)
+        fmap.update_from_particles(x_p=x, y_p=y, z_p=z, ncharges_p=ncharges,
+                                   q0_coulomb=1.)
+        assert fmap._adaptive_grid_levels == levels_1
+        assert fmap.solver is solver_1
+
+        # Large ones do, and the solvers are reused
+        x, y, z = make_bunch(0.5)
+        fmap.update_from_particles(x_p=x, y_p=y, z_p=z, ncharges_p=ncharges,
+                                   q0_coulomb=1.)
+        assert fmap._adaptive_grid_levels < levels_1
+        assert fmap.solver is not solver_1
+
+        x, y, z = make_bunch(1.)
+        fmap.update_from_particles(x_p=x, y_p=y, z_p=z, ncharges_p=ncharges,
+                                   q0_coulomb=1.)
+        assert fmap._adaptive_grid_levels == levels_1
+        assert fmap.solver is solver_1
@@ -0,0 +1,156 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import numpy as np
+
+import xobjects as xo
+import xpart as xp
+import xfields as xf
+
+
+def test_deposition_private_grids():
+    context = xo.ContextCpu()
+
+    fmap = xf.TriLinearInterpolatedFieldMap(_context=context,
+            x_range=(-1, 1), y_range=(-1, 1), z_range=(-1, 1),
+            nx=20, ny=21, nz=22)
+
+    n_macroparticles = 100000
+    x = np.random.normal(0, 0.3, n_macroparticles)
+    y = np.random.normal(0, 0.3, n_macroparticles)
+    z = np.random.normal(0, 0.3, n_macroparticles)
+    ncharges = np.random.uniform(0.5, 1.5, n_macroparticles)
+    state = np.ones(n_macroparticles, dtype=np.int64)
+    state[::10] = 0
+
+    particles = xp.Particles(_context=context, p0c=7e12, x=x, y=y, zeta=z,
+                             weight=ncharges, state=state)
+
+    for kwargs in [dict(x_p=x, y_p=y, z_p=z, ncharges_p=ncharges,
+                        state_p=state, q0_coulomb=1.),
+                   dict(particles=particles)]:
+        fmap.update_from_particles(update_phi=False, **kwargs)
+        rho_atomic = fmap.rho.copy()
+
+        fmap.update_from_particles(update_phi=False,
+                                   deposition_mode='private', **kwargs)
+        assert np.allclose(fmap.rho, rho_atomic, rtol=0,
+                           atol=1e-12*np.max(rho_atomic))
+
+        # Accumulation on the existing charge density
+        fmap.update_from_particles(update_phi=False, reset=False,
+                                   deposition_mode='private', **kwargs)
+        assert np.allclose(fmap.rho, 2*rho_atomic, rtol=0,
+                           atol=1e-12*np.max(rho_atomic))
+
+
+def test_deposition_active_particles_only():
+    context = xo.ContextCpu()
+
+    fmap = xf.TriLinearInterpolatedFieldMap(_context=context,
+            x_range=(-1, 1), y_range=(-1, 1), z_range=(-1, 1),
+            nx=20, ny=21, nz=22)
+
+    n_macroparticles = 10000
+    particles = xp.Particles(_context=context, p0c=7e12,
+            x=np.random.normal(0, 0.3, n_macroparticles),
+            y=np.random.normal(0, 0.3, n_macroparticles),
+            zeta=np.random.normal(0, 0.3, n_macroparticles))
+    particles.state[::3] = 0
+
+    fmap.update_from_particles(particles=particles, update_phi=False)
+    rho_ref = fmap.rho.copy()
+
+    # Compacted particles, only the active range is visited
+    n_active, _ = particles.reorganize()
+    assert particles._num_active_particles == n_active
+
+    for deposition_mode in ['atomic', 'private']:
+        fmap.update_from_particles(particles=particles, update_phi=False,
+                                   deposition_mode=deposition_mode)
+        assert np.allclose(fmap.rho, rho_ref, rtol=0,
+                           atol=1e-12*np.max(rho_ref))
+
+    # Particles revived without updating the count of active particles are
+    # also deposited
+    particles.state[n_active:] = 1
+    fmap.update_from_particles(particles=particles, update_phi=False)
+    rho_revived = fmap.rho.copy()
+    particles_all = xp.Particles(_context=context, p0c=7e12,
+            x=particles.x, y=particles.y, zeta=particles.zeta)
+    fmap.update_from_particles(particles=particles_all, update_phi=False)
+    assert np.allclose(rho_revived, fmap.rho, rtol=0,
+                       atol=1e-12*np.max(fmap.rho))
+    assert np.sum(rho_revived) > np.sum(rho_ref)
+
+
+def test_deposition_factorized():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        nx, ny, nz = 20, 21, 22
+        fmaps = [xf.TriLinearInterpolatedFieldMap(_context=context,
+                    x_range=(-1, 1), y_range=(-1, 1), z_range=(-1, 1),
+                    nx=nx, ny=ny, nz=nz, solver='FFTSolver2p5D',
+                    factorized=factorized)
+                 for factorized in (False, True)]
+
+        n_macroparticles = 100000
+        particles = xp.Particles(_context=context, p0c=7e12,
+                x=np.random.normal(0, 0.3, n_macroparticles),
+                y=np.random.normal(0, 0.3, n_macroparticles),
+                zeta=np.random.normal(0, 0.3, n_macroparticles),
+                weight=np.random.uniform(0.5, 1.5, n_macroparticles))
+
+        for fmap in fmaps:
+            fmap.update_from_particles(particles=particles)
+
+        # The trilinear weights are products of the weights along each
+        # direction, hence the factors are the projections of the 3D density
+        p2np = context.nparray_from_context_array
+        rho = p2np(fmaps[0].rho)
+        fmap = fmaps[1]
+        rho_xy = p2np(fmap._rho_xy).reshape((nx, ny), order='F')
+        line_density = p2np(fmap._line_density)
+        assert np.allclose(rho_xy, rho.sum(axis=2)*fmap.dz, rtol=0,
+                           atol=1e-12*np.max(rho_xy))
+        assert np.allclose(line_density, rho.sum(axis=(0, 1))*fmap.dx*fmap.dy,
+                           rtol=0, atol=1e-12*np.max(line_density))
+
+        q_tot = np.sum(line_density)*fmap.dz
+        assert np.allclose(p2np(fmap.rho),
+                           rho_xy[:, :, None]*line_density[None, None, :]/q_tot,
+                           rtol=0, atol=1e-12*np.max(rho))
+
+
+def test_factorized_potential():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        nx, ny, nz = 32, 33, 15
+        x_grid = np.linspace(-1, 1, nx)
+        y_grid = np.linspace(-1, 1, ny)
+        z_grid = np.linspace(-1, 1, nz)
+
+        # Separable charge density, for which the factorization is exact
+        rho = (np.exp(-x_grid[:, None, None]**2/0.1
+                      - y_grid[None, :, None]**2/0.2)
+               * np.exp(-z_grid[None, None, :]**2/0.3))
+
+        fmaps = [xf.TriLinearInterpolatedFieldMap(_context=context,
+                    x_grid=x_grid, y_grid=y_grid, z_grid=z_grid,
+                    solver='FFTSolver2p5D', factorized=factorized)
+                 for factorized in (False, True)]
+        assert fmaps[1].solver.nz == 1
+
+        p2np = context.nparray_from_context_array
+        for fmap in fmaps:
+            fmap.update_rho(context.nparray_to_context_array(rho))
+            fmap.update_phi_from_rho()
+
+        for nn in ['phi', 'dphi_dx', 'dphi_dy', 'dphi_dz']:
+            vv_ref = p2np(getattr(fmaps[0], nn))
+            assert np.allclose(p2np(getattr(fmaps[1], nn)), vv_ref, rtol=0,
+                               atol=1e-10*np.max(np.abs(vv_ref)))
@@ -3,6 +3,9 @@
 # Copyright (c) CERN, 2021.                   #
 # ########################################### #
 
+import os
+import tempfile
+
 import numpy as np
 from numpy.random import default_rng
 import xobjects as xo
@@ -102,3 +105,380 @@ def test_tricubic_interpolation():
         assert np.allclose(part.px[mask_p], true_px, atol=1.e-13, rtol=1.e-13)
         assert np.allclose(part.py[mask_p], true_py, atol=1.e-13, rtol=1.e-13)
         assert np.allclose(part.ptau[mask_p], true_ptau, atol=1.e-13, rtol=1.e-13)
+
+
+def test_tricubic_precomputed_coefficients():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        x_grid = np.linspace(-0.5, 0.5, 15)
+        y_grid = np.linspace(-0.4, 0.4, 13)
+        z_grid = np.linspace(-0.3, 0.3, 11)
+        rng = default_rng(12345)
+        phi = rng.random((len(x_grid), len(y_grid), len(z_grid)))
+
+        fieldmaps = {}
+        for precompute in [False, True]:
+            fieldmaps[precompute] = xf.TriCubicInterpolatedFieldMap(
+                    _context=context,
+                    x_grid=x_grid, y_grid=y_grid, z_grid=z_grid,
+                    mirror_x=1, phi=phi,
+                    precompute_coefficients=precompute)
+        assert len(fieldmaps[False]._coefs) == 0
+        assert len(fieldmaps[True]._coefs) == 64 * 14 * 12 * 10
+
+        # Map built from phi_taylor, with shape (nx, ny, nz, 8)
+        phi_taylor = context.nparray_from_context_array(
+                fieldmaps[False]._phi_taylor).reshape(
+                (8,) + phi.shape, order='F').transpose(1, 2, 3, 0)
+        fieldmaps['from_phi_taylor'] = xf.TriCubicInterpolatedFieldMap(
+                _context=context,
+                x_grid=x_grid, y_grid=y_grid, z_grid=z_grid,
+                mirror_x=1, phi_taylor=phi_taylor,
+                precompute_coefficients=True)
+
+        n_parts = 1000
+        x_test = rng.random(n_parts) * 1.2 - 0.6
+        y_test = rng.random(n_parts) * 0.9 - 0.45
+        tau_test = rng.random(n_parts) * 0.7 - 0.35
+        p0c = 450e9
+        beta0 = xp.Particles(p0c=p0c).beta0[0]
+
+        def track(fieldmap):
+            ecloud = xf.ElectronCloud(length=1, fieldmap=fieldmap,
+                                      _buffer=fieldmap._buffer)
+            part = xp.Particles(_context=context, x=x_test, y=y_test,
+                                zeta=beta0*tau_test, p0c=p0c)
+            ecloud.track(part)
+            part.move(_context=xo.ContextCpu())
+            return part
+
+        part_ref = track(fieldmaps[False])
+        assert np.any(part_ref.state == -11)
+        for key in [True, 'from_phi_taylor']:
+            part = track(fieldmaps[key])
+            assert np.all(part.state == part_ref.state)
+            for nn in ['px', 'py', 'ptau']:
+                assert np.allclose(getattr(part, nn), getattr(part_ref, nn),
+                                   rtol=1e-14, atol=0)
+
+        # After a direct modification of phi_taylor the coefficients need
+        # to be updated
+        for key in [False, True]:
+            fieldmaps[key]._phi_taylor[:] *= 2
+        fieldmaps[True].update_coefficients()
+        part_ref = track(fieldmaps[False])
+        part = track(fieldmaps[True])
+        for nn in ['px', 'py', 'ptau']:
+            assert np.allclose(getattr(part, nn), getattr(part_ref, nn),
+                               rtol=1e-14, atol=0)
+
+
+def test_tricubic_blocked_layout():
+    for context in xo.context.get_test_contexts():
+        if isinstance(context, xo.ContextPyopencl):
+            print(f'skipping test_tricubic_blocked_layout for context {context}')
+            continue
+        print(f"Test {context.__class__}")
+
+        # Grid sizes that are not multiples of the brick size
+        x_grid = np.linspace(-0.5, 0.5, 15)
+        y_grid = np.linspace(-0.4, 0.4, 10)
+        z_grid = np.linspace(-0.3, 0.3, 7)
+        rng = default_rng(12345)
+        phi = rng.random((len(x_grid), len(y_grid), len(z_grid)))
+
+        fieldmaps = {}
+        for layout in ['linear', 'blocked']:
+            for precompute in [False, True]:
+                fieldmaps[layout, precompute] = xf.TriCubicInterpolatedFieldMap(
+                        _context=context,
+                        x_grid=x_grid, y_grid=y_grid, z_grid=z_grid,
+                        mirror_y=1, phi=phi,
+                        precompute_coefficients=precompute,
+                        phi_taylor_layout=layout)
+        assert len(fieldmaps['blocked', False]._phi_taylor) == 8*64*4*3*2
+
+        phi_taylor = context.nparray_from_context_array(
+                fieldmaps['linear', False].get_phi_taylor())
+        assert np.allclose(phi_taylor[:, :, :, 0], phi, rtol=0, atol=1e-15)
+        for key, fieldmap in fieldmaps.items():
+            assert np.all(context.nparray_from_context_array(
+                        fieldmap.get_phi_taylor()) == phi_taylor)
+
+        # Map set by longitudinal slices (also across layers of bricks)
+        for n_planes in [2, 3]:
+            fieldmap = xf.TriCubicInterpolatedFieldMap(_context=context,
+                    x_grid=x_grid, y_grid=y_grid, z_grid=z_grid, mirror_y=1,
+                    phi_taylor_layout='blocked')
+            for iz in range(0, len(z_grid), n_planes):
+                fieldmap.update_phi_taylor(
+                        phi_taylor[:, :, iz:iz+n_planes, :], iz_start=iz)
+            assert np.all(fieldmap._phi_taylor
+                          == fieldmaps['blocked', False]._phi_taylor)
+
+        n_parts = 1000
+        x_test = rng.random(n_parts) * 1.2 - 0.6
+        y_test = rng.random(n_parts) * 0.9 - 0.45
+        tau_test = rng.random(n_parts) * 0.7 - 0.35
+        p0c = 450e9
+        beta0 = xp.Particles(p0c=p0c).beta0[0]
+
+        def track(fieldmap):
+            ecloud = xf.ElectronCloud(length=1, fieldmap=fieldmap,
+                                      _buffer=fieldmap._buffer)
+            part = xp.Particles(_context=context, x=x_test, y=y_test,
+                                zeta=beta0*tau_test, p0c=p0c)
+            ecloud.track(part)
+            part.move(_context=xo.ContextCpu())
+            return part
+
+        part_ref = track(fieldmaps['linear', False])
+        for key in [('blocked', False), ('blocked', True)]:
+            part = track(fieldmaps[key])
+            assert np.all(part.state == part_ref.state)
+            for nn in ['px', 'py', 'ptau']:
+                assert np.allclose(getattr(part, nn), getattr(part_ref, nn),
+                                   rtol=1e-14, atol=0)
+
+
+def test_tricubic_single_precision():
+    for context in xo.context.get_test_contexts():
+        if isinstance(context, xo.ContextPyopencl):
+            print(f'skipping test_tricubic_single_precision for context {context}')
+            continue
+        print(f"Test {context.__class__}")
+
+        x_grid = np.linspace(-0.5, 0.5, 15)
+        y_grid = np.linspace(-0.4, 0.4, 10)
+        z_grid = np.linspace(-0.3, 0.3, 7)
+        XX, YY, ZZ = np.meshgrid(x_grid, y_grid, z_grid, indexing='ij')
+        phi = (XX**2 - YY**2) * np.cos(np.pi * ZZ) + XX * YY * ZZ
+
+        fieldmaps = {}
+        for dtype in ['float64', 'float32']:
+            for layout in ['linear', 'blocked']:
+                fieldmaps[dtype, layout] = xf.TriCubicInterpolatedFieldMap(
+                        _context=context,
+                        x_grid=x_grid, y_grid=y_grid, z_grid=z_grid,
+                        phi=phi, phi_taylor_layout=layout,
+                        phi_taylor_dtype=dtype)
+        fmap32 = fieldmaps['float32', 'linear']
+        assert fmap32.phi_taylor_dtype == np.float32
+        assert len(fmap32._phi_taylor) == 0
+        assert len(fmap32._phi_taylor_f32) == 8 * phi.size
+
+        phi_taylor = context.nparray_from_context_array(
+                fieldmaps['float64', 'linear'].get_phi_taylor())
+        for layout in ['linear', 'blocked']:
+            phi_taylor_32 = context.nparray_from_context_array(
+                    fieldmaps['float32', layout].get_phi_taylor())
+            assert phi_taylor_32.dtype == np.float32
+            assert np.all(phi_taylor_32 == phi_taylor.astype(np.float32))
+
+        rng = default_rng(12345)
+        n_parts = 1000
+        x_test = rng.random(n_parts) * 0.9 - 0.45
+        y_test = rng.random(n_parts) * 0.7 - 0.35
+        tau_test = rng.random(n_parts) * 0.5 - 0.25
+        p0c = 450e9
+        beta0 = xp.Particles(p0c=p0c).beta0[0]
+
+        kicks = {}
+        for key, fieldmap in fieldmaps.items():
+            ecloud = xf.ElectronCloud(length=1, fieldmap=fieldmap,
+                                      _buffer=fieldmap._buffer)
+            part = xp.Particles(_context=context, x=x_test, y=y_test,
+                                zeta=beta0*tau_test, p0c=p0c)
+            ecloud.track(part)
+            part.move(_context=xo.ContextCpu())
+            assert np.all(part.state == 1)
+            kicks[key] = [getattr(part, nn) for nn in ['px', 'py', 'ptau']]
+
+        for layout in ['linear', 'blocked']:
+            for kk64, kk32 in zip(kicks['float64', 'linear'],
+                                  kicks['float32', layout]):
+                assert np.allclose(kk32, kk64, rtol=0,
+                                   atol=1e-6*np.max(np.abs(kk64)))
+
+
+def test_tricubic_mapped_fieldmaps():
+    x_grid = np.linspace(-0.5, 0.5, 15)
+    y_grid = np.linspace(-0.4, 0.4, 10)
+    z_grid = np.linspace(-0.3, 0.3, 7)
+    rng = default_rng(12345)
+    phi = rng.random((len(x_grid), len(y_grid), len(z_grid)))
+
+    n_parts = 1000
+    x_test = rng.random(n_parts) * 1.2 - 0.6
+    y_test = rng.random(n_parts) * 0.9 - 0.45
+    tau_test = rng.random(n_parts) * 0.7 - 0.35
+    p0c = 450e9
+    beta0 = xp.Particles(p0c=p0c).beta0[0]
+
+    def track(context, fieldmap):
+        ecloud = xf.ElectronCloud(length=1, fieldmap=fieldmap,
+                                  _buffer=fieldmap._buffer)
+        part = xp.Particles(_context=context, x=x_test, y=y_test,
+                            zeta=beta0*tau_test, p0c=p0c)
+        ecloud.track(part)
+        part.move(_context=xo.ContextCpu())
+        return part
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        fieldmaps = {
+            'linear': xf.TriCubicInterpolatedFieldMap(_context=context,
+                    x_grid=x_grid, y_grid=y_grid, z_grid=z_grid,
+                    mirror_y=1, phi=phi),
+            'blocked_f32': xf.TriCubicInterpolatedFieldMap(_context=context,
+                    x_grid=x_grid, y_grid=y_grid, z_grid=z_grid,
+                    mirror_y=1, phi=phi, phi_taylor_layout='blocked',
+                    phi_taylor_dtype='float32',
+                    precompute_coefficients=True),
+            }
+        if isinstance(context, xo.ContextPyopencl):
+            del fieldmaps['blocked_f32']
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'fieldmaps.xfm')
+            xf.save_fieldmaps(filename, fieldmaps)
+            with open(filename, 'rb') as fid:
+                content = fid.read()
+
+            # The options of the h5 loader cannot be applied to the file
+            for kwargs in [dict(filenames={'linear': 'ecloud.h5'}),
+                           dict(tau_max=0.1),
+                           dict(phi_taylor_layout='blocked'),
+                           dict(phi_taylor_dtype='float32')]:
+                try:
+                    xf.full_electroncloud_setup(
+                            context=context, fieldmaps_filename=filename,
+                            **kwargs)
+                except ValueError:
+                    pass
+                else:
+                    raise AssertionError(f'{kwargs} was not rejected')
+
+            use_mmap_options = [False]
+            if isinstance(context, xo.ContextCpu):
+                use_mmap_options.append(True)
+            for use_mmap in use_mmap_options:
+                loaded = xf.load_fieldmaps(filename, context=context,
+                                           use_mmap=use_mmap)
+                assert set(loaded.keys()) == set(fieldmaps.keys())
+                buffer = loaded['linear']._buffer
+                for name, fieldmap in loaded.items():
+                    assert fieldmap._buffer is buffer
+                    assert np.allclose(fieldmap.z_grid,
+                                       fieldmaps[name].z_grid,
+                                       rtol=0, atol=1e-15)
+                    assert fieldmap.phi_taylor_layout == \
+                                fieldmaps[name].phi_taylor_layout
+                    assert fieldmap.phi_taylor_dtype == \
+                                fieldmaps[name].phi_taylor_dtype
+                    assert np.all(context.nparray_from_context_array(
+                                fieldmap.get_phi_taylor())
+                            == context.nparray_from_context_array(
+                                fieldmaps[name].get_phi_taylor()))
+
+                    part_ref = track(context, fieldmaps[name])
+                    part = track(context, fieldmap)
+                    assert np.all(part.state == part_ref.state)
+                    for nn in ['px', 'py', 'ptau']:
+                        assert np.all(getattr(part, nn)
+                                      == getattr(part_ref, nn))
+
+                if use_mmap:
+                    # The elements are allocated in the reserved space of
+                    # the file, the mapping is kept
+                    assert isinstance(buffer, xf.fieldmaps.MappedBufferCpu)
+                    assert buffer.is_mapped
+
+                # The modifications of the loaded maps do not affect the file
+                loaded['linear'].update_phi(2*phi)
+                with open(filename, 'rb') as fid:
+                    assert fid.read() == content
+                del loaded, buffer
+
+
+def test_electroncloud_fieldmap_conversion():
+    try:
+        import h5py
+    except ImportError:
+        print('skipping test_electroncloud_fieldmap_conversion (no h5py)')
+        return
+
+    x_grid = np.linspace(-0.5, 0.5, 15)
+    y_grid = np.linspace(-0.4, 0.4, 10)
+    z_grid = np.linspace(-0.3, 0.3, 7)
+    rng = default_rng(12345)
+    # phi and its derivatives (not scaled with the cell size)
+    phi_slices = rng.random((len(z_grid), len(x_grid), len(y_grid), 8))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        h5_filename = os.path.join(tmpdir, 'ecloud.h5')
+        with h5py.File(h5_filename, 'w') as ff:
+            ff['grid/xg'] = x_grid
+            ff['grid/yg'] = y_grid
+            ff['grid/zg'] = z_grid
+            ff['settings/symmetric2D'] = 1
+            for iz in range(len(z_grid)):
+                ff[f'slices/slice{iz}/phi'] = phi_slices[iz]
+
+        filename = os.path.join(tmpdir, 'ecloud.xfm')
+        xf.convert_electroncloud_fieldmaps_from_h5(
+                filenames={'quads': h5_filename}, output_filename=filename,
+                tau_max=0.15, phi_taylor_layout='blocked')
+
+        header = xf.read_fieldmaps_header(filename)
+        assert header['metadata']['tau_max'] == 0.15
+        entry = header['fieldmaps']['quads']
+        assert entry['phi_taylor_layout'] == 'blocked'
+        assert entry['grid']['nx'] == len(x_grid)
+        assert entry['grid']['mirror_x'] == 1
+        # Slices from -tau_max to tau_max, plus one on each side
+        assert entry['grid']['nz'] == 5
+        assert entry['grid']['z_min'] == z_grid[1]
+
+        fieldmap_ref = xf.config_tools.get_electroncloud_fieldmap_from_h5(
+                filename=h5_filename, tau_max=0.15,
+                buffer=xo.ContextCpu().new_buffer())
+        phi_taylor_ref = fieldmap_ref.get_phi_taylor()
+        scale = np.array([1, fieldmap_ref.dx, fieldmap_ref.dy,
+                          fieldmap_ref.dz, fieldmap_ref.dx*fieldmap_ref.dy,
+                          fieldmap_ref.dx*fieldmap_ref.dz,
+                          fieldmap_ref.dy*fieldmap_ref.dz,
+                          fieldmap_ref.dx*fieldmap_ref.dy*fieldmap_ref.dz])
+        assert np.all(phi_taylor_ref
+                      == np.moveaxis(phi_slices[1:6], 0, 2) * scale)
+
+        for context in xo.context.get_test_contexts():
+            if isinstance(context, xo.ContextPyopencl):
+                print('skipping test_electroncloud_fieldmap_conversion '
+                      f'for context {context}')
+                continue
+            print(f"Test {context.__class__}")
+            for use_mmap in [False, True]:
+                if use_mmap and not isinstance(context, xo.ContextCpu):
+                    continue
+                fieldmap = xf.load_fieldmaps(filename, context=context,
+                                             use_mmap=use_mmap)['quads']
+                assert np.all(context.nparray_from_context_array(
+                                fieldmap.get_phi_taylor()) == phi_taylor_ref)
+
+        # Corrupted file
+        with open(filename, 'r+b') as fid:
+            fid.seek(entry['offset'] + entry['nbytes'] - 1)
+            fid.write(b'\x01')
+        for use_mmap in [False, True]:
+            try:
+                xf.load_fieldmaps(filename, context=xo.ContextCpu(),
+                                  use_mmap=use_mmap)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError('The checksum was not verified')
+        xf.load_fieldmaps(filename, context=xo.ContextCpu(),
+                          verify_checksums=False)
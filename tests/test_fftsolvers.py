@@ -0,0 +1,726 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import gc
+import tempfile
+import weakref
+
+import numpy as np
+
+import xobjects as xo
+import xpart as xp
+import xfields as xf
+from xfields.solvers import FFTSolver2p5D
+from xfields.solvers.base import Solver
+
+
+def test_rfft_solvers():
+    context = xo.ContextCpu()
+
+    nx, ny, nz = 32, 24, 10
+    dx, dy, dz = 1e-3, 2e-3, 1e-2
+
+    rho = np.random.rand(nx, ny, nz)
+
+    for solver_class in [xf.FFTSolver3D, FFTSolver2p5D]:
+        print(f"Test {solver_class.__name__}")
+
+        solver = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                              context=context)
+        solver_rfft = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                                   context=context, rfft=True)
+
+        # Only the non-redundant half of the spectrum is stored
+        assert (solver_rfft._gint_rep_transf_dev.size
+                < 0.6 * solver._gint_rep_transf_dev.size)
+
+        phi = solver.solve(rho).copy()
+        phi_rfft = solver_rfft.solve(rho)
+
+        assert np.allclose(phi_rfft, phi, rtol=0,
+                           atol=1e-12*np.max(np.abs(phi)))
+
+
+def test_solver_workspace():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        nx, ny, nz = 16, 12, 8
+        dx, dy, dz = 1e-3, 2e-3, 1e-2
+
+        rho1 = np.random.rand(nx, ny, nz)
+        rho2 = np.random.rand(nx, ny, nz)
+        rho1_dev = context.nparray_to_context_array(rho1)
+        rho2_dev = context.nparray_to_context_array(rho2)
+        p2np = context.nparray_from_context_array
+
+        for solver_class in [xf.FFTSolver3D, FFTSolver2p5D]:
+            solver_a = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                                    context=context, share_workspace=True)
+            solver_b = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                                    context=context, fftplan=solver_a.fftplan,
+                                    share_workspace=True)
+            solver_own = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny,
+                                      nz=nz, context=context)
+
+            assert solver_b._workspace_dev is solver_a._workspace_dev
+            assert solver_own._workspace_dev is not solver_a._workspace_dev
+
+            # By default the potential is not overwritten by other solvers
+            solver_c = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                                    context=context)
+            phi_own = solver_own.solve(rho1_dev)
+            solver_c.solve(rho2_dev)
+            assert solver_c._workspace_dev is not solver_own._workspace_dev
+
+            phi1_ref = p2np(phi_own).copy()
+            phi2_ref = p2np(solver_own.solve(rho2_dev)).copy()
+
+            # No new workspace is allocated to solve
+            context.zeros = None
+            try:
+                phi1 = p2np(solver_a.solve(rho1_dev)).copy()
+                phi2 = p2np(solver_b.solve(rho2_dev)).copy()
+                phi1_again = p2np(solver_a.solve(rho1_dev)).copy()
+            finally:
+                del context.zeros
+
+            for phi, phi_ref in [(phi1, phi1_ref), (phi2, phi2_ref),
+                                 (phi1_again, phi1_ref)]:
+                assert np.allclose(phi, phi_ref, rtol=0,
+                                   atol=1e-12*np.max(np.abs(phi_ref)))
+
+            # A private workspace is not given to the solvers created later
+            solver_own = solver_class(dx=dx, dy=dy, dz=dz, nx=nx + 1,
+                                      ny=ny, nz=nz, context=context,
+                                      share_workspace=False)
+            solver_shared = solver_class(dx=dx, dy=dy, dz=dz, nx=nx + 1,
+                                         ny=ny, nz=nz, context=context,
+                                         share_workspace=True)
+            assert (solver_shared._workspace_dev
+                    is not solver_own._workspace_dev)
+
+
+def test_green_function_cache():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        cache = xf.solvers.default_green_function_cache
+        cache.clear()
+
+        x_lim, y_lim, z_lim = 1e-2, 2e-2, 3e-1
+        gamma0 = 2.
+
+        for solver in ['FFTSolver3D', 'FFTSolver2p5D']:
+            fmaps = [xf.TriLinearInterpolatedFieldMap(
+                        _context=context,
+                        x_range=(-x_lim, x_lim), y_range=(-y_lim, y_lim),
+                        z_range=(-z_lim, z_lim), nx=16, ny=12, nz=8,
+                        solver=solver,
+                        scale_coordinates_in_solver=(1., 1., scale_z))
+                     for scale_z in (gamma0, gamma0, 1.)]
+
+            # Identical grids share the green function
+            assert (fmaps[1].solver._gint_rep_transf_dev
+                    is fmaps[0].solver._gint_rep_transf_dev)
+
+            # The cached green function is the one computed by the solver
+            fmap = fmaps[2]
+            solver_own = getattr(xf.solvers, solver)(
+                    dx=fmap.dx, dy=fmap.dy, dz=fmap.dz,
+                    nx=fmap.nx, ny=fmap.ny, nz=fmap.nz, context=context,
+                    use_green_function_cache=False)
+            gint_ref = context.nparray_from_context_array(
+                    fmap.solver._gint_rep_transf_dev)
+            gint_own = context.nparray_from_context_array(
+                    solver_own._gint_rep_transf_dev)
+            assert np.allclose(gint_own, gint_ref, rtol=0,
+                               atol=1e-14*np.max(np.abs(gint_ref)))
+
+            if solver == 'FFTSolver3D':
+                # The longitudinal scaling changes the 3D green function
+                assert (fmaps[2].solver._gint_rep_transf_dev
+                        is not fmaps[0].solver._gint_rep_transf_dev)
+            else:
+                # The 2.5D green function does not depend on z
+                assert (fmaps[2].solver._gint_rep_transf_dev
+                        is fmaps[0].solver._gint_rep_transf_dev)
+
+        assert len(cache) == 3
+
+        # The least recently used entries are released above the size cap
+        max_bytes = cache.max_bytes
+        try:
+            nbytes_2p5d = fmaps[0].solver._gint_rep_transf_dev.nbytes
+            cache.max_bytes = nbytes_2p5d
+            cache.evict()
+            assert len(cache) == 1
+            assert cache.nbytes == nbytes_2p5d
+
+            # The released entries are still shared while used by a solver,
+            # and freed with the last one
+            cache.max_bytes = 0
+            cache.evict()
+            assert len(cache) == 0
+            gint = fmaps[0].solver._gint_rep_transf_dev
+            fmap = xf.TriLinearInterpolatedFieldMap(
+                        _context=context,
+                        x_range=(-x_lim, x_lim), y_range=(-y_lim, y_lim),
+                        z_range=(-z_lim, z_lim), nx=16, ny=12, nz=8,
+                        solver='FFTSolver2p5D')
+            assert fmap.solver._gint_rep_transf_dev is gint
+            gint_ref = weakref.ref(gint)
+            del fmaps, fmap, gint
+            gc.collect()
+            assert gint_ref() is None
+        finally:
+            cache.max_bytes = max_bytes
+            cache.clear()
+
+
+def test_green_function_disk_cache():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        cache = xf.solvers.default_green_function_cache
+        cache.clear()
+
+        nx, ny, nz = 16, 12, 8
+        dx, dy, dz = 1e-3, 2e-3, 1e-2
+
+        rho = context.nparray_to_context_array(np.random.rand(nx, ny, nz))
+        p2np = context.nparray_from_context_array
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            disk_cache = xf.solvers.GreenFunctionDiskCache(tmpdir)
+            cache.disk_cache = disk_cache
+            try:
+                solver = xf.FFTSolver3D(dx=dx, dy=dy, dz=dz,
+                                        nx=nx, ny=ny, nz=nz, context=context)
+                phi_ref = p2np(solver.solve(rho)).copy()
+                fnames = list(disk_cache.directory.glob('*.npy'))
+                assert len(fnames) == 1
+
+                # Loaded from disk in a fresh process (memory cache cleared)
+                cache.clear()
+                solver = xf.FFTSolver3D(dx=dx, dy=dy, dz=dz,
+                                        nx=nx, ny=ny, nz=nz, context=context)
+                if isinstance(context, xo.ContextCpu):
+                    assert isinstance(solver._gint_rep_transf_dev, np.memmap)
+                phi = p2np(solver.solve(rho)).copy()
+                assert np.allclose(phi, phi_ref, rtol=0,
+                                   atol=1e-14*np.max(np.abs(phi_ref)))
+
+                # Corrupted entries are discarded when the checksums are
+                # verified
+                cache.clear()
+                del solver
+                data = bytearray(fnames[0].read_bytes())
+                data[-1] ^= 0xff
+                fnames[0].write_bytes(data)
+                key = ('FFTSolver3D', dx, dy, dz, nx, ny, nz, False)
+                assert disk_cache.load(context, key) is not None
+                assert disk_cache.load(context, key,
+                                       verify_checksum=True) is None
+                assert not fnames[0].exists()
+
+                # Truncated entries are always discarded
+                xf.FFTSolver3D(dx=dx, dy=dy, dz=dz,
+                               nx=nx, ny=ny, nz=nz, context=context)
+                cache.clear()
+                data = fnames[0].read_bytes()
+                fnames[0].write_bytes(data[:len(data)//2])
+                assert disk_cache.load(context, key) is None
+
+                # Least recently used entries are evicted above the size cap
+                xf.FFTSolver3D(dx=dx, dy=dy, dz=dz,
+                               nx=nx, ny=ny, nz=nz, context=context)
+                nbytes = disk_cache.nbytes
+                disk_cache.max_bytes = nbytes
+                xf.FFTSolver3D(dx=2*dx, dy=dy, dz=dz,
+                               nx=nx, ny=ny, nz=nz, context=context)
+                assert disk_cache.nbytes == nbytes
+                assert len(list(disk_cache.directory.glob('*.json'))) == 1
+            finally:
+                cache.disk_cache = None
+                cache.clear()
+
+
+def test_compact_green_function():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        nx, ny, nz = 16, 12, 8
+        dx, dy, dz = 1e-3, 2e-3, 1e-2
+
+        rho = context.nparray_to_context_array(np.random.rand(nx, ny, nz))
+        p2np = context.nparray_from_context_array
+
+        if isinstance(context, xo.ContextCpu):
+            fft_modes = [False, True]
+        else:
+            fft_modes = [False]
+
+        for rfft in fft_modes:
+            solver = xf.FFTSolver3D(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                                    context=context, rfft=rfft)
+            solver_compact = xf.FFTSolver3D(dx=dx, dy=dy, dz=dz,
+                                            nx=nx, ny=ny, nz=nz,
+                                            context=context, rfft=rfft,
+                                            compact_green_function=True)
+
+            assert solver_compact._gint_rep_transf_dev.shape == (
+                                                        nx+1, ny+1, nz+1)
+            assert solver_compact._gint_rep_transf_dev.dtype == np.float64
+
+            phi = p2np(solver.solve(rho)).copy()
+            phi_compact = p2np(solver_compact.solve(rho))
+
+            assert np.allclose(phi_compact, phi, rtol=0,
+                               atol=1e-12*np.max(np.abs(phi)))
+
+
+def test_solve_batch():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        nx, ny, nz = 16, 12, 8
+        dx, dy, dz = 1e-3, 2e-3, 1e-2
+        n_batch = 3
+
+        rho_batch = context.nparray_to_context_array(
+                                        np.random.rand(n_batch, nx, ny, nz))
+        p2np = context.nparray_from_context_array
+
+        configs = [{}, {'compact_green_function': True}]
+        if isinstance(context, xo.ContextCpu):
+            configs += [{'rfft': True},
+                        {'rfft': True, 'compact_green_function': True}]
+
+        for solver_class in [xf.FFTSolver3D, FFTSolver2p5D]:
+            for config in configs:
+                if (solver_class is FFTSolver2p5D
+                        and 'compact_green_function' in config):
+                    continue
+
+                solver = solver_class(dx=dx, dy=dy, dz=dz,
+                                      nx=nx, ny=ny, nz=nz,
+                                      context=context, **config)
+
+                phi_batch = p2np(solver.solve_batch(rho_batch)).copy()
+                assert phi_batch.shape == (n_batch, nx, ny, nz)
+
+                for ib in range(n_batch):
+                    phi = p2np(solver.solve(rho_batch[ib]))
+                    assert np.allclose(phi_batch[ib], phi, rtol=0,
+                                       atol=1e-12*np.max(np.abs(phi)))
+
+
+def test_custom_solver():
+
+    class ScaledRhoSolver(Solver):
+        # Minimal solver, without phi_out nor solve_batch
+        def __init__(self, context=None, scale=2.):
+            self.scale = scale
+
+        def solve(self, rho):
+            return self.scale * rho
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        p2np = context.nparray_from_context_array
+        fmap_kwargs = dict(_context=context, x_range=(-1, 1), y_range=(-2, 2),
+                           z_range=(-3, 3), nx=16, ny=12, nz=8)
+        rho = np.random.rand(16, 12, 8)
+        phi_ref = 2 * rho
+
+        solver = ScaledRhoSolver()
+        assert not solver.supports_phi_out
+
+        fmap = xf.TriLinearInterpolatedFieldMap(**fmap_kwargs)
+        fmap.update_rho(context.nparray_to_context_array(rho))
+        fmap.update_phi_from_rho(solver=solver)
+        assert np.allclose(p2np(fmap.phi), phi_ref, rtol=0, atol=1e-14)
+
+        # Without solve_batch the maps are solved one by one
+        fmaps = [xf.TriLinearInterpolatedFieldMap(**fmap_kwargs)
+                 for _ in range(2)]
+        for ii, fmap in enumerate(fmaps):
+            fmap.update_rho(context.nparray_to_context_array((ii + 1) * rho))
+        xf.TriLinearInterpolatedFieldMap.update_phi_from_rho_batch(
+                                                    fmaps, solver=solver)
+        for ii, fmap in enumerate(fmaps):
+            assert np.allclose(p2np(fmap.phi), (ii + 1) * phi_ref, rtol=0,
+                               atol=1e-14)
+            fmap_ref = xf.TriLinearInterpolatedFieldMap(**fmap_kwargs)
+            fmap_ref.update_phi(context.nparray_to_context_array(
+                                                        (ii + 1) * phi_ref))
+            assert np.allclose(p2np(fmap.dphi_dx), p2np(fmap_ref.dphi_dx),
+                               rtol=0, atol=1e-12)
+
+
+def test_update_from_particles_batch():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        n_batch = 3
+        fmap_kwargs = dict(_context=context,
+                           x_range=(-1e-2, 1e-2), y_range=(-2e-2, 2e-2),
+                           z_range=(-3e-1, 3e-1), nx=16, ny=12, nz=8,
+                           solver='FFTSolver2p5D')
+
+        particles = []
+        for ib in range(n_batch):
+            n_part = 10000
+            particles.append(xp.Particles(_context=context, p0c=7e12,
+                    x=np.random.normal(0, 2e-3, n_part),
+                    y=np.random.normal(0, 4e-3, n_part),
+                    zeta=np.random.normal(0, 5e-2, n_part),
+                    weight=1e6*(ib+1)))
+
+        fmaps_batch = [xf.TriLinearInterpolatedFieldMap(**fmap_kwargs)
+                       for _ in range(n_batch)]
+        xf.TriLinearInterpolatedFieldMap.update_from_particles_batch(
+                                            fmaps_batch, particles)
+
+        for fmap_batch, pp in zip(fmaps_batch, particles):
+            fmap = xf.TriLinearInterpolatedFieldMap(**fmap_kwargs)
+            fmap.update_from_particles(particles=pp)
+            for nn in ['rho', 'phi', 'dphi_dx', 'dphi_dy', 'dphi_dz']:
+                ref = context.nparray_from_context_array(getattr(fmap, nn))
+                assert np.allclose(
+                    context.nparray_from_context_array(
+                                            getattr(fmap_batch, nn)),
+                    ref, rtol=0, atol=1e-12*np.max(np.abs(ref)))
+
+
+def test_integrated_green_function_3d():
+
+    nx, ny, nz = 16, 12, 8
+    dx, dy, dz = 1e-3, 2e-3, 1e-2
+
+    # Reference from the primitive on the full meshgrid
+    xg_F = np.arange(0, nx+2) * dx - dx/2
+    yg_F = np.arange(0, ny+2) * dy - dy/2
+    zg_F = np.arange(0, nz+2) * dz - dz/2
+    XX_F, YY_F, ZZ_F = np.meshgrid(xg_F, yg_F, zg_F, indexing='ij')
+    F_temp = xf.solvers.fftsolvers.primitive_func_3d(XX_F, YY_F, ZZ_F)
+    gint_ref = (F_temp[ 1:,  1:,  1:]
+              - F_temp[:-1,  1:,  1:]
+              - F_temp[ 1:, :-1,  1:]
+              + F_temp[:-1, :-1,  1:]
+              - F_temp[ 1:,  1:, :-1]
+              + F_temp[:-1,  1:, :-1]
+              + F_temp[ 1:, :-1, :-1]
+              - F_temp[:-1, :-1, :-1])
+
+    for memory_budget, n_threads in [(2**28, 1), (1, 1), (20000, 3)]:
+        gint = xf.solvers.fftsolvers.integrated_green_function_3d(
+                dx, dy, dz, nx, ny, nz,
+                memory_budget=memory_budget, n_threads=n_threads)
+        assert np.allclose(gint, gint_ref, rtol=0,
+                           atol=1e-12*np.max(np.abs(gint_ref)))
+
+
+def test_sliced_2p5d_solver():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        nx, ny, nz = 16, 12, 20
+        dx, dy, dz = 1e-3, 2e-3, 1e-2
+
+        # Long tails: most slices are empty
+        rho = np.zeros((nx, ny, nz))
+        rho[:, :, 8:13] = np.random.rand(nx, ny, 5)
+        rho[:, :, 2] = 1e-6 * np.random.rand(nx, ny)
+        rho_dev = context.nparray_to_context_array(rho)
+        p2np = context.nparray_from_context_array
+
+        rfft_modes = [False]
+        if isinstance(context, xo.ContextCpu):
+            rfft_modes.append(True)
+
+        for rfft in rfft_modes:
+            solver = FFTSolver2p5D(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                                   context=context, rfft=rfft)
+            phi_ref = p2np(solver.solve(rho_dev)).copy()
+
+            for n_slices_per_batch in [None, 1, 3]:
+                solver_sliced = xf.solvers.FFTSolver2p5DSliced(
+                        dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                        context=context, rfft=rfft,
+                        n_slices_per_batch=n_slices_per_batch)
+                if n_slices_per_batch is not None:
+                    assert (solver_sliced._workspace_dev.shape[2]
+                            == n_slices_per_batch)
+
+                phi = p2np(solver_sliced.solve(rho_dev))
+                assert np.allclose(phi, phi_ref, rtol=0,
+                                   atol=1e-12*np.max(np.abs(phi_ref)))
+
+            # Slices with a negligible charge are skipped
+            solver_sliced = xf.solvers.FFTSolver2p5DSliced(
+                    dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                    context=context, rfft=rfft, n_slices_per_batch=2,
+                    slice_charge_threshold=1e-3)
+            phi = p2np(solver_sliced.solve(rho_dev))
+            assert np.all(phi[:, :, 2] == 0)
+            assert np.allclose(phi[:, :, 8:13], phi_ref[:, :, 8:13], rtol=0,
+                               atol=1e-12*np.max(np.abs(phi_ref)))
+
+            # A plan built for the full grid does not fit the batch workspace
+            try:
+                xf.solvers.FFTSolver2p5DSliced(
+                        dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                        context=context, rfft=rfft, n_slices_per_batch=2,
+                        fftplan=solver.fftplan)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError('The shape of the plan was not checked')
+
+            # The plan of a sliced solver with the same batch can be reused
+            solver_reuse = xf.solvers.FFTSolver2p5DSliced(
+                    dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                    context=context, rfft=rfft, n_slices_per_batch=2,
+                    fftplan=solver_sliced.fftplan)
+            phi = p2np(solver_reuse.solve(rho_dev))
+            assert np.allclose(phi, phi_ref, rtol=0,
+                               atol=1e-12*np.max(np.abs(phi_ref)))
+
+
+def test_solve_phi_out():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        nx, ny, nz = 32, 24, 10
+        dx, dy, dz = 1e-3, 2e-3, 1e-2
+        p2np = context.nparray_from_context_array
+
+        rho = np.random.rand(nx, ny, nz)
+        rho_dev = context.nparray_to_context_array(rho)
+
+        rfft_modes = [False]
+        if isinstance(context, xo.ContextCpu):
+            rfft_modes.append(True)
+
+        for rfft in rfft_modes:
+            for solver_class in [xf.FFTSolver3D, FFTSolver2p5D,
+                                 xf.solvers.FFTSolver2p5DSliced]:
+                solver = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny,
+                                      nz=nz, context=context, rfft=rfft)
+                phi_ref = p2np(solver.solve(rho_dev)).copy()
+
+                phi_out = context.zeros((nx, ny, nz), dtype=np.float64,
+                                        order='F')
+                phi = solver.solve(rho_dev, phi_out=phi_out)
+                assert phi is phi_out
+                assert np.allclose(p2np(phi_out), phi_ref, rtol=0,
+                                   atol=1e-12*np.max(np.abs(phi_ref)))
+
+        # The field map potential is written directly by the solver
+        fmap = xf.TriLinearInterpolatedFieldMap(_context=context,
+                x_range=(-1, 1), y_range=(-2, 2), z_range=(-3, 3),
+                nx=nx, ny=ny, nz=nz, solver='FFTSolver3D')
+        fmap.update_rho(rho_dev)
+        fmap.update_phi_from_rho()
+        phi_ref = p2np(fmap.solver.solve(rho_dev)).copy()
+        assert np.allclose(p2np(fmap.phi), phi_ref, rtol=0,
+                           atol=1e-12*np.max(np.abs(phi_ref)))
+        fmap_ref = xf.TriLinearInterpolatedFieldMap(_context=context,
+                x_range=(-1, 1), y_range=(-2, 2), z_range=(-3, 3),
+                nx=nx, ny=ny, nz=nz)
+        fmap_ref.update_phi(context.nparray_to_context_array(phi_ref))
+        for nn in ['dphi_dx', 'dphi_dy', 'dphi_dz']:
+            dphi_ref = p2np(getattr(fmap_ref, nn))
+            assert np.allclose(p2np(getattr(fmap, nn)), dphi_ref, rtol=0,
+                               atol=1e-12*np.max(np.abs(dphi_ref)))
+
+
+def test_fftsolver2d():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        nx, ny = 40, 30
+        dx, dy = 1e-3, 2e-3
+        p2np = context.nparray_from_context_array
+
+        rho = np.random.rand(nx, ny)
+        rho_dev = context.nparray_to_context_array(rho)
+
+        # Same result as the 2.5D solver on each slice
+        solver_2p5d = FFTSolver2p5D(dx=dx, dy=dy, dz=1., nx=nx, ny=ny, nz=3,
+                                    context=context)
+        phi_ref = p2np(solver_2p5d.solve(context.nparray_to_context_array(
+                                np.repeat(rho[:, :, None], 3, axis=2))))
+        phi_ref = phi_ref[:, :, 0].copy()
+
+        solver = xf.solvers.FFTSolver2D(dx=dx, dy=dy, nx=nx, ny=ny,
+                                        context=context)
+        assert solver._workspace_dev.shape == (2*nx, 2*ny, 1)
+        phi = p2np(solver.solve(rho_dev))
+        assert phi.shape == (nx, ny)
+        assert np.allclose(phi, phi_ref, rtol=0,
+                           atol=1e-12*np.max(np.abs(phi_ref)))
+
+        phi_out = context.zeros((nx, ny), dtype=np.float64, order='F')
+        assert solver.solve(rho_dev, phi_out=phi_out) is phi_out
+        assert np.allclose(p2np(phi_out), phi_ref, rtol=0,
+                           atol=1e-12*np.max(np.abs(phi_ref)))
+
+        phi_batch = p2np(solver.solve_batch([rho_dev, 2*rho_dev]))
+        assert phi_batch.shape == (2, nx, ny)
+        assert np.allclose(phi_batch[1], 2*phi_ref, rtol=0,
+                           atol=1e-12*np.max(np.abs(phi_ref)))
+
+        # 2D field map: the particles are deposited irrespective of their
+        # longitudinal position, with the charge spread over z_range
+        length = 10.
+        fmap_2d = xf.TriLinearInterpolatedFieldMap(_context=context,
+                x_range=(-0.02, 0.02), y_range=(-0.03, 0.03),
+                z_range=(-length/2, length/2), nx=nx, ny=ny, nz=1,
+                solver='FFTSolver2D')
+        fmap_3d = xf.TriLinearInterpolatedFieldMap(_context=context,
+                x_range=(-0.02, 0.02), y_range=(-0.03, 0.03),
+                z_range=(-length/2, length/2), nx=nx, ny=ny, nz=11,
+                solver='FFTSolver2p5D')
+        assert fmap_2d.nz == 1 and fmap_2d.dz == length
+        assert isinstance(fmap_2d.solver, xf.solvers.FFTSolver2D)
+
+        n_macroparticles = 10000
+        particles = xp.Particles(_context=context, p0c=7e12,
+                x=np.random.normal(0, 4e-3, n_macroparticles),
+                y=np.random.normal(0, 6e-3, n_macroparticles),
+                zeta=np.random.uniform(-0.45*length, 0.45*length,
+                                       n_macroparticles))
+        fmap_2d.update_from_particles(particles=particles)
+        fmap_3d.update_from_particles(particles=particles)
+
+        rho_2d = p2np(fmap_2d.rho)[:, :, 0]
+        rho_proj = p2np(fmap_3d.rho).sum(axis=2) * fmap_3d.dz / length
+        assert np.allclose(rho_2d, rho_proj, rtol=0,
+                           atol=1e-12*np.max(rho_2d))
+        assert np.all(p2np(fmap_2d.dphi_dz) == 0)
+
+        # The interpolated values do not depend on z
+        x_test = np.random.uniform(-0.015, 0.015, 100)
+        y_test = np.random.uniform(-0.025, 0.025, 100)
+        values = [p2np(vv) for vv in fmap_2d.get_values_at_points(
+                    x=context.nparray_to_context_array(x_test),
+                    y=context.nparray_to_context_array(y_test),
+                    z=context.nparray_to_context_array(0*x_test))]
+        values_far = [p2np(vv) for vv in fmap_2d.get_values_at_points(
+                    x=context.nparray_to_context_array(x_test),
+                    y=context.nparray_to_context_array(y_test),
+                    z=context.nparray_to_context_array(0*x_test + 100.))]
+        for vv, vv_far in zip(values, values_far):
+            assert np.all(vv == vv_far)
+
+
+def test_fft_padding():
+    assert ([xf.solvers.next_smooth_size(nn) for nn in [1, 7, 14, 62, 97, 262]]
+            == [1, 8, 15, 64, 100, 270])
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        # Sizes with large prime factors
+        nx, ny, nz = 19, 13, 11
+        dx, dy, dz = 1e-3, 2e-3, 1e-2
+        p2np = context.nparray_from_context_array
+
+        rho = np.random.rand(nx, ny, nz)
+        rho_dev = context.nparray_to_context_array(rho)
+
+        for solver_class in [xf.FFTSolver3D, FFTSolver2p5D,
+                             xf.solvers.FFTSolver2p5DSliced]:
+            solver_minimal = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny,
+                                          nz=nz, context=context)
+            phi_ref = p2np(solver_minimal.solve(rho_dev)).copy()
+
+            for fft_padding in ['smooth', 'autotune']:
+                solver = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny,
+                                      nz=nz, context=context,
+                                      fft_padding=fft_padding)
+                if fft_padding == 'smooth':
+                    assert solver.fft_shape[:2] == (40, 27)
+                assert np.allclose(p2np(solver.solve(rho_dev)), phi_ref,
+                                   rtol=0, atol=1e-12*np.max(np.abs(phi_ref)))
+
+            # The plans of the padded solvers are checked
+            try:
+                solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                             context=context, fft_padding='smooth',
+                             fftplan=solver_minimal.fftplan)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError('The shape of the plan was not checked')
+            solver_smooth = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny,
+                                         nz=nz, context=context,
+                                         fft_padding='smooth')
+            solver = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                                  context=context, fft_padding='smooth',
+                                  fftplan=solver_smooth.fftplan)
+            assert np.allclose(p2np(solver.solve(rho_dev)), phi_ref,
+                               rtol=0, atol=1e-12*np.max(np.abs(phi_ref)))
+
+        # The autotuner times the candidate shapes once per grid
+        n_choices = len(xf.solvers.fft_shape_tuner)
+        fmaps = [xf.TriLinearInterpolatedFieldMap(_context=context,
+                        x_range=(-1, 1), y_range=(-2, 2), z_range=(-3, 3),
+                        nx=nx, ny=ny, nz=nz, solver='FFTSolver3D',
+                        fft_padding='autotune') for _ in range(2)]
+        assert len(xf.solvers.fft_shape_tuner) <= n_choices + 1
+        assert fmaps[0].solver.fft_shape == fmaps[1].solver.fft_shape
+        fmaps[0].update_rho(rho_dev)
+        fmaps[0].update_phi_from_rho()
+        phi_ref = p2np(xf.FFTSolver3D(dx=fmaps[0].dx, dy=fmaps[0].dy,
+                            dz=fmaps[0].dz, nx=nx, ny=ny, nz=nz,
+                            context=context).solve(rho_dev))
+        assert np.allclose(p2np(fmaps[0].phi), phi_ref, rtol=0,
+                           atol=1e-12*np.max(np.abs(phi_ref)))
+
+
+def test_fft_backends():
+    from xfields.solvers.fft_backends import pyfftw_available
+
+    context = xo.ContextCpu()
+
+    nx, ny, nz = 20, 15, 6
+    dx, dy, dz = 1e-3, 2e-3, 1e-2
+    rho = np.random.rand(nx, ny, nz)
+
+    libraries = ['numpy', 'scipy']
+    if pyfftw_available:
+        libraries.append('pyfftw')
+
+    for library in libraries:
+        fft_backend = xf.solvers.FFTBackendCpu(library, n_threads=2)
+        for rfft in [False, True]:
+            for solver_class in [xf.FFTSolver3D, FFTSolver2p5D,
+                                 xf.solvers.FFTSolver2p5DSliced]:
+                kwargs = dict(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                              context=context, rfft=rfft,
+                              use_green_function_cache=False)
+                phi_ref = solver_class(**kwargs).solve(rho).copy()
+                solver = solver_class(fft_backend=fft_backend, **kwargs)
+                assert np.allclose(solver.solve(rho), phi_ref, rtol=0,
+                                   atol=1e-12*np.max(np.abs(phi_ref)))
+                phi_batch = solver.solve_batch([rho, 2*rho])
+                assert np.allclose(phi_batch[1], 2*phi_ref, rtol=0,
+                                   atol=1e-12*np.max(np.abs(phi_ref)))
+
+        # The plans are reused for arrays with the same shape and layout
+        data = np.zeros((2*nx, 2*ny, 2*nz), dtype=np.complex128, order='F')
+        assert (fft_backend.plan(data, axes=(0, 1, 2))
+                is fft_backend.plan(data.copy(order='F'), axes=(0, 1, 2)))
+
+    fmap = xf.TriLinearInterpolatedFieldMap(_context=context,
+            x_range=(-1, 1), y_range=(-2, 2), z_range=(-3, 3),
+            nx=nx, ny=ny, nz=nz, solver='FFTSolver2p5D',
+            fft_backend=xf.solvers.FFTBackendCpu('scipy'))
+    assert fmap.solver.fft_backend is fmap.fft_backend
@@ -0,0 +1,211 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import numpy as np
+
+import xobjects as xo
+import xfields as xf
+
+
+def _central_diff(aa, axis, step):
+    res = np.zeros_like(aa)
+    inner = [slice(None)] * 3
+    plus = [slice(None)] * 3
+    minus = [slice(None)] * 3
+    inner[axis] = slice(1, -1)
+    plus[axis] = slice(2, None)
+    minus[axis] = slice(None, -2)
+    res[tuple(inner)] = (aa[tuple(plus)] - aa[tuple(minus)]) / (2 * step)
+    return res
+
+
+def test_trilinear_update_phi_gradient():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        nx, ny, nz = 30, 31, 32
+        fmap = xf.TriLinearInterpolatedFieldMap(_context=context,
+                x_range=(-1, 1), y_range=(-2, 2), z_range=(-3, 3),
+                nx=nx, ny=ny, nz=nz)
+
+        phi = np.random.rand(nx, ny, nz)
+        fmap.update_phi(context.nparray_to_context_array(phi))
+
+        p2np = context.nparray_from_context_array
+        for axis, dphi, step in [(0, fmap.dphi_dx, fmap.dx),
+                                 (1, fmap.dphi_dy, fmap.dy),
+                                 (2, fmap.dphi_dz, fmap.dz)]:
+            assert np.allclose(p2np(dphi), _central_diff(phi, axis, step),
+                               rtol=0, atol=1e-12/step)
+
+
+def test_tricubic_update_phi_taylor():
+    context = xo.ContextCpu()
+
+    nx, ny, nz = 21, 22, 23
+    fmap = xf.TriCubicInterpolatedFieldMap(_context=context,
+            x_range=(-1, 1), y_range=(-2, 2), z_range=(-3, 3),
+            nx=nx, ny=ny, nz=nz)
+
+    phi = np.random.rand(nx, ny, nz)
+    fmap.update_phi(phi)
+
+    # Derivatives normalized with the cell size
+    phi_x = _central_diff(phi, 0, 1)
+    phi_y = _central_diff(phi, 1, 1)
+    phi_z = _central_diff(phi, 2, 1)
+    phi_xy = _central_diff(phi_x, 1, 1)
+    expected = [phi, phi_x, phi_y, phi_z, phi_xy, _central_diff(phi_x, 2, 1),
+                _central_diff(phi_y, 2, 1), _central_diff(phi_xy, 2, 1)]
+
+    phi_taylor = fmap._phi_taylor.reshape((8, nx, ny, nz), order='F')
+    for ii in range(8):
+        assert np.allclose(phi_taylor[ii], expected[ii], rtol=0, atol=1e-14)
+
+    # The work array of the blocked layout is allocated once and reused
+    fmap_blocked = xf.TriCubicInterpolatedFieldMap(_context=context,
+            x_range=(-1, 1), y_range=(-2, 2), z_range=(-3, 3),
+            nx=nx, ny=ny, nz=nz, phi_taylor_layout='blocked')
+    fmap_blocked.update_phi(np.random.rand(nx, ny, nz))
+    work = fmap_blocked._phi_taylor_work
+    fmap_blocked.update_phi(phi)
+    assert fmap_blocked._phi_taylor_work is work
+    assert np.all(fmap_blocked.get_phi_taylor() == fmap.get_phi_taylor())
+
+
+def test_trilinear_packed_gradient():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        nx, ny, nz = 30, 31, 32
+        fmaps = [xf.TriLinearInterpolatedFieldMap(_context=context,
+                    x_range=(-1, 1), y_range=(-2, 2), z_range=(-3, 3),
+                    nx=nx, ny=ny, nz=nz, packed_gradient=packed)
+                 for packed in (False, True)]
+        assert not fmaps[0].packed_gradient
+        assert fmaps[1].packed_gradient
+
+        phi = np.random.rand(nx, ny, nz)
+        for fmap in fmaps:
+            fmap.update_phi(context.nparray_to_context_array(phi))
+
+        p2np = context.nparray_from_context_array
+        for nn in ['phi', 'dphi_dx', 'dphi_dy', 'dphi_dz']:
+            assert np.all(p2np(getattr(fmaps[0], nn))
+                          == p2np(getattr(fmaps[1], nn)))
+
+        n_points = 10000
+        x = context.nparray_to_context_array(np.random.uniform(-1.1, 1.1, n_points))
+        y = context.nparray_to_context_array(np.random.uniform(-2.1, 2.1, n_points))
+        z = context.nparray_to_context_array(np.random.uniform(-3.1, 3.1, n_points))
+        values = [fmap.get_values_at_points(x, y, z, return_rho=False)
+                  for fmap in fmaps]
+        for vv_unpacked, vv_packed in zip(*values):
+            assert np.allclose(p2np(vv_packed), p2np(vv_unpacked),
+                               rtol=1e-14, atol=1e-14)
+
+
+def test_spacecharge_packed_gradient():
+    import xpart as xp
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        nx, ny, nz = 64, 64, 20
+        x_grid = np.linspace(-1e-2, 1e-2, nx)
+        y_grid = np.linspace(-1e-2, 1e-2, ny)
+        z_grid = np.linspace(-0.3, 0.3, nz)
+        phi = (np.exp(-(x_grid[:, None, None]**2 + y_grid[None, :, None]**2)
+                      / (2*3e-3**2))
+               * np.exp(-z_grid[None, None, :]**2/(2*0.1**2)))
+
+        n_part = 10000
+        x = np.random.normal(0, 3e-3, n_part)
+        y = np.random.normal(0, 3e-3, n_part)
+        zeta = np.random.normal(0, 0.1, n_part)
+
+        kicks = []
+        for packed in (False, True):
+            spcharge = xf.SpaceCharge3D(_context=context,
+                    length=1, update_on_track=False, apply_z_kick=False,
+                    x_range=(-1e-2, 1e-2), y_range=(-1e-2, 1e-2),
+                    z_range=(-0.3, 0.3), nx=nx, ny=ny, nz=nz,
+                    phi=phi, packed_gradient=packed)
+            assert spcharge.fieldmap.packed_gradient == packed
+
+            particles = xp.Particles(_context=context, p0c=7e12,
+                    x=x, y=y, zeta=zeta)
+            spcharge.track(particles)
+            kicks.append((context.nparray_from_context_array(particles.px),
+                          context.nparray_from_context_array(particles.py)))
+
+        assert np.max(np.abs(kicks[0][0])) > 0
+        for kk_unpacked, kk_packed in zip(*kicks):
+            assert np.allclose(kk_packed, kk_unpacked, rtol=1e-13, atol=0)
+
+
+def test_trilinear_single_precision():
+    import xpart as xp
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        nx, ny, nz = 64, 64, 20
+        x_grid = np.linspace(-1e-2, 1e-2, nx)
+        y_grid = np.linspace(-1e-2, 1e-2, ny)
+        z_grid = np.linspace(-0.3, 0.3, nz)
+        phi = (np.exp(-(x_grid[:, None, None]**2 + y_grid[None, :, None]**2)
+                      / (2*3e-3**2))
+               * np.exp(-z_grid[None, None, :]**2/(2*0.1**2)))
+
+        n_part = 10000
+        x = np.random.normal(0, 3e-3, n_part)
+        y = np.random.normal(0, 3e-3, n_part)
+        zeta = np.random.normal(0, 0.1, n_part)
+
+        p2np = context.nparray_from_context_array
+        for packed in (False, True):
+            kicks = []
+            values = []
+            for dtype in ('float64', 'float32'):
+                spcharge = xf.SpaceCharge3D(_context=context,
+                        length=1, update_on_track=False, apply_z_kick=False,
+                        x_range=(-1e-2, 1e-2), y_range=(-1e-2, 1e-2),
+                        z_range=(-0.3, 0.3), nx=nx, ny=ny, nz=nz,
+                        phi=phi, packed_gradient=packed,
+                        gradient_dtype=dtype)
+                fmap = spcharge.fieldmap
+                assert fmap.gradient_dtype == np.dtype(dtype)
+                for nn in ['dphi_dx', 'dphi_dy', 'dphi_dz']:
+                    assert getattr(fmap, nn).dtype == np.dtype(dtype)
+                assert fmap.phi.dtype == np.float64
+
+                if dtype == 'float32':
+                    # The work array is allocated once and reused
+                    work = fmap._gradient_work
+                    fmap.update_phi(context.nparray_to_context_array(phi),
+                                    force=True)
+                    assert fmap._gradient_work is work
+
+                values.append(fmap.get_values_at_points(
+                    *[context.nparray_to_context_array(cc)
+                      for cc in (x, y, zeta)], return_rho=False))
+
+                particles = xp.Particles(_context=context, p0c=7e12,
+                        x=x, y=y, zeta=zeta)
+                spcharge.track(particles)
+                kicks.append((p2np(particles.px), p2np(particles.py)))
+
+            # phi is not rounded, the derivatives are rounded to single
+            # precision
+            assert np.all(p2np(values[1][0]) == p2np(values[0][0]))
+            for vv64, vv32 in zip(values[0][1:], values[1][1:]):
+                vv64 = p2np(vv64)
+                assert np.allclose(p2np(vv32), vv64, rtol=0,
+                                   atol=1e-6*np.max(np.abs(vv64)))
+            assert np.max(np.abs(kicks[0][0])) > 0
+            for kk64, kk32 in zip(*kicks):
+                assert np.allclose(kk32, kk64, rtol=0,
+                                   atol=1e-6*np.max(np.abs(kk64)))
@@ -0,0 +1,114 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import numpy as np
+from scipy.constants import epsilon_0
+
+import xobjects as xo
+from xfields.solvers import MultigridSolver3D, MultigridSolver2p5D
+from xfields.solvers import elliptical_chamber_mask, rectangular_chamber_mask
+
+
+def test_multigrid_box():
+    context = xo.ContextCpu()
+
+    # Eigenfunctions of the discrete Laplacian with zero potential one cell
+    # outside the grid
+    nx, ny, nz = 64, 48, 25
+    dx, dy, dz = 1e-3, 1.5e-3, 1e-2
+    kx, ky, kz = np.pi/(nx + 1), np.pi/(ny + 1), np.pi/(nz + 1)
+    sx = np.sin(kx*np.arange(1, nx + 1))[:, None, None]
+    sy = np.sin(ky*np.arange(1, ny + 1))[None, :, None]
+    sz = np.sin(kz*np.arange(1, nz + 1))[None, None, :]
+    lam_x = (2 - 2*np.cos(kx))/dx**2
+    lam_y = (2 - 2*np.cos(ky))/dy**2
+    lam_z = (2 - 2*np.cos(kz))/dz**2
+
+    for solver_class, phi_ref, lam in [
+            (MultigridSolver3D, sx*sy*sz, lam_x + lam_y + lam_z),
+            (MultigridSolver2p5D, sx*sy*(1 + sz), lam_x + lam_y)]:
+        print(f"Test {solver_class.__name__}")
+
+        solver = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                              context=context, tol=1e-10)
+        phi = solver.solve(epsilon_0*lam*phi_ref)
+        assert np.allclose(phi, phi_ref, rtol=0, atol=1e-8)
+        n_cycles_cold = solver.n_cycles_last
+
+        # Warm start from the previous solution
+        phi = solver.solve(1.01*epsilon_0*lam*phi_ref)
+        assert np.allclose(phi, 1.01*phi_ref, rtol=0, atol=1e-8)
+        assert solver.n_cycles_last < n_cycles_cold
+
+
+def test_multigrid_chamber():
+    context = xo.ContextCpu()
+
+    nx = ny = 101
+    nz = 3
+    x_grid = np.linspace(-0.055, 0.055, nx)
+    y_grid = x_grid.copy()
+    dx = x_grid[1] - x_grid[0]
+
+    # Uniform round beam in a round chamber
+    radius_chamber = 0.05
+    radius_beam = 0.01
+    lam = 1e-9
+    rr = np.sqrt(x_grid[:, None]**2 + y_grid[None, :]**2)
+    rho = np.where(rr < radius_beam, lam/(np.pi*radius_beam**2), 0.)
+    rho = np.repeat(rho[:, :, None], nz, axis=2)
+
+    phi_ref = np.where(rr < radius_beam,
+        lam/(4*np.pi*epsilon_0)*(1 - rr**2/radius_beam**2)
+            + lam/(2*np.pi*epsilon_0)*np.log(radius_chamber/radius_beam),
+        lam/(2*np.pi*epsilon_0)*np.log(radius_chamber/np.maximum(rr, 1e-12)))
+
+    mask = elliptical_chamber_mask(x_grid, y_grid,
+                                   a=radius_chamber, b=radius_chamber)
+    solver = MultigridSolver2p5D(dx=dx, dy=dx, dz=1., nx=nx, ny=ny, nz=nz,
+                                 context=context, chamber_mask=mask)
+    phi = solver.solve(rho)
+
+    assert np.all(phi[~mask, :] == 0)
+    inside = rr < 0.9*radius_chamber
+    for iz in range(nz):
+        assert np.allclose(phi[:, :, iz][inside], phi_ref[inside], rtol=0,
+                           atol=2e-2*np.max(phi_ref))
+
+    # A rectangular chamber equal to the grid box gives the same result as
+    # no mask
+    mask = rectangular_chamber_mask(x_grid, y_grid, x_aper=1., y_aper=1.)
+    solver_rect = MultigridSolver2p5D(dx=dx, dy=dx, dz=1., nx=nx, ny=ny,
+                                      nz=nz, context=context,
+                                      chamber_mask=mask, tol=1e-10)
+    solver_box = MultigridSolver2p5D(dx=dx, dy=dx, dz=1., nx=nx, ny=ny,
+                                     nz=nz, context=context, tol=1e-10)
+    phi_rect = solver_rect.solve(rho)
+    phi_box = solver_box.solve(rho)
+    assert np.allclose(phi_rect, phi_box, rtol=0,
+                       atol=1e-8*np.max(np.abs(phi_box)))
+
+
+def test_multigrid_phi_out():
+    context = xo.ContextCpu()
+
+    nx, ny, nz = 40, 30, 5
+    x_grid = np.linspace(-0.05, 0.05, nx)
+    y_grid = np.linspace(-0.04, 0.04, ny)
+    mask = elliptical_chamber_mask(x_grid, y_grid, a=0.045, b=0.035)
+    rho = np.random.rand(nx, ny, nz)
+
+    kwargs = dict(dx=x_grid[1] - x_grid[0], dy=y_grid[1] - y_grid[0], dz=1.,
+                  nx=nx, ny=ny, nz=nz, context=context, chamber_mask=mask,
+                  tol=1e-10)
+    phi_ref = MultigridSolver2p5D(**kwargs).solve(rho).copy()
+
+    for order in ['F', 'C']:
+        phi_out = np.ones((nx, ny, nz), order=order)
+        phi = MultigridSolver2p5D(**kwargs).solve(rho, phi_out=phi_out)
+        assert phi is phi_out
+        assert np.all(phi_out[~mask, :] == 0)
+        assert np.allclose(phi_out, phi_ref, rtol=0,
+                           atol=1e-10*np.max(np.abs(phi_ref)))
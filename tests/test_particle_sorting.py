@@ -0,0 +1,63 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import numpy as np
+
+import xobjects as xo
+import xpart as xp
+import xfields as xf
+
+
+def test_particle_sorter():
+    context = xo.ContextCpu()
+
+    fmap = xf.TriLinearInterpolatedFieldMap(_context=context,
+            x_range=(-1, 1), y_range=(-1, 1), z_range=(-1, 1),
+            nx=16, ny=17, nz=18)
+
+    n_macroparticles = 10000
+    particles = xp.Particles(_context=context, p0c=7e12,
+            x=np.random.normal(0, 0.5, n_macroparticles),
+            y=np.random.normal(0, 0.5, n_macroparticles),
+            zeta=np.random.normal(0, 0.5, n_macroparticles),
+            px=np.random.normal(0, 1e-3, n_macroparticles))
+    particles.state[::7] = 0
+
+    fmap.update_from_particles(particles=particles, update_phi=False)
+    rho_unsorted = fmap.rho.copy()
+    coords = {ii: (xx, pp) for ii, xx, pp in zip(
+            particles.particle_id, particles.x, particles.px)}
+
+    sorter = xf.ParticleSorter(fmap, sort_every_n_turns=3)
+    sorter.track(particles)
+
+    # Active particles first, ordered by cell
+    n_active = np.sum(particles.state > 0)
+    assert np.all(particles.state[:n_active] > 0)
+    assert np.all(particles.state[n_active:] <= 0)
+    assert particles._num_active_particles == n_active
+    ix = np.clip(np.floor((particles.x - fmap.x_grid[0]) / fmap.dx),
+                 0, fmap.nx - 1)
+    iy = np.clip(np.floor((particles.y - fmap.y_grid[0]) / fmap.dy),
+                 0, fmap.ny - 1)
+    iz = np.clip(np.floor((particles.zeta - fmap.z_grid[0]) / fmap.dz),
+                 0, fmap.nz - 1)
+    cell = ix + fmap.nx * (iy + fmap.ny * iz)
+    assert np.all(np.diff(cell[:n_active]) >= 0)
+
+    # Same particles, same charge density
+    for ii, xx, pp in zip(particles.particle_id, particles.x, particles.px):
+        assert coords[ii] == (xx, pp)
+    fmap.update_from_particles(particles=particles, update_phi=False)
+    assert np.allclose(fmap.rho, rho_unsorted, rtol=0,
+                       atol=1e-12*np.max(rho_unsorted))
+
+    # Sorted only every n turns
+    order = particles.particle_id.copy()
+    np.random.shuffle(particles.x)
+    for at_turn, sorted_ in [(0, False), (1, False), (2, False), (3, True)]:
+        particles.at_turn[:] = at_turn
+        sorter.track(particles)
+        assert np.all(particles.particle_id == order) != sorted_
@@ -236,3 +236,61 @@ def test_spacecharge_pic():
                     p2np(particles.py[:n_probes])[mask_inside_grid],
                     p_dtk.py[mask_inside_grid],
                     atol=3e-2*np.max(np.abs(p_dtk.py[mask_inside_grid])))
+
+
+def test_spacecharge_coasting():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        n_macroparticles = int(5e5)
+        n_particles = 1e12
+        circumference = 100.
+        sigma_x = 3e-3
+        sigma_y = 2e-3
+        p0c = 25.92e9
+        n_probes = 100
+
+        # Coasting beam, followed by probes with zero weight
+        theta_probes = np.linspace(0, 2*np.pi, n_probes)
+        r_probes = np.linspace(0.5, 2.5, n_probes) * sigma_y
+        x_probes = r_probes * np.cos(theta_probes)
+        y_probes = r_probes * np.sin(theta_probes)
+        particles = xp.Particles(_context=context, p0c=p0c, mass0=pmass,
+                x=np.concatenate([x_probes,
+                    np.random.normal(0, sigma_x, n_macroparticles)]),
+                y=np.concatenate([y_probes,
+                    np.random.normal(0, sigma_y, n_macroparticles)]),
+                zeta=np.random.uniform(-circumference/2, circumference/2,
+                                       n_macroparticles + n_probes),
+                weight=np.concatenate([np.zeros(n_probes),
+                    np.ones(n_macroparticles)*n_particles/n_macroparticles]))
+
+        from xfields import SpaceCharge3D
+
+        x_lim = 6*sigma_x
+        y_lim = 6*sigma_y
+        spcharge = SpaceCharge3D(
+                _context=context,
+                length=1, update_on_track=True, apply_z_kick=False,
+                x_range=(-x_lim, x_lim),
+                y_range=(-y_lim, y_lim),
+                z_range=(-circumference/2, circumference/2),
+                nx=128, ny=128, nz=1,
+                solver='FFTSolver2D')
+        spcharge.track(particles)
+
+        scdtk = dtk.SCCoasting(
+                number_of_particles=n_particles,
+                circumference=circumference,
+                sigma_x=sigma_x,
+                sigma_y=sigma_y,
+                length=spcharge.length)
+        p_dtk = dtk.TestParticles(p0c=p0c, mass=pmass,
+                x=x_probes.copy(), y=y_probes.copy())
+        scdtk.track(p_dtk)
+
+        p2np = context.nparray_from_context_array
+        for pp, pp_dtk in [(particles.px, p_dtk.px),
+                           (particles.py, p_dtk.py)]:
+            assert np.allclose(p2np(pp[:n_probes]), pp_dtk,
+                               rtol=0, atol=3e-2*np.max(np.abs(pp_dtk)))
@@ -7,8 +7,12 @@ from .longitudinal_profiles import LongitudinalProfileCoasting
 from .longitudinal_profiles import LongitudinalProfileQGaussian
 
 from .fieldmaps import TriLinearInterpolatedFieldMap
+from .fieldmaps import ConfigForAdaptiveGrid
 from .fieldmaps import TriCubicInterpolatedFieldMap
 from .fieldmaps import BiGaussianFieldMap, mean_and_std
+from .fieldmaps import ParticleSorter
+from .fieldmaps import save_fieldmaps, load_fieldmaps
+from .fieldmaps import read_fieldmaps_header
 
 from .solvers.fftsolvers import FFTSolver3D
 
@@ -26,6 +30,7 @@ from .config_tools import replace_spacecharge_with_PIC
 from .config_tools import configure_orbit_dependent_parameters_for_bb
 from .config_tools import install_spacecharge_frozen
 from .config_tools import full_electroncloud_setup
+from .config_tools import convert_electroncloud_fieldmaps_from_h5
 
 
 import xtrack as _xt
@@ -41,7 +41,11 @@ class SpaceCharge3D(xt.BeamElement):
             the computing grid.
         nx (int): Number of cells in the horizontal direction.
         ny (int): Number of cells in the vertical direction.
-        nz (int): Number of cells in the vertical direction.
+        nz (int): Number of cells in the longitudinal direction. For a
+            coasting beam ``nz`` can be set to ``1``, together with
+            ``z_range`` spanning the length over which the particles are
+            distributed, and the solver to ``FFTSolver2D`` (see
+            :class:`TriLinearInterpolatedFieldMap`).
         dx (float): Horizontal cell size in meters. It can be
             provided alternatively to ``nx``.
         dy (float): Vertical cell size in meters. It can be
@@ -63,12 +67,43 @@ class SpaceCharge3D(xt.BeamElement):
             Volts. If not provided the ``phi`` is calculated from ``rho``
             using the Poisson solver (if available).
         solver (str or solver object): Defines the Poisson solver to be used
-            to compute phi from rho. Accepted values are ``FFTSolver3D`` and
-            ``FFTSolver2p5D``. A Xfields solver object can also be provided.
+            to compute phi from rho. Accepted values are ``FFTSolver3D``,
+            ``FFTSolver2p5D``, ``FFTSolver2p5DSliced``, ``MultigridSolver3D``
+            and ``MultigridSolver2p5D``, and ``FFTSolver2D`` if ``nz`` is
+            ``1``. A Xfields solver object can also be provided (e.g. a
+            multigrid solver with a chamber mask).
             In case ``update_on_track``is ``False`` and ``phi`` is provided
             by the user, this argument can be omitted.
         gamma0 (float): Relativistic gamma factor of the beam. This is required
-            only if the solver is ``FFTSolver3D``.
+            only if the solver is ``FFTSolver3D`` or ``MultigridSolver3D``.
+        adaptive_grid (bool or ConfigForAdaptiveGrid): If provided, the grid
+            extent follows the particle distribution at each update of the
+            field map (see :class:`ConfigForAdaptiveGrid`). ``True`` selects
+            the default settings. The default is ``None``.
+        particle_sorter (ParticleSorter): If provided, it is used to sort the
+            particles by grid cell before each kick (at most once per turn,
+            see :class:`ParticleSorter`). The same sorter can be shared by
+            several elements. The default is ``None``.
+        packed_gradient (bool): If ``True`` the transverse derivatives of the
+            potential are stored interleaved in the field map, which speeds
+            up the kick (see :class:`TriLinearInterpolatedFieldMap`). The
+            default is ``False``.
+        gradient_dtype (str or np.dtype): Type used to store the derivatives
+            of the potential in the field map, ``float64`` or ``float32``
+            (see :class:`TriLinearInterpolatedFieldMap`). The default is
+            ``float64``.
+        factorized (bool): If ``True`` the charge density is approximated as
+            the product of a transverse density and of a line density, hence
+            a single transverse Poisson problem is solved at each update (see
+            :class:`TriLinearInterpolatedFieldMap`). It requires a 2.5D
+            solver. The default is ``False``.
+        fft_padding (str): Size of the padded arrays transformed by the FFT
+            solver (``minimal``, ``smooth`` or ``autotune``, see
+            :class:`TriLinearInterpolatedFieldMap`). The default is
+            ``minimal``.
+        fft_backend (FFTBackendCpu): FFT backend used by the FFT solver
+            (e.g. a multithreaded FFT library). The default is ``None``, i.e.
+            the plans of the context are used.
     Returns:
         (SpaceCharge3D): A space-charge 3D beam element.
     """
@@ -91,7 +126,8 @@ class SpaceCharge3D(xt.BeamElement):
                 update_on_track=self.update_on_track,
                 length=self.length,
                 apply_z_kick=self.apply_z_kick,
-                fieldmap=self.fieldmap)
+                fieldmap=self.fieldmap,
+                particle_sorter=self.particle_sorter)
 
     def __init__(self,
                  _context=None,
@@ -108,13 +144,21 @@ class SpaceCharge3D(xt.BeamElement):
                  rho=None, phi=None,
                  solver=None,
                  gamma0=None,
-                 fftplan=None):
+                 fftplan=None,
+                 adaptive_grid=None,
+                 particle_sorter=None,
+                 packed_gradient=False,
+                 gradient_dtype='float64',
+                 factorized=False,
+                 fft_padding='minimal',
+                 fft_backend=None):
 
         self.update_on_track = update_on_track
         self.apply_z_kick = apply_z_kick
+        self.particle_sorter = particle_sorter
 
-        if solver=='FFTSolver3D':
-            assert gamma0 is not None, ('To use FFTSolver3D '
+        if solver in ('FFTSolver3D', 'MultigridSolver3D'):
+            assert gamma0 is not None, (f'To use {solver} '
                                         'gamma0 must be provided')
 
         if gamma0 is not None:
@@ -142,7 +186,13 @@ class SpaceCharge3D(xt.BeamElement):
                         solver=solver,
                         scale_coordinates_in_solver=scale_coordinates_in_solver,
                         updatable=update_on_track,
-                        fftplan=fftplan)
+                        fftplan=fftplan,
+                        adaptive_grid=adaptive_grid,
+                        packed_gradient=packed_gradient,
+                        gradient_dtype=gradient_dtype,
+                        factorized=factorized,
+                        fft_padding=fft_padding,
+                        fft_backend=fft_backend)
 
         self.xoinitialize(
                  _context=_context,
@@ -155,7 +205,7 @@ class SpaceCharge3D(xt.BeamElement):
 
     @property
     def iscollective(self):
-        return self.update_on_track
+        return self.update_on_track or self.particle_sorter is not None
 
 
     def track(self, particles):
@@ -168,6 +218,9 @@ class SpaceCharge3D(xt.BeamElement):
             particles (Particles Object): Particles to be tracked.
         """
 
+        if self.particle_sorter is not None:
+            self.particle_sorter.track(particles)
+
         if self.update_on_track:
             self.fieldmap.update_from_particles(
                 particles=particles)
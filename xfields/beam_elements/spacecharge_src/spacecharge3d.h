@@ -15,7 +15,15 @@ void SpaceCharge3D_track_local_particle(
     const double length = SpaceCharge3DData_get_length(el);
     /*gpuglmem*/ double* dphi_dx_map = SpaceCharge3DData_getp1_fieldmap_dphi_dx(el, 0);
     /*gpuglmem*/ double* dphi_dy_map = SpaceCharge3DData_getp1_fieldmap_dphi_dy(el, 0);
+    /*gpuglmem*/ double* dphi_packed_map = SpaceCharge3DData_getp1_fieldmap_dphi_packed(el, 0);
+    /*gpuglmem*/ float* dphi_dx_map_f32 = SpaceCharge3DData_getp1_fieldmap_dphi_dx_f32(el, 0);
+    /*gpuglmem*/ float* dphi_dy_map_f32 = SpaceCharge3DData_getp1_fieldmap_dphi_dy_f32(el, 0);
+    /*gpuglmem*/ float* dphi_packed_map_f32 = SpaceCharge3DData_getp1_fieldmap_dphi_packed_f32(el, 0);
     TriLinearInterpolatedFieldMapData fmap = SpaceCharge3DData_getp_fieldmap(el);
+    const int64_t packed_gradient =
+                  TriLinearInterpolatedFieldMapData_get_packed_gradient(fmap);
+    const int64_t single_precision =
+                  TriLinearInterpolatedFieldMapData_get_single_precision(fmap);
 
     //start_per_particle_block (part0->part)
 	double const x = LocalParticle_get_x(part);
@@ -31,10 +39,29 @@ void SpaceCharge3D_track_local_particle(
 	const IndicesAndWeights iw = 
 	    TriLinearInterpolatedFieldMap_compute_indeces_and_weights(fmap, x, y, z);
 
-   	const double dphi_dx = 
-	    TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(dphi_dx_map, iw);
-   	const double dphi_dy = 
-	    TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(dphi_dy_map, iw);
+	double dphi_dx, dphi_dy;
+	if (single_precision){
+	    if (packed_gradient){
+	        TriLinearInterpolatedFieldMap_interpolate_3d_map_packed_gradient_f32(
+	                dphi_packed_map_f32, iw, &dphi_dx, &dphi_dy);
+	    }
+	    else{
+	        dphi_dx = TriLinearInterpolatedFieldMap_interpolate_3d_map_strided_f32(
+	                                                  dphi_dx_map_f32, 1, iw);
+	        dphi_dy = TriLinearInterpolatedFieldMap_interpolate_3d_map_strided_f32(
+	                                                  dphi_dy_map_f32, 1, iw);
+	    }
+	}
+	else if (packed_gradient){
+	    TriLinearInterpolatedFieldMap_interpolate_3d_map_packed_gradient(
+	            dphi_packed_map, iw, &dphi_dx, &dphi_dy);
+	}
+	else{
+	    dphi_dx = TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(
+	                                                      dphi_dx_map, iw);
+	    dphi_dy = TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(
+	                                                      dphi_dy_map, iw);
+	}
 
         const double charge_mass_ratio = 
 		             chi*QELEM*q0/(mass0*QELEM/(C_LIGHT*C_LIGHT));
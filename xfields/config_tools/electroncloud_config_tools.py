@@ -3,15 +3,20 @@
 # Copyright (c) CERN, 2021.                   #
 # ########################################### #
 
+import os
+
 import numpy as np
 
+import xobjects as xo
 import xfields as xf
 import xpart as xp
 import xtrack as xt
 
 
 def get_electroncloud_fieldmap_from_h5(
-        filename, tau_max=None, buffer=None, ecloud_name="e-cloud"):
+        filename, tau_max=None, buffer=None, ecloud_name="e-cloud",
+        precompute_coefficients=False, phi_taylor_layout='linear',
+        phi_taylor_dtype='float64'):
     assert buffer is not None
     import h5py
     ff = h5py.File(filename, "r")
@@ -48,17 +53,24 @@ def get_electroncloud_fieldmap_from_h5(
     z_grid = ff["grid/zg"][iz1:iz2]
 
     mirror2D = ff["settings/symmetric2D"][()]
-    # (in GB), 8 bytes per double-precision number
-    memory_estimate = (ix2 - ix1) * (iy2 - iy1) * (iz2 - iz1) * 8 * 8 * 1.e-9
+    # (in GB), 8 bytes per double-precision number, 4 in single precision
+    memory_estimate = ((ix2 - ix1) * (iy2 - iy1) * (iz2 - iz1) * 8
+                       * np.dtype(phi_taylor_dtype).itemsize * 1.e-9)
+    if precompute_coefficients:
+        # 64 coefficients per cell, in double precision
+        memory_estimate += (ix2 - ix1) * (iy2 - iy1) * (iz2 - iz1) * 64 * 8 * 1.e-9
     print(f"Creating fieldmap... (Memory estimate = {memory_estimate:.2f} GB)")
     fieldmap = xf.TriCubicInterpolatedFieldMap(x_grid=x_grid, y_grid=y_grid, z_grid=z_grid,
-                                               mirror_x=mirror2D, mirror_y=mirror2D, mirror_z=0, _buffer=buffer)
+                                               mirror_x=mirror2D, mirror_y=mirror2D, mirror_z=0, _buffer=buffer,
+                                               precompute_coefficients=precompute_coefficients,
+                                               phi_taylor_layout=phi_taylor_layout,
+                                               phi_taylor_dtype=phi_taylor_dtype)
     print(f"Reading {ecloud_name}: ")
     kk = 0.
-    scale = [1., fieldmap.dx, fieldmap.dy, fieldmap.dz,
-             fieldmap.dx * fieldmap.dy, fieldmap.dx *
-             fieldmap.dz, fieldmap.dy * fieldmap.dz,
-             fieldmap.dx * fieldmap.dy * fieldmap.dz]
+    scale = np.array([1., fieldmap.dx, fieldmap.dy, fieldmap.dz,
+                      fieldmap.dx * fieldmap.dy, fieldmap.dx *
+                      fieldmap.dz, fieldmap.dy * fieldmap.dz,
+                      fieldmap.dx * fieldmap.dy * fieldmap.dz])
 
     ####### Optimized version of the loop in the block below. ################
     for iz in range(iz1, iz2):
@@ -66,15 +78,11 @@ def get_electroncloud_fieldmap_from_h5(
             while (iz - iz1) / (iz2 - iz1) > kk:
                 kk += 0.2
             print(f"{int(np.round(100*kk)):d}%..")
-        phi_slice = ff[f"slices/slice{iz}/phi"][ix1:ix2,
-                                                iy1:iy2, :].transpose(1, 0, 2)
-        for ll in range(8):
-            phi_slice[:, :, ll] *= scale[ll]
-        index_offset = 8 * nx * ny * (iz - iz1)
-        len_slice = phi_slice.shape[0] * \
-            phi_slice.shape[1] * phi_slice.shape[2]
-        fieldmap._phi_taylor[index_offset:index_offset +
-                             len_slice] = phi_slice.flatten()
+        phi_slice = ff[f"slices/slice{iz}/phi"][ix1:ix2, iy1:iy2, :]
+        phi_slice *= scale
+        fieldmap.update_phi_taylor(phi_slice[:, :, None, :],
+                                   iz_start=iz - iz1,
+                                   refresh_coefficients=False)
     ##########################################################################
     # for iz in range(iz1, iz2):
     #     if (iz-iz1)/nz > kk:
@@ -88,6 +96,7 @@ def get_electroncloud_fieldmap_from_h5(
     #                 index = ll + 8 * ix + 8 * nx * iy + 8 * nx * ny * (iz - iz1)
     #                 fieldmap._phi_taylor[index] = phi_slice[ix, iy, ll] * scale[ll]
     ##########################################################################
+    fieldmap.update_coefficients()
 
     return fieldmap
 
@@ -163,17 +172,51 @@ def electroncloud_dipolar_kicks_of_fieldmap(fieldmap=None, p0c=None):
 
 
 def full_electroncloud_setup(line=None, ecloud_info=None, filenames=None, context=None,
-                             tau_max=None, subtract_dipolar_kicks=True, shift_to_closed_orbit=True):
+                             tau_max=None, subtract_dipolar_kicks=True, shift_to_closed_orbit=True,
+                             precompute_coefficients=None, phi_taylor_layout=None,
+                             phi_taylor_dtype=None, fieldmaps_filename=None):
 
-    buffer = context.new_buffer()
-    fieldmaps = {
-        ecloud_type: get_electroncloud_fieldmap_from_h5(
-            filename=filename,
-            buffer=buffer,
-            tau_max=tau_max,
-            ecloud_name=ecloud_type) for (
-            ecloud_type,
-            filename) in filenames.items()}
+    if context is None:
+        context = xo.context_default
+
+    if fieldmaps_filename is not None:
+        # Field maps saved with save_fieldmaps (by electron cloud type),
+        # memory-mapped on CPU contexts. The elements and the tracker are
+        # allocated in the same buffer.
+        if filenames is not None or tau_max is not None:
+            raise ValueError('filenames and tau_max cannot be used together '
+                             'with fieldmaps_filename (the maps are taken '
+                             'from the converted file)')
+        # The storage options, if given, need to match the converted file
+        header = xf.read_fieldmaps_header(fieldmaps_filename)
+        requested = {'precompute_coefficients': precompute_coefficients,
+                     'phi_taylor_layout': phi_taylor_layout,
+                     'phi_taylor_dtype': (None if phi_taylor_dtype is None
+                                          else np.dtype(phi_taylor_dtype).name)}
+        for ecloud_type, entry in header['fieldmaps'].items():
+            for kk, vv in requested.items():
+                if vv is not None and entry[kk] != vv:
+                    raise ValueError(
+                        f'{kk}={vv} was requested, but the field map '
+                        f'{ecloud_type} in {fieldmaps_filename} has '
+                        f'{kk}={entry[kk]}')
+
+        fieldmaps = xf.load_fieldmaps(fieldmaps_filename, context=context,
+                                      use_mmap=isinstance(context, xo.ContextCpu))
+        buffer = next(iter(fieldmaps.values()))._buffer
+    else:
+        buffer = context.new_buffer()
+        fieldmaps = {
+            ecloud_type: get_electroncloud_fieldmap_from_h5(
+                filename=filename,
+                buffer=buffer,
+                tau_max=tau_max,
+                ecloud_name=ecloud_type,
+                precompute_coefficients=bool(precompute_coefficients),
+                phi_taylor_layout=phi_taylor_layout or 'linear',
+                phi_taylor_dtype=phi_taylor_dtype or 'float64') for (
+                ecloud_type,
+                filename) in filenames.items()}
 
     for ecloud_type, fieldmap in fieldmaps.items():
         print(f"Inserting \"{ecloud_type}\" electron clouds...")
@@ -195,3 +238,34 @@ def full_electroncloud_setup(line=None, ecloud_info=None, filenames=None, contex
     twiss_with_ecloud = tracker.twiss()
 
     return tracker, twiss_without_ecloud, twiss_with_ecloud
+
+
+def convert_electroncloud_fieldmaps_from_h5(
+        filenames, output_filename, tau_max=None,
+        precompute_coefficients=False, phi_taylor_layout='linear',
+        phi_taylor_dtype='float64', reserve_nbytes=64*2**20):
+    # Converts the h5 files (by electron cloud type) into a single file in
+    # the native format of xfields.save_fieldmaps: phi_taylor is stored
+    # scaled, in the layout and type used by the kernels, hence the maps
+    # are loaded by a single read or memory-mapped (see
+    # full_electroncloud_setup(fieldmaps_filename=...)).
+    buffer = xo.context_default.new_buffer()
+    fieldmaps = {
+        ecloud_type: get_electroncloud_fieldmap_from_h5(
+            filename=filename,
+            buffer=buffer,
+            tau_max=tau_max,
+            ecloud_name=ecloud_type,
+            precompute_coefficients=precompute_coefficients,
+            phi_taylor_layout=phi_taylor_layout,
+            phi_taylor_dtype=phi_taylor_dtype) for (
+            ecloud_type,
+            filename) in filenames.items()}
+
+    print(f"Writing {output_filename}...")
+    xf.save_fieldmaps(output_filename, fieldmaps,
+                      reserve_nbytes=reserve_nbytes,
+                      metadata={'source_files': {
+                                    kk: os.path.abspath(vv)
+                                    for kk, vv in filenames.items()},
+                                'tau_max': tau_max})
@@ -4,5 +4,9 @@
 # ########################################### #
 
 from .interpolated import TriLinearInterpolatedFieldMap
+from .interpolated import ConfigForAdaptiveGrid
 from .tricubicinterpolated import TriCubicInterpolatedFieldMap
+from .particle_sorting import ParticleSorter
 from .bigaussian import BiGaussianFieldMap, mean_and_std
+from .fieldmap_files import save_fieldmaps, load_fieldmaps, MappedBufferCpu
+from .fieldmap_files import read_fieldmaps_header
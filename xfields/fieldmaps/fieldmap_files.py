@@ -0,0 +1,273 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import json
+import mmap
+import os
+import zlib
+
+import numpy as np
+
+import xobjects as xo
+from xobjects.context import Chunk
+from xobjects.context_cpu import BufferNumpy
+
+from .tricubicinterpolated import TriCubicInterpolatedFieldMap
+
+_MAGIC = b'XFMAPS01'
+_VERSION = 1
+_PAGE_SIZE = 4096
+
+_fieldmap_classes = {
+    'TriCubicInterpolatedFieldMap': TriCubicInterpolatedFieldMap,
+    }
+
+
+class MappedBufferCpu(BufferNumpy):
+
+    '''
+    Buffer of a CPU context whose memory is a copy-on-write mapping of a
+    file. The pages of the file are read by the operating system when they
+    are first accessed, hence the resident memory only includes the parts
+    of the file that are actually used. Modifications of the buffer are not
+    written to the file.
+
+    The first ``used_nbytes`` bytes of the file are considered occupied, the
+    rest of the file (usually a sparse tail of zeros) is available to
+    allocate new objects. If more space is needed, the whole content of the
+    buffer is copied to memory.
+
+    Each page that is written (e.g. by updating a map, or by the objects
+    allocated in the free space) becomes a private copy in memory, which is
+    not bounded by the buffer and cannot be released by the operating
+    system while the buffer exists. Writing the whole content, hence, takes
+    as much memory as a buffer that is not mapped.
+
+    Args:
+        filename (str): Mapped file.
+        used_nbytes (int): Size of the occupied part at the beginning of
+            the file.
+        context (ContextCpu): Context of the buffer. If ``None`` a new CPU
+            context is created.
+    Returns:
+        (MappedBufferCpu): Buffer object.
+    '''
+
+    def __init__(self, filename, used_nbytes, context=None):
+
+        self.filename = filename
+        self._mmap = None
+
+        capacity = os.path.getsize(filename)
+        assert used_nbytes <= capacity
+        super().__init__(capacity=capacity, context=context)
+
+        if used_nbytes < capacity:
+            self.chunks = [Chunk(used_nbytes, capacity)]
+        else:
+            self.chunks = []
+
+    def _new_buffer(self, capacity):
+        if self._mmap is None:
+            with open(self.filename, 'rb') as fid:
+                self._mmap = mmap.mmap(fid.fileno(), 0,
+                                       access=mmap.ACCESS_COPY)
+            return np.frombuffer(self._mmap, dtype=np.int8)
+        # The buffer is grown, the content is copied to memory
+        return np.zeros(capacity, dtype=np.int8)
+
+    @property
+    def is_mapped(self):
+        '''
+        ``True`` if the buffer is still a mapping of the file (i.e. it has
+        not been grown).
+        '''
+        return (self._mmap is not None
+                and self.buffer.base is not None
+                and self.capacity == len(self._mmap))
+
+
+def save_fieldmaps(filename, fieldmaps, reserve_nbytes=64*2**20,
+                   metadata=None):
+
+    '''
+    Saves a set of field maps in a single file, which can be loaded
+    (optionally memory-mapped) with :func:`load_fieldmaps`. The file
+    contains the memory image of each map, as used by the tracking kernels
+    (for ``TriCubicInterpolatedFieldMap`` objects, ``phi_taylor`` is stored
+    already scaled and in the selected layout and type), preceded by a
+    header with the grid of each map and a CRC-32 checksum of its image
+    (see :func:`read_fieldmaps_header`). Only
+    ``TriCubicInterpolatedFieldMap`` objects are supported.
+
+    Args:
+        filename (str): Name of the file.
+        fieldmaps (dict): Field maps to be saved, by name.
+        reserve_nbytes (int): Size of the free space left at the end of the
+            file, in which the beam elements using the maps (and the tracker
+            of the line) are allocated after loading. It is written as a
+            sparse region, hence it does not use disk space on most file
+            systems. The default is 64 MB.
+        metadata (dict): Additional information stored in the header (it
+            needs to be serializable to JSON).
+    '''
+
+    entries = {}
+    images = []
+    for name, fieldmap in fieldmaps.items():
+        cls_name = fieldmap.__class__.__name__
+        if cls_name not in _fieldmap_classes:
+            raise NotImplementedError(
+                    f'Saving {cls_name} objects is not supported')
+        xobject = fieldmap._xobject
+        context = xobject._buffer.context
+        image = context.nparray_from_context_array(
+                xobject._buffer.to_nplike(xobject._offset, 'int8',
+                                          (xobject._size,)))
+        entries[name] = {'class': cls_name, 'offset': 0,
+                         'nbytes': int(xobject._size),
+                         'crc32': zlib.crc32(image),
+                         **_get_fieldmap_info(fieldmap)}
+        images.append((name, image))
+
+    header = {'version': _VERSION, 'used_nbytes': 0, 'fieldmaps': entries,
+              'metadata': metadata if metadata is not None else {}}
+
+    # The header is followed by the images, starting at page boundaries so
+    # that the data of the maps are aligned in the mapped buffer (the
+    # offsets are not known yet, room is left for them)
+    header_nbytes = _align(len(_MAGIC) + 8 + len(json.dumps(header))
+                           + 24*(len(entries) + 1), _PAGE_SIZE)
+    offset = header_nbytes
+    for name, image in images:
+        entries[name]['offset'] = offset
+        offset = _align(offset + len(image), _PAGE_SIZE)
+    header['used_nbytes'] = offset
+
+    header_bytes = json.dumps(header).encode()
+    assert len(_MAGIC) + 8 + len(header_bytes) <= header_nbytes
+
+    with open(filename, 'wb') as fid:
+        fid.write(_MAGIC)
+        fid.write(np.int64(len(header_bytes)).tobytes())
+        fid.write(header_bytes)
+        for name, image in images:
+            fid.seek(entries[name]['offset'])
+            image.tofile(fid)
+        fid.truncate(header['used_nbytes'] + reserve_nbytes)
+
+
+def read_fieldmaps_header(filename):
+
+    '''
+    Reads the header of a file written by :func:`save_fieldmaps`, without
+    loading the field maps.
+
+    Args:
+        filename (str): Name of the file.
+    Returns:
+        (dict): Header of the file. The entry ``fieldmaps`` contains, for
+        each map, its class, the position (``offset``, ``nbytes``) and the
+        checksum (``crc32``) of its image in the file, its grid (``grid``)
+        and the storage options of ``phi_taylor``. The entry ``metadata``
+        contains the information provided when saving the file.
+    '''
+
+    with open(filename, 'rb') as fid:
+        magic = fid.read(len(_MAGIC))
+        if magic != _MAGIC:
+            raise ValueError(f'{filename} is not a field map file')
+        header_len = int(np.frombuffer(fid.read(8), dtype=np.int64)[0])
+        header = json.loads(fid.read(header_len).decode())
+
+    if header['version'] > _VERSION:
+        raise ValueError(f'{filename} has version {header["version"]}, '
+                         f'only versions up to {_VERSION} are supported')
+    return header
+
+
+def load_fieldmaps(filename, context=None, use_mmap=True,
+                   verify_checksums=True):
+
+    '''
+    Loads a set of field maps saved with :func:`save_fieldmaps`. All maps
+    are placed in the same buffer, which also provides free space for the
+    beam elements using them.
+
+    Args:
+        filename (str): Name of the file.
+        context (XfContext): Context on which the maps are loaded. If
+            ``None`` the default context is used.
+        use_mmap (bool): If ``True`` the file is memory-mapped into the
+            buffer (see :class:`MappedBufferCpu`): the loading is
+            immediate and the data are read from disk only when used by
+            the tracking. Only available on CPU contexts. If ``False`` the
+            file is read into a new buffer. The default is ``True``.
+        verify_checksums (bool): If ``True`` the checksums of the maps are
+            verified, which requires reading the whole file, also when it is
+            memory-mapped (the pages are then in memory, until they are
+            reclaimed by the operating system). If ``False`` corrupted files
+            are not detected, but a memory-mapped file is only read when
+            used. The default is ``True``.
+    Returns:
+        (dict): Field maps, by name.
+    '''
+
+    header = read_fieldmaps_header(filename)
+    used_nbytes = header['used_nbytes']
+
+    if context is None:
+        context = xo.context_default
+
+    if use_mmap:
+        if not isinstance(context, xo.ContextCpu):
+            raise NotImplementedError(
+                    'Memory-mapped field maps are only available on CPU '
+                    'contexts')
+        buffer = MappedBufferCpu(filename, used_nbytes, context=context)
+        content = buffer.buffer
+    else:
+        buffer = context.new_buffer(capacity=os.path.getsize(filename))
+        assert buffer.allocate(used_nbytes, align=False) == 0
+        with open(filename, 'rb') as fid:
+            if isinstance(context, xo.ContextCpu):
+                fid.readinto(memoryview(buffer.buffer)[:used_nbytes])
+                content = buffer.buffer
+            else:
+                content = np.fromfile(fid, dtype=np.int8, count=used_nbytes)
+                buffer.update_from_buffer(0, content)
+
+    fieldmaps = {}
+    for name, entry in header['fieldmaps'].items():
+        if verify_checksums:
+            offset = entry['offset']
+            crc = zlib.crc32(content[offset:offset + entry['nbytes']])
+            if crc != entry['crc32']:
+                raise ValueError(f'Checksum mismatch for field map {name} '
+                                 f'in {filename}')
+        cls = _fieldmap_classes[entry['class']]
+        fieldmap = cls._from_buffer_image(buffer, entry['offset'])
+        info = _get_fieldmap_info(fieldmap)
+        if any(entry[kk] != vv for kk, vv in info.items()):
+            raise ValueError(f'Field map {name} in {filename} is not '
+                             f'consistent with the header')
+        fieldmaps[name] = fieldmap
+    return fieldmaps
+
+
+def _get_fieldmap_info(fieldmap):
+    grid = {}
+    for nn in ['x_min', 'y_min', 'z_min', 'dx', 'dy', 'dz']:
+        grid[nn] = float(getattr(fieldmap, '_' + nn))
+    for nn in ['nx', 'ny', 'nz', 'mirror_x', 'mirror_y', 'mirror_z']:
+        grid[nn] = int(getattr(fieldmap, '_' + nn))
+    return {'grid': grid,
+            'phi_taylor_layout': fieldmap.phi_taylor_layout,
+            'phi_taylor_dtype': fieldmap.phi_taylor_dtype.name,
+            'precompute_coefficients': fieldmap.precompute_coefficients}
+
+
+def _align(nbytes, alignment):
+    return (nbytes + alignment - 1) // alignment * alignment
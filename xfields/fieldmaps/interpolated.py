@@ -9,22 +9,32 @@ import xobjects as xo
 import xpart as xp
 import xtrack as xt
 
-from ..solvers.fftsolvers import FFTSolver3D, FFTSolver2p5D
+from ..solvers.fftsolvers import FFTSolver2D, FFTSolver3D, FFTSolver2p5D
+from ..solvers.fftsolvers import FFTSolver2p5DSliced
+from ..solvers.multigrid import MultigridSolver3D, MultigridSolver2p5D
 from ..general import _pkg_root
+from .bigaussian import mean_and_std
 
 _TriLinearInterpolatedFielmap_kernels = {
-    'central_diff': xo.Kernel(
+    'central_diff_3d': xo.Kernel(
         args=[
-            xo.Arg(xo.Int32,   pointer=False, name='nelem'),
-            xo.Arg(xo.Int32,   pointer=False, name='row_size'),
-            xo.Arg(xo.Int32,   pointer=False, name='stride_in_dbl'),
-            xo.Arg(xo.Float64, pointer=False, name='factor'),
+            xo.Arg(xo.Int32,   pointer=False, name='nrows'),
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Float64, pointer=False, name='fx'),
+            xo.Arg(xo.Float64, pointer=False, name='fy'),
+            xo.Arg(xo.Float64, pointer=False, name='fz'),
+            xo.Arg(xo.Int32,   pointer=False, name='in_stride'),
+            xo.Arg(xo.Int32,   pointer=False, name='out_stride'),
             xo.Arg(xo.Int8,    pointer=True,  name='matrix_buffer'),
             xo.Arg(xo.Int64,   pointer=False, name='matrix_offset'),
             xo.Arg(xo.Int8,    pointer=True,  name='res_buffer'),
-            xo.Arg(xo.Int64,   pointer=False, name='res_offset'),
+            xo.Arg(xo.Int64,   pointer=False, name='res_x_offset'),
+            xo.Arg(xo.Int64,   pointer=False, name='res_y_offset'),
+            xo.Arg(xo.Int64,   pointer=False, name='res_z_offset'),
             ],
-        n_threads='nelem'
+        n_threads='nrows'
         ),
     'p2m_rectmesh3d_xparticles': xo.Kernel(
         args=[
@@ -66,6 +76,88 @@ _TriLinearInterpolatedFielmap_kernels = {
             ],
         n_threads='nparticles'
         ),
+    'p2m_rectmesh3d_private_xparticles': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nparticles'),
+            xo.Arg(xp.Particles, pointer=False, name='particles'),
+            xo.Arg(xo.Float64, pointer=False, name='x0'),
+            xo.Arg(xo.Float64, pointer=False, name='y0'),
+            xo.Arg(xo.Float64, pointer=False, name='z0'),
+            xo.Arg(xo.Float64, pointer=False, name='dx'),
+            xo.Arg(xo.Float64, pointer=False, name='dy'),
+            xo.Arg(xo.Float64, pointer=False, name='dz'),
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Int32,   pointer=False, name='n_private_grids'),
+            xo.Arg(xo.Float64, pointer=True,  name='private_grids'),
+            xo.Arg(xo.Int8,    pointer=True,  name='grid1d_buffer'),
+            xo.Arg(xo.Int64,   pointer=False, name='grid1d_offset'),
+            ],
+        ),
+    'p2m_rectmesh3d_private': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nparticles'),
+            xo.Arg(xo.Float64, pointer=True, name='x'),
+            xo.Arg(xo.Float64, pointer=True, name='y'),
+            xo.Arg(xo.Float64, pointer=True, name='z'),
+            xo.Arg(xo.Float64, pointer=True, name='part_weights'),
+            xo.Arg(xo.Int64,   pointer=True, name='part_state'),
+            xo.Arg(xo.Float64, pointer=False, name='x0'),
+            xo.Arg(xo.Float64, pointer=False, name='y0'),
+            xo.Arg(xo.Float64, pointer=False, name='z0'),
+            xo.Arg(xo.Float64, pointer=False, name='dx'),
+            xo.Arg(xo.Float64, pointer=False, name='dy'),
+            xo.Arg(xo.Float64, pointer=False, name='dz'),
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Int32,   pointer=False, name='n_private_grids'),
+            xo.Arg(xo.Float64, pointer=True,  name='private_grids'),
+            xo.Arg(xo.Int8,    pointer=True,  name='grid1d_buffer'),
+            xo.Arg(xo.Int64,   pointer=False, name='grid1d_offset'),
+            ],
+        ),
+    'p2m_rectmesh2d_line_density_xparticles': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nparticles'),
+            xo.Arg(xp.Particles, pointer=False, name='particles'),
+            xo.Arg(xo.Float64, pointer=False, name='x0'),
+            xo.Arg(xo.Float64, pointer=False, name='y0'),
+            xo.Arg(xo.Float64, pointer=False, name='z0'),
+            xo.Arg(xo.Float64, pointer=False, name='dx'),
+            xo.Arg(xo.Float64, pointer=False, name='dy'),
+            xo.Arg(xo.Float64, pointer=False, name='dz'),
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Float64, pointer=True,  name='grid2d'),
+            xo.Arg(xo.Float64, pointer=True,  name='line_density'),
+            ],
+        n_threads='nparticles'
+        ),
+    'p2m_rectmesh2d_line_density': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nparticles'),
+            xo.Arg(xo.Float64, pointer=True, name='x'),
+            xo.Arg(xo.Float64, pointer=True, name='y'),
+            xo.Arg(xo.Float64, pointer=True, name='z'),
+            xo.Arg(xo.Float64, pointer=True, name='part_weights'),
+            xo.Arg(xo.Int64,   pointer=True, name='part_state'),
+            xo.Arg(xo.Float64, pointer=False, name='x0'),
+            xo.Arg(xo.Float64, pointer=False, name='y0'),
+            xo.Arg(xo.Float64, pointer=False, name='z0'),
+            xo.Arg(xo.Float64, pointer=False, name='dx'),
+            xo.Arg(xo.Float64, pointer=False, name='dy'),
+            xo.Arg(xo.Float64, pointer=False, name='dz'),
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Float64, pointer=True,  name='grid2d'),
+            xo.Arg(xo.Float64, pointer=True,  name='line_density'),
+            ],
+        n_threads='nparticles'
+        ),
     'TriLinearInterpolatedFieldMap_interpolate_3d_map_vector': xo.Kernel(
         args=[
             xo.Arg(xo.ThisClass, pointer=False, name='fmap'),
@@ -76,6 +168,8 @@ _TriLinearInterpolatedFielmap_kernels = {
             xo.Arg(xo.Int64,   pointer=False, name='n_quantities'),
             xo.Arg(xo.Int8,    pointer=True,  name='buffer_mesh_quantities'),
             xo.Arg(xo.Int64,   pointer=True,  name='offsets_mesh_quantities'),
+            xo.Arg(xo.Int64,   pointer=True,  name='strides_mesh_quantities'),
+            xo.Arg(xo.Int64,   pointer=True,  name='single_precision_mesh_quantities'),
             xo.Arg(xo.Float64, pointer=True,  name='particles_quantities'),
             ],
         n_threads='n_points'
@@ -100,7 +194,12 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
             the computing grid.
         nx (int): Number of cells in the horizontal direction.
         ny (int): Number of cells in the vertical direction.
-        nz (int): Number of cells in the vertical direction.
+        nz (int): Number of cells in the longitudinal direction. If ``nz`` is
+            ``1`` a 2D map is built (e.g. for a coasting beam): all the
+            particles are deposited on a single transverse slice, irrespective
+            of their longitudinal position, and the charge is spread uniformly
+            over the length of ``z_range``, which is returned by ``dz``. The
+            longitudinal derivative of the potential is zero.
         dx (float): Horizontal cell size in meters. It can be
             provided alternatively to ``nx``.
         dy (float): Vertical cell size in meters. It can be
@@ -122,8 +221,11 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
             Volts. If not provided the ``phi`` is calculated from ``rho``
             using the Poisson solver (if available).
         solver (str or solver object): Defines the Poisson solver to be used
-            to compute phi from rho. Accepted values are ``FFTSolver3D`` and
-            ``FFTSolver2p5D``. A Xfields solver object can also be provided.
+            to compute phi from rho. Accepted values are ``FFTSolver3D``,
+            ``FFTSolver2p5D``, ``FFTSolver2p5DSliced``, ``MultigridSolver3D``
+            and ``MultigridSolver2p5D``, and ``FFTSolver2D`` for 2D maps. A
+            Xfields solver object can also be provided (e.g. a multigrid
+            solver with a chamber mask).
             In case ``update_on_track``is ``False`` and ``phi`` is provided
             by the user, this argument can be omitted.
         scale_coordinates_in_solver (tuple): Three coefficients used to rescale
@@ -131,6 +233,43 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
             (1.,1.,1.).
         updatable (bool): If ``True`` the field map can be updated after
             creation. Default is ``True``.
+        adaptive_grid (bool or ConfigForAdaptiveGrid): If provided, the grid
+            extent is recomputed from the particle distribution at each
+            update from particles (see :class:`ConfigForAdaptiveGrid`), while
+            the number of cells is kept fixed. ``True`` selects the default
+            settings. It requires the solver to be given by name. Default is
+            ``None``.
+        packed_gradient (bool): If ``True`` the horizontal and vertical
+            derivatives of the potential are stored interleaved (the two
+            derivatives at each grid point are contiguous in memory), so that
+            the transverse kick at a particle position gathers the eight
+            surrounding grid points only once. This speeds up the tracking
+            through frozen maps. The ``dphi_dx``, ``dphi_dy`` and ``dphi_dz``
+            properties are available for both layouts. Default is ``False``.
+        gradient_dtype (str or np.dtype): Type used to store the derivatives
+            of the potential, either ``float64`` or ``float32``. In single
+            precision the memory and bandwidth needed by the interpolation
+            of the derivatives are halved, while the interpolation is still
+            performed in double precision. The derivatives are computed in
+            double precision and rounded when stored. The charge density and
+            the potential are always stored in double precision. Default is
+            ``float64``.
+        factorized (bool): If ``True`` the charge density is approximated as
+            the product of a transverse charge density and of a longitudinal
+            line density, which are deposited separately. A single
+            transverse Poisson problem is then solved and the potential is
+            obtained by scaling its solution with the line density. This is
+            suitable when the transverse distribution changes little along
+            the bunch, and reduces the cost of the solve by a factor ``nz``.
+            Only 2.5D solvers can be used. Default is ``False``.
+        fft_padding (str): Size of the padded arrays transformed by the FFT
+            solvers generated by name. ``minimal`` uses twice the number of
+            cells, ``smooth`` the next 2,3,5-smooth size and ``autotune``
+            the fastest of the two, timed once per grid (see
+            :class:`FFTSolver3D`). Default is ``minimal``.
+        fft_backend (FFTBackendCpu): FFT backend used by the FFT solvers
+            generated by name (e.g. a multithreaded FFT library). If
+            ``None`` the plans of the context are used. Default is ``None``.
     Returns:
         (TriLinearInterpolatedFieldMap): Interpolator object.
     """
@@ -150,6 +289,13 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
         'dphi_dx': xo.Float64[:],
         'dphi_dy': xo.Float64[:],
         'dphi_dz': xo.Float64[:],
+        'packed_gradient': xo.Int64,
+        'dphi_packed': xo.Float64[:],
+        'single_precision': xo.Int64,
+        'dphi_dx_f32': xo.Float32[:],
+        'dphi_dy_f32': xo.Float32[:],
+        'dphi_dz_f32': xo.Float32[:],
+        'dphi_packed_f32': xo.Float32[:],
     }
 
     # I add undescores in front of the names so that I can define custom
@@ -180,7 +326,13 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
                  solver=None,
                  scale_coordinates_in_solver=(1.,1.,1.),
                  updatable=True,
-                 fftplan=None
+                 fftplan=None,
+                 adaptive_grid=None,
+                 packed_gradient=False,
+                 gradient_dtype='float64',
+                 factorized=False,
+                 fft_padding='minimal',
+                 fft_backend=None
                  ):
 
         if _xobject is not None:
@@ -188,14 +340,47 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
                              _buffer=_buffer, _offset=_offset)
             return
 
+        if adaptive_grid is True:
+            adaptive_grid = ConfigForAdaptiveGrid()
+        elif adaptive_grid is False:
+            adaptive_grid = None
+        if adaptive_grid is not None and not isinstance(solver, str):
+            raise ValueError('An adaptive grid requires the solver to be '
+                             'given by name')
+        self.adaptive_grid = adaptive_grid
+
         self.updatable = updatable
         self.scale_coordinates_in_solver = scale_coordinates_in_solver
+        self.factorized = factorized
+        self.fft_padding = fft_padding
+        self.fft_backend = fft_backend
 
         self._x_grid = _configure_grid('x', x_grid, dx, x_range, nx)
         self._y_grid = _configure_grid('y', y_grid, dy, y_range, ny)
-        self._z_grid = _configure_grid('z', z_grid, dz, z_range, nz)
+        if nz == 1:
+            # 2D map, a single slice at the center of z_range
+            assert z_grid is None and dz is None, (
+                    'A 2D map (nz=1) is defined by z_range')
+            assert z_range is not None and len(z_range) == 2, (
+                    'z_range must be provided for a 2D map (nz=1)')
+            assert not factorized, 'A 2D map (nz=1) cannot be factorized'
+            self._z_length = z_range[1] - z_range[0]
+            self._z_grid = np.array([0.5*(z_range[0] + z_range[1])])
+        else:
+            self._z_grid = _configure_grid('z', z_grid, dz, z_range, nz)
+
+        gradient_dtype = np.dtype(gradient_dtype)
+        if gradient_dtype not in (np.float64, np.float32):
+            raise ValueError(f'gradient_dtype {gradient_dtype} not supported')
+        single_precision = gradient_dtype == np.float32
 
         nelem = self.nx*self.ny*self.nz
+        # Only the arrays of the selected gradient layout and type are
+        # allocated
+        nelem_unpacked = 0 if packed_gradient else nelem
+        nelem_packed = 2*nelem if packed_gradient else 0
+        n64 = 0 if single_precision else 1
+        n32 = 1 if single_precision else 0
         self.xoinitialize(
                  _context=_context,
                  _buffer=_buffer,
@@ -211,16 +396,36 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
                  dz = self.dz,
                  rho = nelem,
                  phi = nelem,
-                 dphi_dx = nelem,
-                 dphi_dy = nelem,
-                 dphi_dz = nelem)
+                 dphi_dx = n64*nelem_unpacked,
+                 dphi_dy = n64*nelem_unpacked,
+                 dphi_dz = n64*nelem,
+                 packed_gradient = packed_gradient,
+                 dphi_packed = n64*nelem_packed,
+                 single_precision = single_precision,
+                 dphi_dx_f32 = n32*nelem_unpacked,
+                 dphi_dy_f32 = n32*nelem_unpacked,
+                 dphi_dz_f32 = n32*nelem,
+                 dphi_packed_f32 = n32*nelem_packed)
 
         self.compile_kernels(only_if_needed=True)
 
+        if factorized:
+            # Transverse charge density (C/m^2) and line density (C/m)
+            self._rho_xy = self._buffer.context.zeros(
+                    self.nx*self.ny, dtype=np.float64)
+            self._line_density = self._buffer.context.zeros(
+                    self.nz, dtype=np.float64)
+
         if isinstance(solver, str):
             self.solver = self.generate_solver(solver, fftplan)
+            if adaptive_grid is not None:
+                self._init_adaptive_grid(solver)
         else:
             #TODO: consistency check to be added
+            if factorized and solver is not None:
+                assert solver.nz == 1, (
+                    'In factorized mode the solver needs to be defined on '
+                    'a single slice (nz=1)')
             self.solver = solver
 
         # Set rho
@@ -270,27 +475,47 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
 
         assert len(x) == len(y) == len(z)
 
+        xobj = self._xobject
         pos_in_buffer_of_maps_to_interp = []
+        strides_of_maps_to_interp = []
+        single_precision_of_maps_to_interp = []
         if return_rho:
             pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.rho._offset + self._xobject.rho._data_offset)
+                    xobj.rho._offset + xobj.rho._data_offset)
+            strides_of_maps_to_interp.append(1)
+            single_precision_of_maps_to_interp.append(0)
         if return_phi:
             pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.phi._offset + self._xobject.phi._data_offset)
-        if return_dphi_dx:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.dphi_dx._offset + self._xobject.dphi_dx._data_offset)
-        if return_dphi_dy:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.dphi_dy._offset + self._xobject.dphi_dy._data_offset)
-        if return_dphi_dz:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.dphi_dz._offset + self._xobject.dphi_dz._data_offset)
+                    xobj.phi._offset + xobj.phi._data_offset)
+            strides_of_maps_to_interp.append(1)
+            single_precision_of_maps_to_interp.append(0)
+        suffix = '_f32' if self.gradient_dtype == np.float32 else ''
+        itemsize = self.gradient_dtype.itemsize
+        for icomp, (flag, nn) in enumerate([(return_dphi_dx, 'dphi_dx'),
+                                            (return_dphi_dy, 'dphi_dy'),
+                                            (return_dphi_dz, 'dphi_dz')]):
+            if not flag:
+                continue
+            if self.packed_gradient and nn != 'dphi_dz':
+                dphi = getattr(xobj, 'dphi_packed' + suffix)
+                pos_in_buffer_of_maps_to_interp.append(
+                        dphi._offset + dphi._data_offset + itemsize*icomp)
+                strides_of_maps_to_interp.append(2)
+            else:
+                dphi = getattr(xobj, nn + suffix)
+                pos_in_buffer_of_maps_to_interp.append(
+                        dphi._offset + dphi._data_offset)
+                strides_of_maps_to_interp.append(1)
+            single_precision_of_maps_to_interp.append(int(suffix == '_f32'))
 
         context = self._buffer.context
 
         pos_in_buffer_of_maps_to_interp = context.nparray_to_context_array(
                         np.array(pos_in_buffer_of_maps_to_interp, dtype=np.int64))
+        strides_of_maps_to_interp = context.nparray_to_context_array(
+                        np.array(strides_of_maps_to_interp, dtype=np.int64))
+        single_precision_of_maps_to_interp = context.nparray_to_context_array(
+                np.array(single_precision_of_maps_to_interp, dtype=np.int64))
         nmaps_to_interp = len(pos_in_buffer_of_maps_to_interp)
         buffer_out = context.zeros(
                 shape=(nmaps_to_interp * len(x),), dtype=np.float64)
@@ -302,6 +527,9 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
                     n_quantities=nmaps_to_interp,
                     buffer_mesh_quantities=self._buffer.buffer,
                     offsets_mesh_quantities=pos_in_buffer_of_maps_to_interp,
+                    strides_mesh_quantities=strides_of_maps_to_interp,
+                    single_precision_mesh_quantities=(
+                                    single_precision_of_maps_to_interp),
                     particles_quantities=buffer_out)
 
         # Split buffer 
@@ -315,7 +543,8 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
                         particles=None,
                         x_p=None, y_p=None, z_p=None,
                         ncharges_p=None, state_p=None, q0_coulomb=None,
-                        reset=True, update_phi=True, solver=None, force=False):
+                        reset=True, update_phi=True, solver=None, force=False,
+                        deposition_mode='atomic'):
 
         """
         Updates the charge density at the grid using a given set of particles,
@@ -341,24 +570,73 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
                 attached to the fieldmap is used (if any). The default is ``None``.
             force (bool): If ``True`` the potential is updated even if the
                 map is declared as not updateable. The default is ``False``.
+            deposition_mode (str): ``'atomic'`` to deposit the charge with
+                atomic additions to the grid. ``'private'`` to have each
+                OpenMP thread deposit into a private copy of the grid, the
+                copies being then reduced in parallel. The latter avoids the
+                contention of the atomic additions when many particles are
+                in a few cells, at the cost of one grid copy per thread. It is
+                available only on CPU contexts and not in factorized mode.
+                The default is ``'atomic'``.
+
+        If the map has an adaptive grid, the grid is adapted to the provided
+        particles before the deposition (only if ``reset`` is ``True``).
+
+        In factorized mode the transverse charge density and the line density
+        are deposited, and the stored charge density is set to their
+        (normalized) product.
+
+        On CPU contexts, if the particles object is compacted (active particles
+        first, see ``xpart.Particles.reorganize``), only the active particles
+        are visited.
         """
 
         if not force:
             self._assert_updatable()
 
         if reset:
-            self.rho[:,:,:] = 0.
+            if self.factorized:
+                self._rho_xy[:] = 0.
+                self._line_density[:] = 0.
+            else:
+                self.rho[:,:,:] = 0.
 
         context = self._buffer.context
 
+        if deposition_mode == 'atomic':
+            kernel_suffix = ''
+            private_args = {}
+        elif deposition_mode == 'private':
+            if self.factorized:
+                raise NotImplementedError('Deposition with private grids is '
+                                          'not available in factorized mode')
+            kernel_suffix = '_private'
+            private_args = self._get_private_grids()
+        else:
+            raise ValueError(
+                    f'deposition_mode {deposition_mode} not recognized')
+
+        if self.factorized:
+            kernel_prefix = 'p2m_rectmesh2d_line_density'
+            grid_args = {'grid2d': self._rho_xy,
+                         'line_density': self._line_density}
+        else:
+            kernel_prefix = 'p2m_rectmesh3d'
+            grid_args = {'grid1d_buffer': self._xobject.rho._buffer.buffer,
+                         'grid1d_offset': self._xobject.rho._offset
+                                          + self._xobject.rho._data_offset}
+
         if particles is None:
             assert (len(x_p) == len(y_p) == len(z_p) == len(ncharges_p))
             if state_p is None:
                 state_p = context.zeros(shape=x_p.shape, dtype=np.int64) + 1
             else:
                 assert len(state_p) == len(x_p)
+            if reset and self.adaptive_grid is not None:
+                mask = state_p > 0
+                self.adapt_grid(x_p[mask], y_p[mask], z_p[mask])
 
-            context.kernels.p2m_rectmesh3d(
+            getattr(context.kernels, kernel_prefix + kernel_suffix)(
                     nparticles=len(x_p),
                     x=x_p, y=y_p, z=z_p,
                     part_weights=q0_coulomb*ncharges_p,
@@ -366,25 +644,219 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
                     x0=self.x_grid[0], y0=self.y_grid[0], z0=self.z_grid[0],
                     dx=self.dx, dy=self.dy, dz=self.dz,
                     nx=self.nx, ny=self.ny, nz=self.nz,
-                    grid1d_buffer=self._xobject.rho._buffer.buffer,
-                    grid1d_offset=self._xobject.rho._offset
-                                 +self._xobject.rho._data_offset)
+                    **grid_args,
+                    **private_args)
         else:
             assert (x_p is None and y_p is None and z_p is None
                     and ncharges_p is None and state_p is None)
-            context.kernels.p2m_rectmesh3d_xparticles(
-                    nparticles=particles._capacity,
+            nparticles = _get_num_particles_to_deposit(particles)
+            if reset and self.adaptive_grid is not None:
+                mask = particles.state[:nparticles] > 0
+                self.adapt_grid(particles.x[:nparticles][mask],
+                                particles.y[:nparticles][mask],
+                                particles.zeta[:nparticles][mask])
+            getattr(context.kernels,
+                    kernel_prefix + kernel_suffix + '_xparticles')(
+                    nparticles=nparticles,
                     particles=particles,
                     x0=self.x_grid[0], y0=self.y_grid[0], z0=self.z_grid[0],
                     dx=self.dx, dy=self.dy, dz=self.dz,
                     nx=self.nx, ny=self.ny, nz=self.nz,
-                    grid1d_buffer=self._xobject.rho._buffer.buffer,
-                    grid1d_offset=self._xobject.rho._offset
-                                 +self._xobject.rho._data_offset)
+                    **grid_args,
+                    **private_args)
+
+        if self.factorized:
+            _fill_outer_product(self.rho, self._rho_xy, self._line_density,
+                                1 / self._factorized_total_charge())
 
         if update_phi:
             self.update_phi_from_rho(solver=solver)
 
+    def _get_private_grids(self):
+
+        # Scratch grids for the deposition with private grids, one for each
+        # OpenMP thread except the first one (which deposits directly into
+        # rho), allocated at the first use
+
+        context = self._buffer.context
+        if not isinstance(context, xo.ContextCpu):
+            raise NotImplementedError(
+                    'Deposition with private grids is available only on CPU '
+                    'contexts')
+
+        n_private_grids = max(context.omp_num_threads, 1) - 1
+        size = max(n_private_grids * self.nx * self.ny * self.nz, 1)
+        if (getattr(self, '_private_grids', None) is None
+                or self._private_grids.size != size):
+            self._private_grids = context.zeros(size, dtype=np.float64)
+
+        return {'n_private_grids': n_private_grids,
+                'private_grids': self._private_grids}
+
+    def _init_adaptive_grid(self, solver_name):
+        self._solver_name = solver_name
+        self._adaptive_grid_reference = [
+                (gg[-1] - gg[0])/2 for gg in self._grids()]
+        self._adaptive_grid_levels = (0, 0, 0)
+        self._adaptive_grid_solvers = {self._adaptive_grid_levels: self.solver}
+
+    def _grids(self):
+        return self._x_grid, self._y_grid, self._z_grid
+
+    def adapt_grid(self, x, y, z):
+
+        """
+        Recomputes the grid extent from the distribution of a set of points
+        (typically the macroparticle coordinates), keeping the number of cells
+        fixed. The grid is centered on the mean of the points and its
+        half-width is ``n_sigmas`` times their r.m.s. size, rounded up to
+        the allowed values (see :class:`ConfigForAdaptiveGrid`). The solver
+        is regenerated when the cell size changes; the solvers of the cell
+        sizes already used are kept and reused.
+
+        Args:
+            x (float64 array): Horizontal coordinates of the points.
+            y (float64 array): Vertical coordinates of the points.
+            z (float64 array): Longitudinal coordinates of the points.
+        """
+
+        config = self.adaptive_grid
+        assert config is not None, 'This FieldMap has no adaptive grid!'
+
+        levels = []
+        for ii, (vv, gg) in enumerate(zip((x, y, z), self._grids())):
+            level = self._adaptive_grid_levels[ii]
+            # The single slice of a 2D map is not adapted
+            if len(vv) == 0 or len(gg) == 1:
+                levels.append(level)
+                continue
+
+            mean, std = mean_and_std(vv)
+            half_width_needed = config.n_sigmas[ii] * std
+            if half_width_needed > 0:
+                level_needed = int(np.ceil(np.log(half_width_needed
+                                    / self._adaptive_grid_reference[ii])
+                                    / np.log(config.step)))
+                # Grow immediately, shrink only beyond the hysteresis
+                if (level_needed > level
+                        or level_needed < level - config.hysteresis):
+                    level = level_needed
+            levels.append(level)
+
+            half_width = self._adaptive_grid_reference[ii] * config.step**level
+            n_cells = len(gg)
+            new_grid = mean + np.linspace(-half_width, half_width, n_cells)
+            if ii == 0:
+                self._x_grid = new_grid
+            elif ii == 1:
+                self._y_grid = new_grid
+            else:
+                self._z_grid = new_grid
+
+        self._x_min = self._x_grid[0]
+        self._y_min = self._y_grid[0]
+        self._z_min = self._z_grid[0]
+        self._dx = self.dx
+        self._dy = self.dy
+        self._dz = self.dz
+
+        levels = tuple(levels)
+        if levels != self._adaptive_grid_levels:
+            self._adaptive_grid_levels = levels
+            if levels not in self._adaptive_grid_solvers:
+                self._adaptive_grid_solvers[levels] = self.generate_solver(
+                        self._solver_name,
+                        fftplan=getattr(self.solver, 'fftplan', None))
+            self.solver = self._adaptive_grid_solvers[levels]
+
+    @classmethod
+    def update_from_particles_batch(cls, fieldmaps, particles,
+                                    update_phi=True, solver=None, force=False,
+                                    deposition_mode='atomic'):
+
+        """
+        Updates the charge density of several field maps defined on the same
+        grid, each from its own set of particles (e.g. the different bunches
+        of a train). The potentials can be optionally updated accordingly,
+        solving Poisson's equation for all the maps with a single batched
+        solve.
+
+        Args:
+            fieldmaps (sequence of TriLinearInterpolatedFieldMap): field maps
+                to be updated.
+            particles (sequence of xtrack.Particles): xtrack particle objects,
+                one for each field map.
+            update_phi (bool): If ``True`` the stored potentials are
+                recalculated from the stored charge densities.
+            solver (Solver object): solver object to be used to solve Poisson's
+                equation (compute phi from rho). If ``None`` is provided the
+                solver attached to the first fieldmap is used (if any). The
+                default is ``None``.
+            force (bool): If ``True`` the potential is updated even if the
+                maps are declared as not updateable. The default is ``False``.
+            deposition_mode (str): Deposition mode (see
+                :meth:`update_from_particles`). The default is ``'atomic'``.
+        """
+
+        assert len(fieldmaps) == len(particles)
+
+        for fmap, pp in zip(fieldmaps, particles):
+            fmap.update_from_particles(particles=pp, update_phi=False,
+                                       force=force,
+                                       deposition_mode=deposition_mode)
+
+        if update_phi:
+            cls.update_phi_from_rho_batch(fieldmaps, solver=solver,
+                                          force=force)
+
+    @classmethod
+    def update_phi_from_rho_batch(cls, fieldmaps, solver=None, force=False):
+
+        """
+        Updates the potential of several field maps defined on the same grid
+        from their charge densities, solving Poisson's equation for all the
+        maps with a single batched solve.
+
+        Args:
+            fieldmaps (sequence of TriLinearInterpolatedFieldMap): field maps
+                to be updated.
+            solver (Solver object): solver object to be used to solve Poisson's
+                equation. If it does not provide a ``solve_batch`` method the
+                maps are solved one by one. If ``None`` is provided the solver
+                attached to the first fieldmap is used (if any). The default
+                is ``None``.
+            force (bool): If ``True`` the potential is updated even if the
+                maps are declared as not updateable. The default is ``False``.
+        """
+
+        fmap0 = fieldmaps[0]
+        for fmap in fieldmaps:
+            if not force:
+                fmap._assert_updatable()
+            assert ((fmap.nx, fmap.ny, fmap.nz, fmap.dx, fmap.dy, fmap.dz)
+                 == (fmap0.nx, fmap0.ny, fmap0.nz,
+                     fmap0.dx, fmap0.dy, fmap0.dz)), (
+                        'The field maps need to be defined on the same grid')
+
+        if solver is None:
+            if hasattr(fmap0, 'solver'):
+                solver = fmap0.solver
+            else:
+                raise ValueError('I have no solver to compute phi!')
+
+        if (any(fmap.factorized for fmap in fieldmaps)
+                or not hasattr(solver, 'solve_batch')):
+            # A single transverse solve for each map, no batching needed (or
+            # possible)
+            for fmap in fieldmaps:
+                fmap.update_phi_from_rho(solver=solver)
+            return
+
+        solver.solve_batch([fmap.rho for fmap in fieldmaps],
+                           phi_out=[fmap.phi for fmap in fieldmaps])
+        for fmap in fieldmaps:
+            fmap._update_gradient()
+
     def update_rho(self, rho, reset=True, force=False):
         """
         Updates the charge density on the grid.
@@ -396,6 +868,9 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
                 is added to the stored one. The default is ``True``.
             force (bool): If ``True`` the charge density is updated even if the
                 map is declared as not updateable. The default is ``False``.
+
+        In factorized mode the transverse charge density and the line density
+        are obtained by projecting the provided charge density.
         """
 
         if not force:
@@ -406,6 +881,12 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
         else:
             raise ValueError('Not implemented!')
 
+        if self.factorized:
+            rho = self.rho
+            self._rho_xy.reshape((self.nx, self.ny), order='F')[:, :] = (
+                    rho.sum(axis=2) * self.dz)
+            self._line_density[:] = rho.sum(axis=(0, 1)) * self.dx * self.dy
+
     #@profile
     def update_phi(self, phi, reset=True, force=False):
 
@@ -430,42 +911,60 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
         else:
             raise ValueError('Not implemented!')
 
+        self._update_gradient()
+
+    def _update_gradient(self):
+
         context = self._buffer.context
 
-        # Compute gradient
-        context.kernels.central_diff(
-                nelem = self.phi.size,
-                row_size = self.nx,
-                stride_in_dbl = self.phi.strides[0]/8,
-                factor = 1/(2*self.dx),
-                matrix_buffer = self._xobject.phi._buffer.buffer,
-                matrix_offset = (self._xobject.phi._offset
-                               + self._xobject.phi._data_offset),
-                res_buffer = self._xobject.dphi_dx._buffer.buffer,
-                res_offset = (self._xobject.dphi_dx._offset
-                            + self._xobject.dphi_dx._data_offset))
-        context.kernels.central_diff(
-                nelem = self.phi.size,
-                row_size = self.ny,
-                stride_in_dbl = self.phi.strides[1]/8,
-                factor = 1/(2*self.dy),
-                matrix_buffer = self._xobject.phi._buffer.buffer,
-                matrix_offset = (self._xobject.phi._offset
-                               + self._xobject.phi._data_offset),
-                res_buffer = self._xobject.dphi_dy._buffer.buffer,
-                res_offset = (self._xobject.dphi_dy._offset
-                            + self._xobject.dphi_dy._data_offset))
-        context.kernels.central_diff(
-                nelem = self.phi.size,
-                row_size = self.nz,
-                stride_in_dbl = self.phi.strides[2]/8,
-                factor = 1/(2*self.dz),
-                matrix_buffer = self._xobject.phi._buffer.buffer,
-                matrix_offset = (self._xobject.phi._offset
-                               + self._xobject.phi._data_offset),
-                res_buffer = self._xobject.dphi_dz._buffer.buffer,
-                res_offset = (self._xobject.dphi_dz._offset
-                            + self._xobject.dphi_dz._data_offset))
+        # Compute gradient (single pass over phi)
+        xobj = self._xobject
+        if self.gradient_dtype == np.float32:
+            # The derivatives are computed in double precision in a work
+            # array (transverse derivatives followed by the longitudinal
+            # one, allocated at the first update and reused) and then
+            # rounded
+            nelem = self.nx * self.ny * self.nz
+            work = _get_work_array(self, '_gradient_work', 3*nelem)
+            res_buffer = work.view(np.int8)
+            offset_dphi_dx = 0
+            offset_dphi_dy = 8*nelem
+            offset_dphi_dz = 16*nelem
+            offset_packed = 0
+        else:
+            res_buffer = xobj.phi._buffer.buffer
+            offset_dphi_dx = xobj.dphi_dx._offset + xobj.dphi_dx._data_offset
+            offset_dphi_dy = xobj.dphi_dy._offset + xobj.dphi_dy._data_offset
+            offset_dphi_dz = xobj.dphi_dz._offset + xobj.dphi_dz._data_offset
+            offset_packed = (xobj.dphi_packed._offset
+                             + xobj.dphi_packed._data_offset)
+        if self.packed_gradient:
+            # Interleaved transverse derivatives, then the longitudinal one
+            passes = [(2, offset_packed, offset_packed + 8, -1),
+                      (1, -1, -1, offset_dphi_dz)]
+        else:
+            passes = [(1, offset_dphi_dx, offset_dphi_dy, offset_dphi_dz)]
+        for out_stride, res_x_offset, res_y_offset, res_z_offset in passes:
+            context.kernels.central_diff_3d(
+                    nrows = self.ny * self.nz,
+                    nx = self.nx, ny = self.ny, nz = self.nz,
+                    fx = 1/(2*self.dx), fy = 1/(2*self.dy),
+                    fz = 1/(2*self.dz),
+                    in_stride = 1, out_stride = out_stride,
+                    matrix_buffer = xobj.phi._buffer.buffer,
+                    matrix_offset = xobj.phi._offset + xobj.phi._data_offset,
+                    res_buffer = res_buffer,
+                    res_x_offset = res_x_offset,
+                    res_y_offset = res_y_offset,
+                    res_z_offset = res_z_offset)
+
+        if self.gradient_dtype == np.float32:
+            if self.packed_gradient:
+                self._dphi_packed_f32[:] = work[:2*nelem]
+            else:
+                self._dphi_dx_f32[:] = work[:nelem]
+                self._dphi_dy_f32[:] = work[nelem:2*nelem]
+            self._dphi_dz_f32[:] = work[2*nelem:]
 
     #@profile
     def update_phi_from_rho(self, solver=None):
@@ -489,8 +988,25 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
             else:
                 raise ValueError('I have no solver to compute phi!')
 
-        new_phi = solver.solve(self.rho)
-        self.update_phi(new_phi)
+        if self.factorized:
+            # Single transverse solve, scaled by the line density
+            q_tot = self._factorized_total_charge()
+            phi_xy = solver.solve(
+                    self._rho_xy.reshape((self.nx, self.ny, 1), order='F'))
+            _fill_outer_product(self.phi, phi_xy[:, :, 0],
+                                self._line_density, 1 / q_tot)
+        elif getattr(solver, 'supports_phi_out', False):
+            # The potential is written by the solver directly into phi
+            solver.solve(self.rho, phi_out=self.phi)
+        else:
+            self.update_phi(solver.solve(self.rho), force=True)
+            return
+        self._update_gradient()
+
+    def _factorized_total_charge(self):
+        q_tot = float(self._line_density.sum()) * self.dz
+        # The products are zero anyway if no charge is deposited
+        return q_tot if q_tot != 0 else 1.
 
     def generate_solver(self, solver, fftplan):
 
@@ -499,30 +1015,80 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
 
         Args:
             solver (str): Defines the Poisson solver to be used
-            to compute phi from rho. Accepted values are ``FFTSolver3D`` and
-            ``FFTSolver2p5D``.
+            to compute phi from rho. Accepted values are ``FFTSolver3D``,
+            ``FFTSolver2p5D``, ``FFTSolver2p5DSliced``, ``MultigridSolver3D``
+            and ``MultigridSolver2p5D``, and ``FFTSolver2D`` for 2D maps.
+            The FFT solvers are padded according to ``fft_padding`` and use
+            the ``fft_backend`` of the field map.
         Returns:
             (Solver): Solver object associated to the defined grid.
         """
 
         scale_dx, scale_dy, scale_dz = self.scale_coordinates_in_solver
 
-        if solver == 'FFTSolver3D':
+        # In factorized mode a single transverse problem is solved
+        nz = self.nz
+        if self.factorized:
+            if solver in ('FFTSolver3D', 'MultigridSolver3D'):
+                raise ValueError(
+                    f'{solver} cannot be used in factorized mode')
+            nz = 1
+
+        if self.nz == 1 and solver in ('FFTSolver3D', 'MultigridSolver3D'):
+            raise ValueError(f'{solver} cannot be used for a 2D map (nz=1)')
+        if self.nz > 1 and solver == 'FFTSolver2D':
+            raise ValueError('FFTSolver2D can be used only for a 2D map '
+                             '(nz=1)')
+
+        if solver == 'FFTSolver2D':
+            solver = FFTSolver2D(
+                    dx=self.dx*scale_dx,
+                    dy=self.dy*scale_dy,
+                    dz=self.dz*scale_dz,
+                    nx=self.nx, ny=self.ny,
+                    context=self._buffer.context,
+                    fftplan=fftplan,
+                    fft_padding=self.fft_padding,
+                    fft_backend=self.fft_backend)
+        elif solver == 'FFTSolver3D':
             solver = FFTSolver3D(
                     dx=self.dx*scale_dx,
                     dy=self.dy*scale_dy,
                     dz=self.dz*scale_dz,
-                    nx=self.nx, ny=self.ny, nz=self.nz,
+                    nx=self.nx, ny=self.ny, nz=nz,
                     context=self._buffer.context,
-                    fftplan=fftplan)
+                    fftplan=fftplan,
+                    fft_padding=self.fft_padding,
+                    fft_backend=self.fft_backend)
         elif solver == 'FFTSolver2p5D':
             solver = FFTSolver2p5D(
                     dx=self.dx*scale_dx,
                     dy=self.dy*scale_dy,
                     dz=self.dz*scale_dz,
-                    nx=self.nx, ny=self.ny, nz=self.nz,
+                    nx=self.nx, ny=self.ny, nz=nz,
                     context=self._buffer.context,
-                    fftplan=fftplan)
+                    fftplan=fftplan,
+                    fft_padding=self.fft_padding,
+                    fft_backend=self.fft_backend)
+        elif solver == 'FFTSolver2p5DSliced':
+            solver = FFTSolver2p5DSliced(
+                    dx=self.dx*scale_dx,
+                    dy=self.dy*scale_dy,
+                    dz=self.dz*scale_dz,
+                    nx=self.nx, ny=self.ny, nz=nz,
+                    context=self._buffer.context,
+                    fftplan=fftplan,
+                    fft_padding=self.fft_padding,
+                    fft_backend=self.fft_backend)
+        elif solver in ('MultigridSolver3D', 'MultigridSolver2p5D'):
+            solver_class = {'MultigridSolver3D': MultigridSolver3D,
+                            'MultigridSolver2p5D': MultigridSolver2p5D}[solver]
+            solver = solver_class(
+                    dx=self.dx*scale_dx,
+                    dy=self.dy*scale_dy,
+                    dz=self.dz*scale_dz,
+                    nx=self.nx, ny=self.ny, nz=nz,
+                    context=self._buffer.context)
         else:
             raise ValueError(f'solver name {solver} not recognized')
 
@@ -587,8 +1153,10 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
     @property
     def dz(self):
         """
-        Longitudinal cell size in meters.
+        Longitudinal cell size in meters (the length of the map for 2D maps).
         """
+        if self.nz == 1:
+            return self._z_length
         return self.z_grid[1] - self.z_grid[0]
 
     # TODO: these reshapes can be avoided by allocating 3d arrays directly in the xobject
@@ -606,22 +1174,128 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
                 (self.nx, self.ny, self.nz), order='F')
 
     @property
-    def dphi_dx(self):
-        return self._dphi_dx.reshape(
+    def packed_gradient(self):
+        """
+        ``True`` if the transverse derivatives of the potential are stored
+        interleaved.
+        """
+        return bool(self._packed_gradient)
+
+    @property
+    def gradient_dtype(self):
+        """
+        Type used to store the derivatives of the potential.
+        """
+        return np.dtype(np.float32 if self._single_precision else np.float64)
+
+    def _get_derivative_array(self, name):
+        if self._single_precision:
+            name += '_f32'
+        return getattr(self, name)
+
+    def _get_transverse_derivative(self, icomp, name):
+        if self.packed_gradient:
+            return self._get_derivative_array('_dphi_packed').reshape(
+                    (2, self.nx, self.ny, self.nz), order='F')[icomp]
+        return self._get_derivative_array(name).reshape(
                 (self.nx, self.ny, self.nz), order='F')
 
+    @property
+    def dphi_dx(self):
+        return self._get_transverse_derivative(0, '_dphi_dx')
+
     @property
     def dphi_dy(self):
-        return self._dphi_dy.reshape(
-                (self.nx, self.ny, self.nz), order='F')
+        return self._get_transverse_derivative(1, '_dphi_dy')
 
     @property
     def dphi_dz(self):
-        return self._dphi_dz.reshape(
+        return self._get_derivative_array('_dphi_dz').reshape(
                 (self.nx, self.ny, self.nz), order='F')
 
 
 
+class ConfigForAdaptiveGrid:
+
+    """
+    Settings of the adaptive grid of a
+    :class:`TriLinearInterpolatedFieldMap`. The half-width of the grid along
+    each direction is ``n_sigmas`` times the r.m.s. size of the particle
+    distribution, rounded up to the initial half-width times an integer
+    power of ``step``. Rounding limits the number of different cell sizes,
+    hence of the solvers that need to be generated. The grid is enlarged as
+    soon as needed, while it is reduced only if the required half-width
+    is more than ``hysteresis`` steps below the current one.
+
+    Args:
+        n_sigmas (float or tuple): Half-width of the grid in units of r.m.s.
+            size of the particle distribution, either one value or three
+            values (x, y, z). The default is ``5.``.
+        step (float): Ratio between consecutive allowed half-widths. The
+            default is ``1.1``.
+        hysteresis (int): Number of steps by which the required half-width
+            needs to be below the current one for the grid to be reduced.
+            The default is ``2``.
+    Returns:
+        (ConfigForAdaptiveGrid): Adaptive grid settings.
+    """
+
+    def __init__(self, n_sigmas=5., step=1.1, hysteresis=2):
+
+        if np.isscalar(n_sigmas):
+            n_sigmas = (n_sigmas,)*3
+        assert len(n_sigmas) == 3
+        assert step > 1
+
+        self.n_sigmas = tuple(n_sigmas)
+        self.step = step
+        self.hysteresis = hysteresis
+
+
+def _fill_outer_product(out, f_xy, f_z, factor):
+    # out[ix, iy, iz] = factor * f_xy[ix, iy] * f_z[iz], with f_xy stored in
+    # Fortran order
+    nx, ny, nz = out.shape
+    f_xy = f_xy.reshape((nx, ny), order='F')
+    try:
+        # The transposes make it faster in cupy (C-contigous arrays)
+        out.T[:, :, :] = (factor * f_z)[:, None, None] * f_xy.T[None, :, :]
+    except Exception: # pyopencl does not support array broadcasting
+        f_z = factor * f_z.get()
+        for iz in range(nz):
+            out[:, :, iz] = f_z[iz] * f_xy
+
+
+def _get_work_array(fmap, name, size):
+    # Float64 work array stored on the field map, allocated at the first use
+    # (and when the grid changes) and reused by the following updates
+    work = getattr(fmap, name, None)
+    if work is None or len(work) != size:
+        work = fmap._buffer.context.zeros(size, dtype=np.float64)
+        setattr(fmap, name, work)
+    return work
+
+
+def _get_num_particles_to_deposit(particles):
+
+    # On CPU the particles are kept compacted by xtrack (active particles at
+    # the beginning of the arrays), hence the lost ones can be skipped. The
+    # count is only trusted if it matches the state at the boundary of the
+    # active range (e.g. not after particles have been revived without
+    # updating it). On the other contexts, or if the count is not
+    # consistent, all the particles are visited and the lost ones are
+    # discarded based on their state.
+    n_active = particles._num_active_particles
+    if (isinstance(particles._buffer.context, xo.ContextCpu)
+            and 0 <= n_active <= particles._capacity):
+        state = particles.state
+        if ((n_active == 0 or state[n_active - 1] > 0)
+                and (n_active == particles._capacity
+                     or state[n_active] <= 0)):
+            return n_active
+    return particles._capacity
+
+
 def _configure_grid(vname, v_grid, dv, v_range, nv):
 
     # Check input consistency
@@ -6,33 +6,79 @@
 #ifndef CENTRAL_DIFF_H
 #define CENTRAL_DIFF_H
 
+// Computes in a single pass the central differences along x, y and z of a
+// quantity defined on a 3D grid (x index fastest), multiplied by fx, fy and
+// fz. The differences are set to zero at the first and last point along each
+// direction. Consecutive grid points are in_stride (out_stride) doubles apart
+// in the input (output) arrays, so that interleaved arrays can be processed.
+// A negative output offset skips the corresponding direction.
+
 /*gpukern*/
-void central_diff(
-	      const int     nelem,
-	      const int     row_size,
-	      const int     stride_in_dbl,
-	      const double  factor,
+void central_diff_3d(
+              const int     nrows, // ny * nz
+              const int     nx,
+              const int     ny,
+              const int     nz,
+              const double  fx,
+              const double  fy,
+              const double  fz,
+              const int     in_stride,
+              const int     out_stride,
 /*gpuglmem*/  const int8_t* matrix_buffer,
               const int64_t matrix_offset,
 /*gpuglmem*/        int8_t* res_buffer,
-                    int64_t res_offset
+              const int64_t res_x_offset,
+              const int64_t res_y_offset,
+              const int64_t res_z_offset
               ){
 
-   /*gpuglmem*/ const double* matrix = 
-	           (/*gpuglmem*/ double*) (matrix_buffer + matrix_offset); 
-   /*gpuglmem*/       double*  res = 
-	           (/*gpuglmem*/ double*) (res_buffer + res_offset); 
-
-   for(int ii=0; ii<nelem; ii++){//vectorize_over ii nelem
-      if (ii-stride_in_dbl>=0 && ii+stride_in_dbl<nelem){
-         res[ii] = factor * (matrix[ii+stride_in_dbl]
-			   - matrix[ii-stride_in_dbl]);
-      } 
-      int place_in_row = (ii/stride_in_dbl)%row_size;
-      if (place_in_row==0 || place_in_row==row_size-1){
-         res[ii] = 0;
+   /*gpuglmem*/ const double* matrix =
+                   (/*gpuglmem*/ double*) (matrix_buffer + matrix_offset);
+
+   const int64_t sx = in_stride;
+   const int64_t sy = ((int64_t) in_stride) * nx;
+   const int64_t sz = ((int64_t) in_stride) * nx * ny;
+
+   // One row along x for each thread, no division in the inner loop
+   for(int irow=0; irow<nrows; irow++){//vectorize_over irow nrows
+      const int iy = irow % ny;
+      const int iz = irow / ny;
+      const int inner_y = (iy > 0 && iy < ny - 1);
+      const int inner_z = (iz > 0 && iz < nz - 1);
+      const int64_t i0 = ((int64_t) irow) * nx;
+
+      if (res_x_offset >= 0){
+         /*gpuglmem*/ double* res_x =
+                   (/*gpuglmem*/ double*) (res_buffer + res_x_offset);
+         res_x[i0 * out_stride] = 0;
+         for (int ix=1; ix<nx-1; ix++){
+            const int64_t ii = (i0 + ix) * in_stride;
+            res_x[(i0 + ix) * out_stride] = fx * (matrix[ii + sx]
+                                                - matrix[ii - sx]);
+         }
+         res_x[(i0 + nx - 1) * out_stride] = 0;
+      }
+
+      if (res_y_offset >= 0){
+         /*gpuglmem*/ double* res_y =
+                   (/*gpuglmem*/ double*) (res_buffer + res_y_offset);
+         for (int ix=0; ix<nx; ix++){
+            const int64_t ii = (i0 + ix) * in_stride;
+            res_y[(i0 + ix) * out_stride] = inner_y ?
+                        fy * (matrix[ii + sy] - matrix[ii - sy]) : 0;
+         }
+      }
+
+      if (res_z_offset >= 0){
+         /*gpuglmem*/ double* res_z =
+                   (/*gpuglmem*/ double*) (res_buffer + res_z_offset);
+         for (int ix=0; ix<nx; ix++){
+            const int64_t ii = (i0 + ix) * in_stride;
+            res_z[(i0 + ix) * out_stride] = inner_z ?
+                        fz * (matrix[ii + sz] - matrix[ii - sz]) : 0;
+         }
       }
-   }//end_vectorize 
+   }//end_vectorize
 
 }
 
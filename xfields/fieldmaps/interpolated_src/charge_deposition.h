@@ -12,6 +12,56 @@
 
 
 
+/*gpufun*/ void p2m_rectmesh2d_one_particle(
+        // INPUTS:
+        const double x,
+        const double y,
+          // particle weight divided by the cell volume
+        const double pwei_vol,
+          // mesh origin
+        const double x0, const double y0,
+          // mesh distances per cell
+        const double dx, const double dy,
+          // mesh dimension (number of cells)
+        const int nx, const int ny,
+        // OUTPUTS:
+        /*gpuglmem*/ double *grid2d,
+          // if zero, the grid is private to the calling thread
+        const int use_atomic
+) {
+
+    // indices
+    int jx = floor((x - x0) / dx);
+    int ix = floor((y - y0) / dy);
+
+    if (jx >= 0 && jx < nx - 1 && ix >= 0 && ix < ny - 1)
+    {
+        // normalized distances
+        double ux = (x - (x0 + jx * dx)) / dx;
+        double uy = (y - (y0 + ix * dy)) / dy;
+
+        double wij =   pwei_vol * (1.-ux) * (1.-uy);
+        double wij1 =  pwei_vol * ux      * (1.-uy);
+        double wi1j =  pwei_vol * (1.-ux) * uy;
+        double wi1j1 = pwei_vol * ux      * uy;
+
+        if (use_atomic){
+            atomicAdd(&grid2d[jx   + ix*nx],     wij);
+            atomicAdd(&grid2d[jx+1 + ix*nx],     wij1);
+            atomicAdd(&grid2d[jx   + (ix+1)*nx], wi1j);
+            atomicAdd(&grid2d[jx+1 + (ix+1)*nx], wi1j1);
+        }
+        else{
+            grid2d[jx   + ix*nx]     += wij;
+            grid2d[jx+1 + ix*nx]     += wij1;
+            grid2d[jx   + (ix+1)*nx] += wi1j;
+            grid2d[jx+1 + (ix+1)*nx] += wi1j1;
+        }
+    }
+
+}
+
+
 /*gpufun*/ void p2m_rectmesh3d_one_particle(
         // INPUTS:
         const double x, 
@@ -26,11 +76,20 @@
           // mesh dimension (number of cells)
         const int nx, const int ny, const int nz,
         // OUTPUTS:
-        /*gpuglmem*/ double *grid1d
+        /*gpuglmem*/ double *grid1d,
+          // if zero, the grid is private to the calling thread
+        const int use_atomic
 ) {
 
     double vol_m1 = 1/(dx*dy*dz);
 
+    if (nz == 1){
+        // 2D map, the charge is spread uniformly over the length dz
+        p2m_rectmesh2d_one_particle(x, y, pwei * vol_m1, x0, y0, dx, dy,
+                                    nx, ny, grid1d, use_atomic);
+        return;
+    }
+
     // indices
     int jx = floor((x - x0) / dx);
     int ix = floor((y - y0) / dy);
@@ -54,14 +113,26 @@
     if (jx >= 0 && jx < nx - 1 && ix >= 0 && ix < ny - 1
         	    && kx >= 0 && kx < nz - 1)
     {
-        atomicAdd(&grid1d[jx   + ix*nx     + kx*nx*ny],     wijk);
-        atomicAdd(&grid1d[jx+1 + ix*nx     + kx*nx*ny],     wij1k);
-        atomicAdd(&grid1d[jx   + (ix+1)*nx + kx*nx*ny],     wi1jk);
-        atomicAdd(&grid1d[jx+1 + (ix+1)*nx + kx*nx*ny],     wi1j1k);
-        atomicAdd(&grid1d[jx   + ix*nx     + (kx+1)*nx*ny], wijk1);
-        atomicAdd(&grid1d[jx+1 + ix*nx     + (kx+1)*nx*ny], wij1k1);
-        atomicAdd(&grid1d[jx   + (ix+1)*nx + (kx+1)*nx*ny], wi1jk1);
-        atomicAdd(&grid1d[jx+1 + (ix+1)*nx + (kx+1)*nx*ny], wi1j1k1);
+        if (use_atomic){
+            atomicAdd(&grid1d[jx   + ix*nx     + kx*nx*ny],     wijk);
+            atomicAdd(&grid1d[jx+1 + ix*nx     + kx*nx*ny],     wij1k);
+            atomicAdd(&grid1d[jx   + (ix+1)*nx + kx*nx*ny],     wi1jk);
+            atomicAdd(&grid1d[jx+1 + (ix+1)*nx + kx*nx*ny],     wi1j1k);
+            atomicAdd(&grid1d[jx   + ix*nx     + (kx+1)*nx*ny], wijk1);
+            atomicAdd(&grid1d[jx+1 + ix*nx     + (kx+1)*nx*ny], wij1k1);
+            atomicAdd(&grid1d[jx   + (ix+1)*nx + (kx+1)*nx*ny], wi1jk1);
+            atomicAdd(&grid1d[jx+1 + (ix+1)*nx + (kx+1)*nx*ny], wi1j1k1);
+        }
+        else{
+            grid1d[jx   + ix*nx     + kx*nx*ny]     += wijk;
+            grid1d[jx+1 + ix*nx     + kx*nx*ny]     += wij1k;
+            grid1d[jx   + (ix+1)*nx + kx*nx*ny]     += wi1jk;
+            grid1d[jx+1 + (ix+1)*nx + kx*nx*ny]     += wi1j1k;
+            grid1d[jx   + ix*nx     + (kx+1)*nx*ny] += wijk1;
+            grid1d[jx+1 + ix*nx     + (kx+1)*nx*ny] += wij1k1;
+            grid1d[jx   + (ix+1)*nx + (kx+1)*nx*ny] += wi1jk1;
+            grid1d[jx+1 + (ix+1)*nx + (kx+1)*nx*ny] += wi1j1k1;
+        }
     }
 
 }
@@ -98,7 +169,7 @@
 
             p2m_rectmesh3d_one_particle(x[pidx], y[pidx], z[pidx], pwei,
                                         x0, y0, z0, dx, dy, dz, nx, ny, nz,
-                                        grid1d);
+                                        grid1d, 1);
 	}
     }//end_vectorize
 }
@@ -138,9 +209,265 @@
 
             p2m_rectmesh3d_one_particle(x[pidx], y[pidx], z[pidx], pwei,
                                         x0, y0, z0, dx, dy, dz, nx, ny, nz,
-                                        grid1d);
+                                        grid1d, 1);
 	}
     }//end_vectorize
 
 }
+
+/*gpufun*/ void p2m_rectmesh3d_private_grids(
+        // INPUTS:
+          // length of x, y, z arrays
+        const int nparticles,
+          // particle positions
+        /*gpuglmem*/ const double* x,
+        /*gpuglmem*/ const double* y,
+        /*gpuglmem*/ const double* z,
+          // particle weights (multiplied by weight_factor) and stat flags
+        /*gpuglmem*/ const double* part_weights,
+        const double weight_factor,
+        /*gpuglmem*/ const int64_t* part_state,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+          // scratch grids, one for each thread except the first one
+        const int n_private_grids,
+        /*gpuglmem*/ double* private_grids,
+        // OUTPUTS:
+        /*gpuglmem*/ double* grid1d){
+
+    // Each thread deposits into its own copy of the grid (the first thread
+    // directly into the output grid), without atomic operations. The copies
+    // are then reduced in parallel over the grid points.
+
+    const int64_t ngrid = ((int64_t) nx) * ny * nz;
+
+    #pragma omp parallel num_threads(n_private_grids + 1) //only_for_context cpu_openmp
+    {
+        int ithread = 0;
+        int nthreads = 1;
+        #ifdef _OPENMP
+        ithread = omp_get_thread_num();
+        nthreads = omp_get_num_threads();
+        #endif
+
+        /*gpuglmem*/ double* grid_thread = grid1d;
+        if (ithread > 0){
+            grid_thread = private_grids + (ithread - 1) * ngrid;
+            for (int64_t ii=0; ii<ngrid; ii++){
+                grid_thread[ii] = 0.;
+            }
+        }
+
+        #pragma omp for schedule(static) //only_for_context cpu_openmp
+        for (int pidx=0; pidx<nparticles; pidx++){
+            if (part_state[pidx] > 0){
+                double pwei = part_weights[pidx] * weight_factor;
+
+                p2m_rectmesh3d_one_particle(x[pidx], y[pidx], z[pidx], pwei,
+                                        x0, y0, z0, dx, dy, dz, nx, ny, nz,
+                                        grid_thread, 0);
+            }
+        }
+
+        #pragma omp for schedule(static) //only_for_context cpu_openmp
+        for (int64_t ii=0; ii<ngrid; ii++){
+            for (int it=1; it<nthreads; it++){
+                grid1d[ii] += private_grids[(it - 1) * ngrid + ii];
+            }
+        }
+    }
+}
+
+/*gpukern*/ void p2m_rectmesh3d_private(
+        // INPUTS:
+          // length of x, y, z arrays
+        const int nparticles,
+          // particle positions
+        /*gpuglmem*/ const double* x,
+        /*gpuglmem*/ const double* y,
+        /*gpuglmem*/ const double* z,
+          // particle weights and stat flags
+        /*gpuglmem*/ const double* part_weights,
+        /*gpuglmem*/ const int64_t* part_state,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+          // scratch grids, one for each thread except the first one
+        const int n_private_grids,
+        /*gpuglmem*/ double* private_grids,
+        // OUTPUTS:
+        /*gpuglmem*/ int8_t*  grid1d_buffer,
+                     int64_t  grid1d_offset){
+
+    /*gpuglmem*/ double* grid1d =
+                (/*gpuglmem*/ double*)(grid1d_buffer + grid1d_offset);
+
+    p2m_rectmesh3d_private_grids(nparticles, x, y, z, part_weights, 1.,
+                                 part_state, x0, y0, z0, dx, dy, dz,
+                                 nx, ny, nz, n_private_grids, private_grids,
+                                 grid1d);
+}
+
+/*gpukern*/ void p2m_rectmesh3d_private_xparticles(
+        // INPUTS:
+          // length of x, y, z arrays
+        const int nparticles,
+        ParticlesData particles,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+          // scratch grids, one for each thread except the first one
+        const int n_private_grids,
+        /*gpuglmem*/ double* private_grids,
+        // OUTPUTS:
+        /*gpuglmem*/ int8_t*  grid1d_buffer,
+                     int64_t  grid1d_offset){
+
+    /*gpuglmem*/ double* grid1d =
+        (/*gpuglmem*/ double*)(grid1d_buffer + grid1d_offset);
+
+    // TODO I am forgetting about charge_ratio and mass_ratio
+    const double q0_coulomb = QELEM * ParticlesData_get_q0(particles);
+
+    p2m_rectmesh3d_private_grids(nparticles,
+                        ParticlesData_getp1_x(particles, 0),
+                        ParticlesData_getp1_y(particles, 0),
+                        ParticlesData_getp1_zeta(particles, 0),
+                        ParticlesData_getp1_weight(particles, 0), q0_coulomb,
+                        ParticlesData_getp1_state(particles, 0),
+                        x0, y0, z0, dx, dy, dz, nx, ny, nz,
+                        n_private_grids, private_grids, grid1d);
+}
+
+
+/*gpufun*/ void p2m_rectmesh2d_line_density_one_particle(
+        // INPUTS:
+        const double x,
+        const double y,
+        const double z,
+          // particle weight
+        const double pwei,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+        // OUTPUTS:
+          // transverse charge density (nx * ny) and line density (nz)
+        /*gpuglmem*/ double *grid2d,
+        /*gpuglmem*/ double *line_density
+) {
+
+    // Factorized deposition: the transverse charge density (C/m^2) and the
+    // longitudinal line density (C/m) are deposited separately, with four
+    // and two additions respectively. The particles outside the 3D grid are
+    // not deposited, as in p2m_rectmesh3d_one_particle.
+
+    // indices
+    int jx = floor((x - x0) / dx);
+    int ix = floor((y - y0) / dy);
+    int kx = floor((z - z0) / dz);
+
+    if (jx >= 0 && jx < nx - 1 && ix >= 0 && ix < ny - 1
+        	    && kx >= 0 && kx < nz - 1)
+    {
+        // normalized distances
+        double ux = (x - (x0 + jx * dx)) / dx;
+        double uy = (y - (y0 + ix * dy)) / dy;
+        double uz = (z - (z0 + kx * dz)) / dz;
+
+        double pwei_xy = pwei / (dx * dy);
+        double pwei_z = pwei / dz;
+
+        atomicAdd(&grid2d[jx   + ix*nx],     pwei_xy * (1.-ux) * (1.-uy));
+        atomicAdd(&grid2d[jx+1 + ix*nx],     pwei_xy * ux      * (1.-uy));
+        atomicAdd(&grid2d[jx   + (ix+1)*nx], pwei_xy * (1.-ux) * uy);
+        atomicAdd(&grid2d[jx+1 + (ix+1)*nx], pwei_xy * ux      * uy);
+
+        atomicAdd(&line_density[kx],   pwei_z * (1.-uz));
+        atomicAdd(&line_density[kx+1], pwei_z * uz);
+    }
+
+}
+
+/*gpukern*/ void p2m_rectmesh2d_line_density(
+        // INPUTS:
+          // length of x, y, z arrays
+        const int nparticles,
+          // particle positions
+        /*gpuglmem*/ const double* x,
+        /*gpuglmem*/ const double* y,
+        /*gpuglmem*/ const double* z,
+          // particle weights and stat flags
+        /*gpuglmem*/ const double* part_weights,
+        /*gpuglmem*/ const int64_t* part_state,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+        // OUTPUTS:
+        /*gpuglmem*/ double* grid2d,
+        /*gpuglmem*/ double* line_density){
+
+    #pragma omp parallel for //only_for_context cpu_openmp
+    for (int pidx=0; pidx<nparticles; pidx++){ //vectorize_over pidx nparticles
+        if (part_state[pidx] > 0){
+            p2m_rectmesh2d_line_density_one_particle(
+                                x[pidx], y[pidx], z[pidx], part_weights[pidx],
+                                x0, y0, z0, dx, dy, dz, nx, ny, nz,
+                                grid2d, line_density);
+        }
+    }//end_vectorize
+}
+
+/*gpukern*/ void p2m_rectmesh2d_line_density_xparticles(
+        // INPUTS:
+          // length of x, y, z arrays
+        const int nparticles,
+        ParticlesData particles,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+        // OUTPUTS:
+        /*gpuglmem*/ double* grid2d,
+        /*gpuglmem*/ double* line_density){
+
+    /*gpuglmem*/ const double* x = ParticlesData_getp1_x(particles, 0);
+    /*gpuglmem*/ const double* y = ParticlesData_getp1_y(particles, 0);
+    /*gpuglmem*/ const double* z = ParticlesData_getp1_zeta(particles, 0);
+    /*gpuglmem*/ const double* part_weights = ParticlesData_getp1_weight(
+                                                             particles, 0);
+    /*gpuglmem*/ const int64_t* part_state = ParticlesData_getp1_state(
+                                                             particles, 0);
+    // TODO I am forgetting about charge_ratio and mass_ratio
+    const double q0_coulomb = QELEM * ParticlesData_get_q0(particles);
+
+    #pragma omp parallel for //only_for_context cpu_openmp
+    for (int pidx=0; pidx<nparticles; pidx++){ //vectorize_over pidx nparticles
+        if (part_state[pidx] > 0){
+            p2m_rectmesh2d_line_density_one_particle(
+                                x[pidx], y[pidx], z[pidx],
+                                part_weights[pidx] * q0_coulomb,
+                                x0, y0, z0, dx, dy, dz, nx, ny, nz,
+                                grid2d, line_density);
+        }
+    }//end_vectorize
+}
+
 #endif
@@ -6,6 +6,29 @@
 #ifndef XFIELDS_CUBIC_INTERPOLATORS_H
 #define XFIELDS_CUBIC_INTERPOLATORS_H
 
+// Returns the position in phi_taylor (in units of 8 doubles) of the grid
+// point (ix, iy, iz). In the linear layout the x index runs fastest over the
+// whole grid. In the blocked layout the grid is split in bricks of 4x4x4
+// points stored one after the other (x brick index fastest), with the x index
+// fastest within each brick, so that the corners of a cell are close in
+// memory.
+/*gpufun*/
+int64_t TriCubicInterpolatedFieldMap_node_index(
+	TriCubicInterpolatedFieldMapData fmap,
+	   const int64_t ix, const int64_t iy, const int64_t iz){
+
+    const int64_t nx = TriCubicInterpolatedFieldMapData_get_nx(fmap);
+    const int64_t ny = TriCubicInterpolatedFieldMapData_get_ny(fmap);
+
+    if (TriCubicInterpolatedFieldMapData_get_blocked_layout(fmap)){
+        const int64_t nbx = (nx + 3) >> 2;
+        const int64_t nby = (ny + 3) >> 2;
+        const int64_t ibrick = (ix >> 2) + nbx * ( (iy >> 2) + nby * (iz >> 2) );
+        return 64 * ibrick + (ix & 3) + 4 * ( (iy & 3) + 4 * (iz & 3) );
+    }
+    return ix + nx * ( iy + ny * iz );
+}
+
 /*gpufun*/
 void TriCubicInterpolatedFieldMap_construct_b(
 	TriCubicInterpolatedFieldMapData fmap,
@@ -13,26 +36,116 @@ void TriCubicInterpolatedFieldMap_construct_b(
        double* b_vector){
 
     /*gpuglmem*/ double* phi_taylor = TriCubicInterpolatedFieldMapData_getp1_phi_taylor(fmap, 0);
-    // Optimization TODO: change int64 to int for less register pressure?
+
     const int64_t nx = TriCubicInterpolatedFieldMapData_get_nx(fmap);
     const int64_t ny = TriCubicInterpolatedFieldMapData_get_ny(fmap);
 
-    // Optimization TODO: reorganize b_vector to align memory access
-    for(int l = 0; l < 8; l++)
+    // Distances between the corners of the cell along x, y and z
+    int64_t sx = 1;
+    int64_t sy = nx;
+    int64_t sz = nx * ny;
+    if (TriCubicInterpolatedFieldMapData_get_blocked_layout(fmap)){
+        // The next point is in the same brick, unless the cell is on the
+        // upper edge of the brick
+        const int64_t nbx = (nx + 3) >> 2;
+        const int64_t nby = (ny + 3) >> 2;
+        sx = ((ix & 3) == 3) ? 64 - 3 : 1;
+        sy = ((iy & 3) == 3) ? 64 * nbx - 12 : 4;
+        sz = ((iz & 3) == 3) ? 64 * nbx * nby - 48 : 16;
+    }
+
+    // Positions of the eight corners of the cell
+    const int64_t i0 = TriCubicInterpolatedFieldMap_node_index(fmap, ix, iy, iz);
+    int64_t inode[8];
+    for(int m = 0; m < 8; m++)
+    {
+        inode[m] = 8 * (i0 + (m & 1) * sx + ((m >> 1) & 1) * sy
+                           + ((m >> 2) & 1) * sz);
+    }
+
+    // The eight values of each corner are contiguous in phi_taylor
+    if (TriCubicInterpolatedFieldMapData_get_single_precision(fmap)){
+        // Values stored in single precision, the interpolation is performed
+        // in double precision
+        /*gpuglmem*/ float* phi_taylor_f32 =
+            TriCubicInterpolatedFieldMapData_getp1_phi_taylor_f32(fmap, 0);
+        for(int n = 0; n < 8; n++)
+        {
+            for(int l = 0; l < 8; l++)
+            {
+                b_vector[8 * l + n] = (double) phi_taylor_f32[ inode[n] + l ];
+            }
+        }
+        return ;
+    }
+    for(int n = 0; n < 8; n++)
     {
-        const int m = 8 * l;
-        b_vector[m    ] = phi_taylor[ l + 8 * ( (ix    ) + nx * ( (iy    ) + ny * ( (iz    ) ) ) ) ];
-        b_vector[m + 1] = phi_taylor[ l + 8 * ( (ix + 1) + nx * ( (iy    ) + ny * ( (iz    ) ) ) ) ];
-        b_vector[m + 2] = phi_taylor[ l + 8 * ( (ix    ) + nx * ( (iy + 1) + ny * ( (iz    ) ) ) ) ];
-        b_vector[m + 3] = phi_taylor[ l + 8 * ( (ix + 1) + nx * ( (iy + 1) + ny * ( (iz    ) ) ) ) ];
-        b_vector[m + 4] = phi_taylor[ l + 8 * ( (ix    ) + nx * ( (iy    ) + ny * ( (iz + 1) ) ) ) ];
-        b_vector[m + 5] = phi_taylor[ l + 8 * ( (ix + 1) + nx * ( (iy    ) + ny * ( (iz + 1) ) ) ) ];
-        b_vector[m + 6] = phi_taylor[ l + 8 * ( (ix    ) + nx * ( (iy + 1) + ny * ( (iz + 1) ) ) ) ];
-        b_vector[m + 7] = phi_taylor[ l + 8 * ( (ix + 1) + nx * ( (iy + 1) + ny * ( (iz + 1) ) ) ) ];
+        for(int l = 0; l < 8; l++)
+        {
+            b_vector[8 * l + n] = phi_taylor[ inode[n] + l ];
+        }
+    }
+    return ;
+}
+
+// Writes in coefs the 64 coefficients of the tricubic polynomial of the cell
+// (ix, iy, iz). If the coefficients are precomputed they are read from the
+// contiguous block of the cell, otherwise they are built from phi_taylor.
+/*gpufun*/
+void TriCubicInterpolatedFieldMap_get_cell_coefficients(
+	TriCubicInterpolatedFieldMapData fmap,
+	   const int64_t ix, const int64_t iy, const int64_t iz,
+       double* coefs){
+
+    if (TriCubicInterpolatedFieldMapData_get_precomputed_coefficients(fmap)){
+        const int64_t nx = TriCubicInterpolatedFieldMapData_get_nx(fmap);
+        const int64_t ny = TriCubicInterpolatedFieldMapData_get_ny(fmap);
+        const int64_t icell = ix + (nx - 1) * ( iy + (ny - 1) * iz );
+        /*gpuglmem*/ double* cell_coefs =
+            TriCubicInterpolatedFieldMapData_getp1_coefs(fmap, 64 * icell);
+        for(int l = 0; l < 64; l++){
+            coefs[l] = cell_coefs[l];
+        }
+    }
+    else{
+        double b_vector[64];
+        TriCubicInterpolatedFieldMap_construct_b(fmap, ix, iy, iz, b_vector);
+        TriCubicInterpolatedFieldMap_construct_coefficients(b_vector, coefs);
     }
     return ;
 }
 
+// Computes the coefficients of all the cells of the map and stores them in
+// coefs, 64 consecutive doubles per cell with the cells ordered as the grid
+// points (x index fastest).
+/*gpukern*/
+void TriCubicInterpolatedFieldMap_precompute_coefficients(
+	TriCubicInterpolatedFieldMapData fmap,
+	             const int64_t n_cells){
+
+    const int64_t nx = TriCubicInterpolatedFieldMapData_get_nx(fmap);
+    const int64_t ny = TriCubicInterpolatedFieldMapData_get_ny(fmap);
+
+    #pragma omp parallel for //only_for_context cpu_openmp
+    for (int64_t icell=0; icell<n_cells; icell++){ //vectorize_over icell n_cells
+
+        const int64_t ix = icell % (nx - 1);
+        const int64_t iy = (icell / (nx - 1)) % (ny - 1);
+        const int64_t iz = icell / ((nx - 1) * (ny - 1));
+
+        double b_vector[64];
+        double coefs[64];
+        TriCubicInterpolatedFieldMap_construct_b(fmap, ix, iy, iz, b_vector);
+        TriCubicInterpolatedFieldMap_construct_coefficients(b_vector, coefs);
+
+        /*gpuglmem*/ double* cell_coefs =
+            TriCubicInterpolatedFieldMapData_getp1_coefs(fmap, 64 * icell);
+        for(int l = 0; l < 64; l++){
+            cell_coefs[l] = coefs[l];
+        }
+    }//end_vectorize
+}
+
 /*gpufun*/
 int TriCubicInterpolatedFieldMap_interpolate_grad(
 	TriCubicInterpolatedFieldMapData fmap,
@@ -87,11 +200,8 @@ int TriCubicInterpolatedFieldMap_interpolate_grad(
         return 1;                // no need for interpolation
     }
 
-    double b_vector[64];
-    TriCubicInterpolatedFieldMap_construct_b(fmap, ix, iy, iz, b_vector);
-
     double coefs[64];
-    TriCubicInterpolatedFieldMap_construct_coefficients(b_vector, coefs);
+    TriCubicInterpolatedFieldMap_get_cell_coefficients(fmap, ix, iy, iz, coefs);
 
     double x_power[4], y_power[4], z_power[4];
     x_power[0] = 1;
@@ -45,29 +45,39 @@ IndicesAndWeights TriLinearInterpolatedFieldMap_compute_indeces_and_weights(
     	iw.ny = ny;
     	iw.nz = nz;
 
+    	// Multiplications by the inverse cell sizes (divisions in the
+    	// computation of the weights would delay the gather of the field
+    	// values of the following particles)
+    	const double inv_dx = 1. / dx;
+    	const double inv_dy = 1. / dy;
+    	const double inv_dz = 1. / dz;
+
+    	// A map with a single longitudinal cell does not depend on z (2D map)
+    	const int is_2d = (nz == 1);
+
     	// indices
-    	iw.ix = floor((x - x0) / dx);
-    	iw.iy = floor((y - y0) / dy);
-    	iw.iz = floor((z - z0) / dz);
+    	iw.ix = floor((x - x0) * inv_dx);
+    	iw.iy = floor((y - y0) * inv_dy);
+    	iw.iz = is_2d ? 0 : floor((z - z0) * inv_dz);
 
 	
     	if (iw.ix >= 0 && iw.ix < nx - 1 && iw.iy >= 0 && iw.iy < ny - 1
-	    	    && iw.iz >= 0 && iw.iz < nz - 1){
+	    	    && (is_2d || (iw.iz >= 0 && iw.iz < nz - 1))){
 
-    	    // distances
-    	    const double dxi = x - (x0 + iw.ix * dx);
-    	    const double dyi = y - (y0 + iw.iy * dy);
-    	    const double dzi = z - (z0 + iw.iz * dz);
+    	    // normalized distances
+    	    const double ux = (x - (x0 + iw.ix * dx)) * inv_dx;
+    	    const double uy = (y - (y0 + iw.iy * dy)) * inv_dy;
+    	    const double uz = is_2d ? 0. : (z - (z0 + iw.iz * dz)) * inv_dz;
 	    
     	    // weights
-    	    iw.w000 = (1.-dxi/dx) * (1.-dyi/dy) * (1.-dzi/dz);
-    	    iw.w100 = (dxi/dx)    * (1.-dyi/dy) * (1.-dzi/dz);
-    	    iw.w010 = (1.-dxi/dx) * (dyi/dy)    * (1.-dzi/dz);
-    	    iw.w110 = (dxi/dx)    * (dyi/dy)    * (1.-dzi/dz);
-    	    iw.w001 = (1.-dxi/dx) * (1.-dyi/dy) * (dzi/dz);
-    	    iw.w101 = (dxi/dx)    * (1.-dyi/dy) * (dzi/dz);
-    	    iw.w011 = (1.-dxi/dx) * (dyi/dy)    * (dzi/dz);
-    	    iw.w111 = (dxi/dx)    * (dyi/dy)    * (dzi/dz);
+    	    iw.w000 = (1.-ux) * (1.-uy) * (1.-uz);
+    	    iw.w100 = ux      * (1.-uy) * (1.-uz);
+    	    iw.w010 = (1.-ux) * uy      * (1.-uz);
+    	    iw.w110 = ux      * uy      * (1.-uz);
+    	    iw.w001 = (1.-ux) * (1.-uy) * uz;
+    	    iw.w101 = ux      * (1.-uy) * uz;
+    	    iw.w011 = (1.-ux) * uy      * uz;
+    	    iw.w111 = ux      * uy      * uz;
 	}
 	else{
             iw.ix = -999; 
@@ -79,30 +89,151 @@ IndicesAndWeights TriLinearInterpolatedFieldMap_compute_indeces_and_weights(
 }	
 
 /*gpufun*/
-double TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(
+double TriLinearInterpolatedFieldMap_interpolate_3d_map_strided(
 	/*gpuglmem*/ const double* map,
+	   const int64_t stride,
 	   const IndicesAndWeights iw){
-	
+
+    // The values at consecutive grid points are stride doubles apart
+
     double val;
 
     if (iw.ix < 0){
 	 val = 0.;
     }
     else{
-	val = 
-    	       iw.w000 * map[iw.ix   + (iw.iy  ) * iw.nx + (iw.iz  ) * iw.nx * iw.ny]
-    	     + iw.w100 * map[iw.ix+1 + (iw.iy  ) * iw.nx + (iw.iz  ) * iw.nx * iw.ny]
-    	     + iw.w010 * map[iw.ix+  + (iw.iy+1) * iw.nx + (iw.iz  ) * iw.nx * iw.ny]
-    	     + iw.w110 * map[iw.ix+1 + (iw.iy+1) * iw.nx + (iw.iz  ) * iw.nx * iw.ny]
-    	     + iw.w001 * map[iw.ix   + (iw.iy  ) * iw.nx + (iw.iz+1) * iw.nx * iw.ny]
-    	     + iw.w101 * map[iw.ix+1 + (iw.iy  ) * iw.nx + (iw.iz+1) * iw.nx * iw.ny]
-    	     + iw.w011 * map[iw.ix+  + (iw.iy+1) * iw.nx + (iw.iz+1) * iw.nx * iw.ny]
-    	     + iw.w111 * map[iw.ix+1 + (iw.iy+1) * iw.nx + (iw.iz+1) * iw.nx * iw.ny];
+	const int64_t i000 = iw.ix + iw.iy * iw.nx + iw.iz * iw.nx * iw.ny;
+	const int64_t sy = iw.nx;
+	// For 2D maps the weights of the upper corners are zero
+	const int64_t sz = (iw.nz > 1) ? iw.nx * iw.ny : 0;
+	val =
+    	       iw.w000 * map[stride * (i000               )]
+    	     + iw.w100 * map[stride * (i000 + 1           )]
+    	     + iw.w010 * map[stride * (i000     + sy      )]
+    	     + iw.w110 * map[stride * (i000 + 1 + sy      )]
+    	     + iw.w001 * map[stride * (i000          + sz )]
+    	     + iw.w101 * map[stride * (i000 + 1      + sz )]
+    	     + iw.w011 * map[stride * (i000     + sy + sz )]
+    	     + iw.w111 * map[stride * (i000 + 1 + sy + sz )];
     }
 
     return val;
 }
 
+/*gpufun*/
+double TriLinearInterpolatedFieldMap_interpolate_3d_map_strided_f32(
+	/*gpuglmem*/ const float* map,
+	   const int64_t stride,
+	   const IndicesAndWeights iw){
+
+    // Same as TriLinearInterpolatedFieldMap_interpolate_3d_map_strided for
+    // a map stored in single precision (the sum is computed in double
+    // precision)
+
+    double val;
+
+    if (iw.ix < 0){
+	 val = 0.;
+    }
+    else{
+	const int64_t i000 = iw.ix + iw.iy * iw.nx + iw.iz * iw.nx * iw.ny;
+	const int64_t sy = iw.nx;
+	// For 2D maps the weights of the upper corners are zero
+	const int64_t sz = (iw.nz > 1) ? iw.nx * iw.ny : 0;
+	val =
+    	       iw.w000 * (double) map[stride * (i000               )]
+    	     + iw.w100 * (double) map[stride * (i000 + 1           )]
+    	     + iw.w010 * (double) map[stride * (i000     + sy      )]
+    	     + iw.w110 * (double) map[stride * (i000 + 1 + sy      )]
+    	     + iw.w001 * (double) map[stride * (i000          + sz )]
+    	     + iw.w101 * (double) map[stride * (i000 + 1      + sz )]
+    	     + iw.w011 * (double) map[stride * (i000     + sy + sz )]
+    	     + iw.w111 * (double) map[stride * (i000 + 1 + sy + sz )];
+    }
+
+    return val;
+}
+
+/*gpufun*/
+double TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(
+	/*gpuglmem*/ const double* map,
+	   const IndicesAndWeights iw){
+
+    return TriLinearInterpolatedFieldMap_interpolate_3d_map_strided(
+                                                                map, 1, iw);
+}
+
+/*gpufun*/
+void TriLinearInterpolatedFieldMap_interpolate_3d_map_packed_gradient(
+	/*gpuglmem*/ const double* map,
+	   const IndicesAndWeights iw,
+	   double* dphi_dx, double* dphi_dy){
+
+    // The horizontal and vertical derivatives of each grid point are
+    // contiguous, hence the two corners along x of the cell are four
+    // contiguous doubles, which are gathered once for both derivatives
+
+    if (iw.ix < 0){
+        *dphi_dx = 0.;
+        *dphi_dy = 0.;
+        return;
+    }
+
+    const int64_t i000 = iw.ix + iw.iy * iw.nx + iw.iz * iw.nx * iw.ny;
+    const int64_t sy = iw.nx;
+    // For 2D maps the weights of the upper corners are zero
+    const int64_t sz = (iw.nz > 1) ? iw.nx * iw.ny : 0;
+
+    /*gpuglmem*/ const double* n000 = map + 2 * i000;
+    /*gpuglmem*/ const double* n010 = n000 + 2 * sy;
+    /*gpuglmem*/ const double* n001 = n000 + 2 * sz;
+    /*gpuglmem*/ const double* n011 = n000 + 2 * (sy + sz);
+
+    *dphi_dx = iw.w000 * n000[0] + iw.w100 * n000[2]
+             + iw.w010 * n010[0] + iw.w110 * n010[2]
+             + iw.w001 * n001[0] + iw.w101 * n001[2]
+             + iw.w011 * n011[0] + iw.w111 * n011[2];
+    *dphi_dy = iw.w000 * n000[1] + iw.w100 * n000[3]
+             + iw.w010 * n010[1] + iw.w110 * n010[3]
+             + iw.w001 * n001[1] + iw.w101 * n001[3]
+             + iw.w011 * n011[1] + iw.w111 * n011[3];
+}
+
+/*gpufun*/
+void TriLinearInterpolatedFieldMap_interpolate_3d_map_packed_gradient_f32(
+	/*gpuglmem*/ const float* map,
+	   const IndicesAndWeights iw,
+	   double* dphi_dx, double* dphi_dy){
+
+    // Same as TriLinearInterpolatedFieldMap_interpolate_3d_map_packed_gradient
+    // for a map stored in single precision
+
+    if (iw.ix < 0){
+        *dphi_dx = 0.;
+        *dphi_dy = 0.;
+        return;
+    }
+
+    const int64_t i000 = iw.ix + iw.iy * iw.nx + iw.iz * iw.nx * iw.ny;
+    const int64_t sy = iw.nx;
+    // For 2D maps the weights of the upper corners are zero
+    const int64_t sz = (iw.nz > 1) ? iw.nx * iw.ny : 0;
+
+    /*gpuglmem*/ const float* n000 = map + 2 * i000;
+    /*gpuglmem*/ const float* n010 = n000 + 2 * sy;
+    /*gpuglmem*/ const float* n001 = n000 + 2 * sz;
+    /*gpuglmem*/ const float* n011 = n000 + 2 * (sy + sz);
+
+    *dphi_dx = iw.w000 * (double) n000[0] + iw.w100 * (double) n000[2]
+             + iw.w010 * (double) n010[0] + iw.w110 * (double) n010[2]
+             + iw.w001 * (double) n001[0] + iw.w101 * (double) n001[2]
+             + iw.w011 * (double) n011[0] + iw.w111 * (double) n011[2];
+    *dphi_dy = iw.w000 * (double) n000[1] + iw.w100 * (double) n000[3]
+             + iw.w010 * (double) n010[1] + iw.w110 * (double) n010[3]
+             + iw.w001 * (double) n001[1] + iw.w101 * (double) n001[3]
+             + iw.w011 * (double) n011[1] + iw.w111 * (double) n011[3];
+}
+
 /*gpukern*/
 void TriLinearInterpolatedFieldMap_interpolate_3d_map_vector(
     TriLinearInterpolatedFieldMapData  fmap,
@@ -113,6 +244,8 @@ void TriLinearInterpolatedFieldMap_interpolate_3d_map_vector(
                         const int64_t  n_quantities,
            /*gpuglmem*/ const int8_t*  buffer_mesh_quantities,
            /*gpuglmem*/ const int64_t* offsets_mesh_quantities,
+           /*gpuglmem*/ const int64_t* strides_mesh_quantities,
+           /*gpuglmem*/ const int64_t* single_precision_mesh_quantities,
            /*gpuglmem*/       double*  particles_quantities) {
 
     #pragma omp parallel for //only_for_context cpu_openmp 
@@ -122,10 +255,18 @@ void TriLinearInterpolatedFieldMap_interpolate_3d_map_vector(
 		TriLinearInterpolatedFieldMap_compute_indeces_and_weights(
 	                                      fmap, x[pidx], y[pidx], z[pidx]);
     	for (int iq=0; iq<n_quantities; iq++){
-	    particles_quantities[iq*n_points + pidx] = 
-		TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(
-	           (/*gpuglmem*/ double*)(buffer_mesh_quantities + offsets_mesh_quantities[iq]),
-		   iw);
+	    if (single_precision_mesh_quantities[iq]){
+	        particles_quantities[iq*n_points + pidx] =
+		    TriLinearInterpolatedFieldMap_interpolate_3d_map_strided_f32(
+	               (/*gpuglmem*/ float*)(buffer_mesh_quantities + offsets_mesh_quantities[iq]),
+		       strides_mesh_quantities[iq], iw);
+	    }
+	    else{
+	        particles_quantities[iq*n_points + pidx] =
+		    TriLinearInterpolatedFieldMap_interpolate_3d_map_strided(
+	               (/*gpuglmem*/ double*)(buffer_mesh_quantities + offsets_mesh_quantities[iq]),
+		       strides_mesh_quantities[iq], iw);
+	    }
 	}
     }//end_vectorize
 }
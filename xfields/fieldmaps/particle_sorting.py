@@ -0,0 +1,139 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import numpy as np
+
+import xobjects as xo
+from xpart.particles.particles import LAST_INVALID_STATE
+
+
+class ParticleSorter:
+
+    """
+    Sorts the particles by cell of the grid of a field map, so that the
+    charge deposition and the field interpolation access the grid memory
+    nearly sequentially. The particle arrays are reordered in place, hence
+    the ordering is used by all the elements tracking the particles (e.g.
+    several space-charge or electron-cloud kicks in a turn). The active
+    particles are placed first, followed by the lost ones, as done by
+    ``xpart.Particles.reorganize``.
+
+    The sorter can be inserted in a line as a collective element (for
+    example before the first of a set of space-charge or electron-cloud
+    elements) or passed to :class:`SpaceCharge3D`, which uses it before
+    each kick. The particles are sorted at most once per turn, and only every
+    ``sort_every_n_turns`` turns, as the cell of the particles changes slowly
+    from turn to turn.
+
+    Args:
+        fieldmap (TriLinearInterpolatedFieldMap or
+            TriCubicInterpolatedFieldMap): Field map defining the grid. The
+            cells are identified from the ``x``, ``y`` and ``zeta``
+            coordinates of the particles.
+        sort_every_n_turns (int): Number of turns between two sorts. The
+            default is ``1``.
+    Returns:
+        (ParticleSorter): Particle sorter object.
+    """
+
+    iscollective = True
+
+    def __init__(self, fieldmap, sort_every_n_turns=1):
+        self.fieldmap = fieldmap
+        self.sort_every_n_turns = sort_every_n_turns
+        self._last_sorted_turn = None
+
+    def track(self, particles):
+
+        """
+        Sorts the particles if they were not sorted in the last
+        ``sort_every_n_turns`` turns.
+
+        Args:
+            particles (xpart.Particles): Particles to be sorted.
+        """
+
+        nplike = particles._buffer.context.nplike_lib
+        mask_active = particles.state > 0
+        if not nplike.any(mask_active):
+            return
+        at_turn = int(nplike.max(particles.at_turn[mask_active]))
+
+        if (self._last_sorted_turn is not None
+                and 0 <= at_turn - self._last_sorted_turn
+                        < self.sort_every_n_turns):
+            return
+
+        self.sort(particles)
+        self._last_sorted_turn = at_turn
+
+    def get_permutation(self, particles):
+
+        """
+        Returns the permutation that sorts the particles by cell (active
+        particles first, then lost particles and unused slots), without
+        reordering them.
+
+        Args:
+            particles (xpart.Particles): Particles to be sorted.
+        Returns:
+            (int64 array): Permutation of the particle indices.
+        """
+
+        context = particles._buffer.context
+        if isinstance(context, xo.ContextPyopencl):
+            raise NotImplementedError(
+                    'Particle sorting is not available on pyopencl contexts')
+        nplike = context.nplike_lib
+
+        fmap = self.fieldmap
+        nx, ny, nz = fmap.nx, fmap.ny, fmap.nz
+        n_cells = nx * ny * nz
+
+        cell_index = 0
+        for coord, grid, dd, nn, stride in [
+                (particles.x, fmap.x_grid, fmap.dx, nx, 1),
+                (particles.y, fmap.y_grid, fmap.dy, ny, nx),
+                (particles.zeta, fmap.z_grid, fmap.dz, nz, nx * ny)]:
+            ii = nplike.floor((coord - grid[0]) / dd)
+            ii = nplike.clip(ii, 0, nn - 1).astype(np.int64)
+            cell_index = cell_index + stride * ii
+
+        state = particles.state
+        sort_key = nplike.where(state > 0, cell_index, n_cells)
+        sort_key[state <= LAST_INVALID_STATE] = n_cells + 1
+
+        return nplike.argsort(sort_key, kind='stable')
+
+    def sort(self, particles):
+
+        """
+        Reorders in place the particle arrays by cell.
+
+        Args:
+            particles (xpart.Particles): Particles to be sorted.
+        """
+
+        if particles.lost_particles_are_hidden:
+            restore_hidden = True
+            particles.unhide_lost_particles()
+        else:
+            restore_hidden = False
+
+        permutation = self.get_permutation(particles)
+
+        with particles._bypass_linked_vars():
+            for tt, nn in particles._structure['per_particle_vars']:
+                vv = getattr(particles, nn)
+                vv[:] = vv[permutation]
+
+        if isinstance(particles._buffer.context, xo.ContextCpu):
+            state = particles.state
+            particles._num_active_particles = int(np.sum(state > 0))
+            particles._num_lost_particles = int(np.sum(
+                    (state < 1) & (state > LAST_INVALID_STATE)))
+
+        if restore_hidden:
+            particles.hide_lost_particles(_assume_reorganized=True)
@@ -8,22 +8,29 @@ import numpy as np
 import xobjects as xo
 import xpart as xp
 
-from .interpolated import _configure_grid
+from .interpolated import _configure_grid, _get_work_array
 from ..general import _pkg_root
 
 _TriCubicInterpolatedFieldMap_kernels = {
-    'central_diff': xo.Kernel(
+    'central_diff_3d': xo.Kernel(
         args=[
-            xo.Arg(xo.Int32,   pointer=False, name='nelem'),
-            xo.Arg(xo.Int32,   pointer=False, name='row_size'),
-            xo.Arg(xo.Int32,   pointer=False, name='stride_in_dbl'),
-            xo.Arg(xo.Float64, pointer=False, name='factor'),
+            xo.Arg(xo.Int32,   pointer=False, name='nrows'),
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Float64, pointer=False, name='fx'),
+            xo.Arg(xo.Float64, pointer=False, name='fy'),
+            xo.Arg(xo.Float64, pointer=False, name='fz'),
+            xo.Arg(xo.Int32,   pointer=False, name='in_stride'),
+            xo.Arg(xo.Int32,   pointer=False, name='out_stride'),
             xo.Arg(xo.Int8,    pointer=True,  name='matrix_buffer'),
             xo.Arg(xo.Int64,   pointer=False, name='matrix_offset'),
             xo.Arg(xo.Int8,    pointer=True,  name='res_buffer'),
-            xo.Arg(xo.Int64,   pointer=False, name='res_offset'),
+            xo.Arg(xo.Int64,   pointer=False, name='res_x_offset'),
+            xo.Arg(xo.Int64,   pointer=False, name='res_y_offset'),
+            xo.Arg(xo.Int64,   pointer=False, name='res_z_offset'),
             ],
-        n_threads='nelem'
+        n_threads='nrows'
         ),
     'p2m_rectmesh3d_xparticles': xo.Kernel(
         args=[
@@ -65,6 +72,13 @@ _TriCubicInterpolatedFieldMap_kernels = {
             ],
         n_threads='nparticles'
         ),
+    'TriCubicInterpolatedFieldMap_precompute_coefficients': xo.Kernel(
+        args=[
+            xo.Arg(xo.ThisClass, pointer=False, name='fmap'),
+            xo.Arg(xo.Int64,   pointer=False, name='n_cells'),
+            ],
+        n_threads='n_cells'
+        ),
     }
 
 
@@ -129,6 +143,32 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
             (1.,1.,1.).
         updatable (bool): If ``True`` the field map can be updated after
             creation. Default is ``True``.
+        precompute_coefficients (bool): If ``True`` the 64 coefficients of
+            the interpolating polynomial of each cell are computed once and
+            stored contiguously, instead of being rebuilt from ``phi_taylor``
+            at each interpolation. This speeds up the tracking at the cost of
+            eight times the memory of ``phi_taylor``. The coefficients are
+            refreshed by ``update_phi``; if ``phi_taylor`` is modified
+            directly, ``update_coefficients`` needs to be called. The default
+            is ``False``.
+        phi_taylor_layout (str): Memory layout of ``phi_taylor``. With
+            ``linear`` the grid points are stored with the x index running
+            fastest over the whole grid. With ``blocked`` the grid is split in
+            bricks of 4x4x4 points stored contiguously, so that the corners of
+            a cell are close in memory, which can reduce the cache and TLB
+            misses of the interpolation for maps much larger than the caches.
+            The grid is padded to a multiple of 4 points along each
+            direction. In both cases the values of
+            ``phi_taylor`` can be set with ``update_phi_taylor`` and retrieved
+            with ``get_phi_taylor``. The default is ``linear``.
+        phi_taylor_dtype (str or np.dtype): Type used to store
+            ``phi_taylor``, either ``float64`` or ``float32``. In single
+            precision the memory needed by the map is halved, while the
+            interpolation is still performed in double precision. The
+            derivatives computed by ``update_phi`` are rounded after being
+            computed in double precision. The error on the interpolated
+            gradient is of the order of the rounding error of the potential
+            divided by the cell size. The default is ``float64``.
     Returns:
         (TriCubicInterpolatedFieldMap): Interpolator object.
     """
@@ -147,6 +187,11 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
         'dy': xo.Float64,
         'dz': xo.Float64,
         'phi_taylor': xo.Float64[:],
+        'single_precision': xo.Int64,
+        'phi_taylor_f32': xo.Float32[:],
+        'blocked_layout': xo.Int64,
+        'precomputed_coefficients': xo.Int64,
+        'coefs': xo.Float64[:],
     }
 
     # I add undescores in front of the names so that I can define custom
@@ -181,6 +226,9 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
                  phi_taylor=None,
                  scale_coordinates_in_solver=(1.,1.,1.),
                  updatable=True,
+                 precompute_coefficients=False,
+                 phi_taylor_layout='linear',
+                 phi_taylor_dtype='float64',
                  ):
 
         if _xobject is not None:
@@ -195,7 +243,29 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
         self._y_grid = _configure_grid('y', y_grid, dy, y_range, ny)
         self._z_grid = _configure_grid('z', z_grid, dz, z_range, nz)
 
-        nelem = self.nx*self.ny*self.nz*8
+        if phi_taylor_layout not in ('linear', 'blocked'):
+            raise ValueError(
+                    f'phi_taylor_layout {phi_taylor_layout} not recognized')
+        blocked_layout = phi_taylor_layout == 'blocked'
+        if blocked_layout and isinstance(_context, xo.ContextPyopencl):
+            raise NotImplementedError(
+                    'The blocked layout is not available on OpenCL contexts')
+
+        phi_taylor_dtype = np.dtype(phi_taylor_dtype)
+        if phi_taylor_dtype not in (np.float64, np.float32):
+            raise ValueError(
+                    f'phi_taylor_dtype {phi_taylor_dtype} not supported')
+        single_precision = phi_taylor_dtype == np.float32
+
+        if blocked_layout:
+            nelem = 8 * 64 * ((self.nx + 3)//4) * ((self.ny + 3)//4) \
+                      * ((self.nz + 3)//4)
+        else:
+            nelem = self.nx*self.ny*self.nz*8
+        if precompute_coefficients:
+            n_coefs = 64 * (self.nx - 1) * (self.ny - 1) * (self.nz - 1)
+        else:
+            n_coefs = 0
         self.xoinitialize(
                  _context=_context,
                  _buffer=_buffer,
@@ -212,13 +282,19 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
                  mirror_x = mirror_x,
                  mirror_y = mirror_y,
                  mirror_z = mirror_z,
-                 phi_taylor = nelem
+                 # Only the array of the selected type is allocated
+                 phi_taylor = 0 if single_precision else nelem,
+                 single_precision = int(single_precision),
+                 phi_taylor_f32 = nelem if single_precision else 0,
+                 blocked_layout = int(blocked_layout),
+                 precomputed_coefficients = int(precompute_coefficients),
+                 coefs = n_coefs,
                  )
 
         self.compile_kernels(only_if_needed=True)
 
         if phi_taylor is not None:
-            self.phi_taylor = phi_taylor
+            self.update_phi_taylor(phi_taylor)
         else:
             # Set rho
             if rho is not None:
@@ -231,6 +307,22 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
                 if solver is not None and rho is not None:
                     self.update_phi_from_rho()
 
+    @classmethod
+    def _from_buffer_image(cls, buffer, offset):
+        '''
+        Builds a field map on the memory image stored in ``buffer`` at
+        ``offset`` (as written by ``save_fieldmaps``), without copying it.
+        '''
+        xobject = cls._XoStruct._from_buffer(buffer=buffer, offset=offset)
+        self = cls(_xobject=xobject)
+        self.updatable = True
+        self.scale_coordinates_in_solver = (1., 1., 1.)
+        self._x_grid = self._x_min + self._dx*np.arange(self._nx)
+        self._y_grid = self._y_min + self._dy*np.arange(self._ny)
+        self._z_grid = self._z_min + self._dz*np.arange(self._nz)
+        self.compile_kernels(only_if_needed=True)
+        return self
+
     def _assert_updatable(self):
         assert self.updatable, 'This FieldMap is not updatable!'
 
@@ -337,11 +429,12 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
     def update_phi(self, phi, reset=True, force=False):
 
         """
-        Updates the potential on the grid. The stored derivatives are also
-        updated.
+        Updates the potential on the grid. The normalized derivatives stored
+        in ``phi_taylor`` are computed by central differences (they are set
+        to zero on the boundaries of the grid).
 
         Args:
-            rho (float64 array): Potential at the grid points.
+            phi (float64 array): Potential at the grid points.
             reset (bool): If ``True`` the stored potential is overwritten
                 with the provided one. If ``False`` the provided potential
                 is added to the stored one. The default is ``True``.
@@ -352,48 +445,187 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
         if not force:
             self._assert_updatable()
 
-        if reset:
-            self.phi.T[:,:,:] = phi.T
-        else:
+        if not reset:
             raise ValueError('Not implemented!')
 
         context = self._buffer.context
 
-        # Compute gradient
-        context.kernels.central_diff(
-                nelem = self.phi.size,
-                row_size = self.nx,
-                stride_in_dbl = self.phi.strides[0]/8,
-                factor = 1/(2*self.dx),
-                matrix_buffer = self._xobject.phi._buffer.buffer,
-                matrix_offset = (self._xobject.phi._offset
-                               + self._xobject.phi._data_offset),
-                res_buffer = self._xobject.dphi_dx._buffer.buffer,
-                res_offset = (self._xobject.dphi_dx._offset
-                            + self._xobject.dphi_dx._data_offset))
-        context.kernels.central_diff(
-                nelem = self.phi.size,
-                row_size = self.ny,
-                stride_in_dbl = self.phi.strides[1]/8,
-                factor = 1/(2*self.dy),
-                matrix_buffer = self._xobject.phi._buffer.buffer,
-                matrix_offset = (self._xobject.phi._offset
-                               + self._xobject.phi._data_offset),
-                res_buffer = self._xobject.dphi_dy._buffer.buffer,
-                res_offset = (self._xobject.dphi_dy._offset
-                            + self._xobject.dphi_dy._data_offset))
-        context.kernels.central_diff(
-                nelem = self.phi.size,
-                row_size = self.nz,
-                stride_in_dbl = self.phi.strides[2]/8,
-                factor = 1/(2*self.dz),
-                matrix_buffer = self._xobject.phi._buffer.buffer,
-                matrix_offset = (self._xobject.phi._offset
-                               + self._xobject.phi._data_offset),
-                res_buffer = self._xobject.dphi_dz._buffer.buffer,
-                res_offset = (self._xobject.dphi_dz._offset
-                            + self._xobject.dphi_dz._data_offset))
+        # The derivatives are computed in the linear layout and in double
+        # precision, in a work array (allocated at the first update and
+        # reused) for the blocked layout and for single precision
+        xobj = self._xobject
+        use_work = (self.phi_taylor_layout == 'blocked'
+                    or self.phi_taylor_dtype == np.float32)
+        if use_work:
+            work = _get_work_array(self, '_phi_taylor_work',
+                                   8*self.nx*self.ny*self.nz)
+            work_buffer = work.view(np.int8)
+            offset = 0
+        else:
+            work = self._phi_taylor
+            work_buffer = xobj.phi_taylor._buffer.buffer
+            offset = xobj.phi_taylor._offset + xobj.phi_taylor._data_offset
+
+        # phi_taylor has shape (8, nx, ny, nz) in Fortran order
+        phi_taylor = work.reshape((8, self.nx, self.ny, self.nz), order='F')
+        phi_taylor[0, :, :, :] = phi
+
+        # The derivatives along each direction are normalized with the cell
+        # size, the mixed derivatives are obtained by differentiating the
+        # first derivatives
+        for i_in, i_out_x, i_out_y, i_out_z in [(0, 1, 2, 3),
+                                                (1, None, 4, 5),
+                                                (2, None, None, 6),
+                                                (4, None, None, 7)]:
+            context.kernels.central_diff_3d(
+                nrows = self.ny * self.nz,
+                nx = self.nx, ny = self.ny, nz = self.nz,
+                fx = 0.5, fy = 0.5, fz = 0.5,
+                in_stride = 8, out_stride = 8,
+                matrix_buffer = work_buffer,
+                matrix_offset = offset + 8 * i_in,
+                res_buffer = work_buffer,
+                res_x_offset = -1 if i_out_x is None else offset + 8*i_out_x,
+                res_y_offset = -1 if i_out_y is None else offset + 8*i_out_y,
+                res_z_offset = -1 if i_out_z is None else offset + 8*i_out_z)
+
+        if self.phi_taylor_layout == 'blocked':
+            self._set_blocked_phi_taylor(work)
+        elif use_work:
+            self._phi_taylor_storage[:] = work
+
+        self.update_coefficients()
+
+    def update_phi_taylor(self, phi_taylor, iz_start=0,
+                          refresh_coefficients=True):
+
+        """
+        Sets the normalized potential and its derivatives at the grid points
+        (see the ``phi_taylor`` argument of the constructor), for the whole
+        grid or for a range of longitudinal grid points.
+
+        Args:
+            phi_taylor (float64 array): Values with shape (nx, ny, n, 8), with
+                n the number of longitudinal grid points to be set.
+            iz_start (int): Index of the first longitudinal grid point to be
+                set. The default is ``0``.
+            refresh_coefficients (bool): If ``True`` the precomputed
+                coefficients (if any) are updated. It can be set to
+                ``False`` when the map is set in several steps, calling
+                ``update_coefficients`` at the end. The default is ``True``.
+        """
+
+        context = self._buffer.context
+
+        n_planes = phi_taylor.shape[2]
+        assert phi_taylor.shape == (self.nx, self.ny, n_planes, 8)
+        assert iz_start + n_planes <= self.nz
+
+        # Values in the order of the linear layout
+        values = context.nparray_to_context_array(
+                phi_taylor.transpose(3, 0, 1, 2).flatten(order='F'))
+
+        if self.phi_taylor_layout == 'blocked':
+            self._set_blocked_phi_taylor(values, iz_start)
+        else:
+            i_start = 8 * self.nx * self.ny * iz_start
+            self._phi_taylor_storage[i_start:i_start + len(values)] = values
+
+        if refresh_coefficients:
+            self.update_coefficients()
 
+    def get_phi_taylor(self):
+
+        """
+        Returns the normalized potential and its derivatives at the grid
+        points, with shape (nx, ny, nz, 8) independently of the layout, with
+        the type used to store them.
+        """
+
+        if self.phi_taylor_layout == 'blocked':
+            values = self._get_blocked_phi_taylor()
+        else:
+            values = self._phi_taylor_storage
+        return values.reshape((8, self.nx, self.ny, self.nz),
+                              order='F').transpose(1, 2, 3, 0)
+
+    def _brick_layers(self, iz_start, n_planes):
+
+        # Ranges of longitudinal grid points (iz_start, n_planes) belonging
+        # to the same layer of bricks, in which the blocked layout is
+        # scattered or gathered, so that the index arrays only cover a few
+        # planes
+
+        iz = iz_start
+        while iz < iz_start + n_planes:
+            n_layer = min(4 - iz % 4, iz_start + n_planes - iz)
+            yield iz, n_layer
+            iz += n_layer
+
+    def _set_blocked_phi_taylor(self, values, iz_start=0):
+
+        # Sets the values of the longitudinal grid points from iz_start,
+        # given in the order of the linear layout
+
+        plane_size = 8 * self.nx * self.ny
+        n_planes = len(values) // plane_size
+        for iz, n_layer in self._brick_layers(iz_start, n_planes):
+            i_start = (iz - iz_start) * plane_size
+            i_end = i_start + n_layer * plane_size
+            positions = self._phi_taylor_positions(iz, n_layer)
+            self._phi_taylor_storage[positions] = values[i_start:i_end]
+
+    def _get_blocked_phi_taylor(self):
+
+        # Values of all the grid points in the order of the linear layout
+
+        storage = self._phi_taylor_storage
+        plane_size = 8 * self.nx * self.ny
+        values = self._buffer.context.zeros(plane_size * self.nz,
+                                            dtype=storage.dtype)
+        for iz, n_layer in self._brick_layers(0, self.nz):
+            i_start = iz * plane_size
+            i_end = i_start + n_layer * plane_size
+            positions = self._phi_taylor_positions(iz, n_layer)
+            values[i_start:i_end] = storage[positions]
+        return values
+
+    def _phi_taylor_positions(self, iz_start=0, n_planes=None):
+
+        # Positions in phi_taylor of the values of the longitudinal grid
+        # points from iz_start to iz_start + n_planes, in the order of the
+        # linear layout. The brick size needs to match the one in
+        # cubic_interpolators.h
+
+        if n_planes is None:
+            n_planes = self.nz - iz_start
+        nbx = (self.nx + 3) // 4
+        nby = (self.ny + 3) // 4
+
+        ll = np.arange(8)[:, None, None, None]
+        ix = np.arange(self.nx)[None, :, None, None]
+        iy = np.arange(self.ny)[None, None, :, None]
+        iz = np.arange(iz_start, iz_start + n_planes)[None, None, None, :]
+        ibrick = (ix // 4) + nbx * ((iy // 4) + nby * (iz // 4))
+        inode = 64 * ibrick + (ix % 4) + 4 * ((iy % 4) + 4 * (iz % 4))
+        positions = (8 * inode + ll).flatten(order='F')
+
+        return self._buffer.context.nparray_to_context_array(positions)
+
+    def update_coefficients(self):
+
+        """
+        Recomputes the precomputed coefficients of the interpolating
+        polynomials from ``phi_taylor``. It has no effect if the map was
+        created with ``precompute_coefficients=False``.
+        """
+
+        if not self.precompute_coefficients:
+            return
+
+        context = self._buffer.context
+        context.kernels.TriCubicInterpolatedFieldMap_precompute_coefficients(
+                fmap=self._xobject, n_cells=self._n_cells)
 
     def update_phi_from_rho(self, solver=None):
 
@@ -518,4 +750,34 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
         """
         return self.z_grid[1] - self.z_grid[0]
 
+    @property
+    def precompute_coefficients(self):
+        """
+        ``True`` if the coefficients of the interpolating polynomials are
+        precomputed.
+        """
+        return bool(self._precomputed_coefficients)
+
+    @property
+    def _n_cells(self):
+        return (self._nx - 1) * (self._ny - 1) * (self._nz - 1)
+
+    @property
+    def phi_taylor_layout(self):
+        """
+        Memory layout of ``phi_taylor`` (``linear`` or ``blocked``).
+        """
+        return 'blocked' if self._blocked_layout else 'linear'
+
+    @property
+    def phi_taylor_dtype(self):
+        """
+        Type used to store ``phi_taylor``.
+        """
+        return np.dtype(np.float32 if self._single_precision else np.float64)
 
+    @property
+    def _phi_taylor_storage(self):
+        if self._single_precision:
+            return self._phi_taylor_f32
+        return self._phi_taylor
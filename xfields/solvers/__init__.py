@@ -3,4 +3,12 @@
 # Copyright (c) CERN, 2021.                   #
 # ########################################### #
 
-from .fftsolvers import FFTSolver3D, FFTSolver2p5D
\ No newline at end of file
+from .fftsolvers import FFTSolver2D, FFTSolver3D, FFTSolver2p5D
+from .fftsolvers import FFTSolver2p5DSliced
+from .multigrid import MultigridSolver3D, MultigridSolver2p5D
+from .multigrid import elliptical_chamber_mask, rectangular_chamber_mask
+from .green_function_cache import GreenFunctionCache
+from .green_function_cache import default_green_function_cache
+from .green_function_cache import GreenFunctionDiskCache
+from .fft_padding import FFTShapeTuner, fft_shape_tuner, next_smooth_size
+from .fft_backends import FFTBackendCpu
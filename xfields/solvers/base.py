@@ -8,6 +8,10 @@ from abc import ABC, abstractmethod
 
 class Solver(ABC):
 
+    # Solvers that can write the potential into a provided array
+    # (``solve(rho, phi_out=...)``) set this to ``True``
+    supports_phi_out = False
+
     @abstractmethod
     def __init__(self, context=None, **kwargs):
         pass
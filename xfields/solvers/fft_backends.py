@@ -0,0 +1,202 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import os
+
+import numpy as np
+import scipy.fft
+
+try:
+    import pyfftw
+    pyfftw_available = True
+except ImportError:
+    pyfftw_available = False
+
+
+class FFTBackendCpu:
+
+    '''
+    FFT backend for the solvers on CPU contexts. By default the solvers use
+    the plans of the context, which on CPU are executed by numpy on a single
+    thread; a backend allows using a multithreaded FFT library instead.
+    The plans are kept by the backend and reused by all the solvers using
+    it, for any array having the same shape, type and layout.
+
+    Args:
+        library (str): FFT library. Accepted values are ``numpy`` (single
+            threaded), ``scipy`` (pocketfft with ``n_threads`` workers) and
+            ``pyfftw`` (FFTW, requires the ``pyfftw`` package). The default
+            is ``scipy``.
+        n_threads (int): Number of threads used by each transform. If
+            ``None`` all the available cores are used. The default is
+            ``None``.
+        planner_effort (str): Planner flag used by FFTW to build the plans
+            (``FFTW_ESTIMATE``, ``FFTW_MEASURE``, ``FFTW_PATIENT`` or
+            ``FFTW_EXHAUSTIVE``). The plans are built once per array shape.
+            The default is ``FFTW_MEASURE``.
+    Returns:
+        (FFTBackendCpu): FFT backend object.
+    '''
+
+    def __init__(self, library='scipy', n_threads=None,
+                 planner_effort='FFTW_MEASURE'):
+
+        if library not in ('numpy', 'scipy', 'pyfftw'):
+            raise ValueError(f'FFT library {library} not recognized')
+        if library == 'pyfftw' and not pyfftw_available:
+            raise ImportError('The pyfftw package is needed to use the '
+                              'pyfftw FFT backend')
+
+        if n_threads is None:
+            n_threads = os.cpu_count() or 1
+        if library == 'numpy':
+            n_threads = 1
+
+        self.library = library
+        self.n_threads = int(n_threads)
+        self.planner_effort = planner_effort
+        self._plans = {}
+
+    @property
+    def config(self):
+        '''
+        Tuple identifying the configuration of the backend.
+        '''
+        return (self.library, self.n_threads, self.planner_effort)
+
+    def plan(self, data, axes, rfft=False):
+
+        '''
+        Returns a plan for the FFT of arrays like ``data`` along ``axes``,
+        reusing a previously built one if available. Complex plans transform
+        in place (``transform(data)``, ``itransform(data)``), real-to-complex
+        plans map a real array onto the non-redundant half of its spectrum
+        and back (``transform(data, out)``, ``itransform(data, out)``, see
+        :class:`RFFTPlanCpu`).
+
+        Args:
+            data (np.ndarray): Array having the shape, type and layout for
+                which the FFT needs to be planned (real for ``rfft``).
+            axes (sequence of ints): Axes along which the FFT needs to be
+                performed.
+            rfft (bool): If ``True`` a real-to-complex plan is returned.
+        Returns:
+            (FFTPlanBackendCpu): FFT plan object.
+        '''
+
+        axes = tuple(axes)
+        key = (data.shape, data.strides, np.dtype(data.dtype), axes, rfft)
+        if key not in self._plans:
+            self._plans[key] = FFTPlanBackendCpu(self, data, axes, rfft)
+        return self._plans[key]
+
+    def fftn(self, data, axes, rfft=False):
+
+        '''
+        Returns the FFT of ``data`` along ``axes`` (only the non-redundant
+        half of the spectrum if ``rfft`` is ``True``), without building a
+        persistent plan.
+        '''
+
+        if rfft:
+            return scipy.fft.rfftn(data, axes=axes, workers=self.n_threads)
+        return scipy.fft.fftn(data, axes=axes, workers=self.n_threads)
+
+
+class FFTPlanBackendCpu:
+
+    '''
+    FFT plan generated by :class:`FFTBackendCpu`. The plan is not bound to
+    an array, it can be executed on any array having the shape, type and
+    layout for which it was built.
+    '''
+
+    def __init__(self, backend, data, axes, rfft):
+
+        self.library = backend.library
+        self.n_threads = backend.n_threads
+        self.axes = axes
+        self.rfft = rfft
+        self.shape = data.shape
+        self._s = tuple(data.shape[aa] for aa in axes)
+
+        spectrum_shape = list(data.shape)
+        if rfft:
+            spectrum_shape[axes[-1]] = data.shape[axes[-1]]//2 + 1
+        self.spectrum_shape = tuple(spectrum_shape)
+
+        if self.library == 'pyfftw':
+            # The plans are built on temporary arrays, as the planner
+            # overwrites them, and executed on the arrays passed at each call
+            # (the plans accept any alignment, as the arrays of the context
+            # buffers are not necessarily SIMD aligned, so that they are not
+            # copied)
+            flags = (backend.planner_effort, 'FFTW_UNALIGNED')
+            if rfft:
+                real = pyfftw.empty_aligned(data.shape, dtype=np.float64,
+                                            order='F')
+                spectrum = pyfftw.empty_aligned(self.spectrum_shape,
+                                                dtype=np.complex128, order='F')
+                self._fftw = pyfftw.FFTW(real, spectrum, axes=axes,
+                        direction='FFTW_FORWARD', flags=flags,
+                        threads=self.n_threads)
+                self._ifftw = pyfftw.FFTW(spectrum, real, axes=axes,
+                        direction='FFTW_BACKWARD', flags=flags,
+                        threads=self.n_threads)
+            else:
+                work = pyfftw.empty_aligned(data.shape, dtype=np.complex128,
+                                            order='F')
+                self._fftw = pyfftw.FFTW(work, work, axes=axes,
+                        direction='FFTW_FORWARD', flags=flags,
+                        threads=self.n_threads)
+                self._ifftw = pyfftw.FFTW(work, work, axes=axes,
+                        direction='FFTW_BACKWARD', flags=flags,
+                        threads=self.n_threads)
+
+    def transform(self, data, out=None):
+        if self.rfft:
+            self._execute(False, data, out)
+        else:
+            self._execute(False, data, data)
+
+    def itransform(self, data, out=None):
+        if self.rfft:
+            self._execute(True, data, out)
+        else:
+            self._execute(True, data, data)
+
+    def _execute(self, inverse, data, out):
+
+        if self.library == 'pyfftw':
+            fftw = self._ifftw if inverse else self._fftw
+            try:
+                res = fftw(data, out, normalise_idft=True)
+            except ValueError:
+                # The arrays do not have the alignment of the plan, the
+                # internal arrays are used
+                res = fftw(data, normalise_idft=True)
+            if res is not out:
+                out[...] = res
+            return
+
+        if self.library == 'numpy':
+            if self.rfft:
+                res = (np.fft.irfftn(data, s=self._s, axes=self.axes)
+                       if inverse else np.fft.rfftn(data, axes=self.axes))
+            else:
+                res = (np.fft.ifftn(data, axes=self.axes)
+                       if inverse else np.fft.fftn(data, axes=self.axes))
+        else:
+            kwargs = dict(axes=self.axes, workers=self.n_threads)
+            if self.rfft:
+                res = (scipy.fft.irfftn(data, s=self._s, **kwargs)
+                       if inverse else scipy.fft.rfftn(data, **kwargs))
+            else:
+                # The input is a workspace, it can be overwritten
+                res = (scipy.fft.ifftn(data, overwrite_x=True, **kwargs)
+                       if inverse else
+                       scipy.fft.fftn(data, overwrite_x=True, **kwargs))
+        if res is not out:
+            out[...] = res
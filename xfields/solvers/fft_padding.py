@@ -0,0 +1,192 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import itertools
+import time
+
+import numpy as np
+
+import xobjects as xo
+
+
+def next_smooth_size(n):
+
+    '''
+    Returns the smallest 2,3,5-smooth integer (i.e. of the form
+    2^a * 3^b * 5^c) not smaller than ``n``. FFTs of these sizes are
+    efficient with all the FFT libraries used by the contexts.
+
+    Args:
+        n (int): Minimum size.
+    Returns:
+        (int): Smooth size.
+    '''
+
+    n = int(n)
+    if n <= 1:
+        return 1
+
+    best = None
+    p5 = 1
+    while p5 < 2*n:
+        p35 = p5
+        while p35 < 2*n:
+            # Smallest power of two bringing p35 above n
+            size = p35
+            while size < n:
+                size *= 2
+            if best is None or size < best:
+                best = size
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+class FFTShapeTuner:
+
+    '''
+    Chooses the padded shape of the FFTs of the solvers among a set of
+    candidate sizes for each transformed axis, by timing a forward and an
+    inverse transform for each combination of candidates. The choice is
+    cached per context and set of candidates, hence the timing is performed
+    only once per grid.
+
+    Args:
+        n_repetitions (int): Number of timed transforms for each candidate
+            shape (the fastest is retained). The default is ``2``.
+    Returns:
+        (FFTShapeTuner): Tuner object.
+    '''
+
+    def __init__(self, n_repetitions=2):
+        self.n_repetitions = n_repetitions
+        self._choices = {}
+
+    def __len__(self):
+        return len(self._choices)
+
+    def clear(self):
+        '''
+        Removes all the cached choices.
+        '''
+        self._choices.clear()
+
+    def tune(self, context, candidates, rfft=False, fft_backend=None):
+
+        '''
+        Returns the fastest combination of candidate sizes, timing the
+        transforms if the choice is not cached.
+
+        Args:
+            context (XfContext): Context on which the transforms are
+                performed.
+            candidates (sequence of sequences of ints): Candidate sizes for
+                each transformed axis.
+            rfft (bool): If ``True`` real-to-complex transforms are timed.
+            fft_backend (FFTBackendCpu): If provided, the transforms of this
+                backend are timed instead of those of the context.
+        Returns:
+            (tuple): Chosen size for each transformed axis.
+        '''
+
+        candidates = tuple(tuple(sorted(set(cc))) for cc in candidates)
+        backend_config = None if fft_backend is None else fft_backend.config
+        key = (context, candidates, rfft, backend_config)
+        if key not in self._choices:
+            self._choices[key] = self._time_candidates(
+                                    context, candidates, rfft, fft_backend)
+        return self._choices[key]
+
+    def _time_candidates(self, context, candidates, rfft, fft_backend):
+
+        # Avoids circular imports
+        from .fftsolvers import _plan_fft
+
+        shapes = list(itertools.product(*candidates))
+        if len(shapes) == 1:
+            return shapes[0]
+
+        axes = tuple(range(len(candidates)))
+        timings = []
+        for shape in shapes:
+            if rfft:
+                data = context.zeros(shape, dtype=np.float64, order='F')
+                plan = _plan_fft(context, data, axes=axes, rfft=True,
+                                 fft_backend=fft_backend)
+                spectrum = context.zeros(plan.spectrum_shape,
+                                         dtype=np.complex128, order='F')
+                def run():
+                    plan.transform(data, out=spectrum)
+                    plan.itransform(spectrum, out=data)
+            else:
+                data = context.zeros(shape, dtype=np.complex128, order='F')
+                plan = _plan_fft(context, data, axes=axes, rfft=False,
+                                 fft_backend=fft_backend)
+                def run():
+                    plan.transform(data)
+                    plan.itransform(data)
+
+            run() # warm up (plan creation)
+            t_best = np.inf
+            for _ in range(self.n_repetitions):
+                t1 = time.perf_counter()
+                run()
+                _synchronize(context)
+                t_best = min(t_best, time.perf_counter() - t1)
+            timings.append(t_best)
+
+        return shapes[int(np.argmin(timings))]
+
+
+fft_shape_tuner = FFTShapeTuner()
+
+
+def get_fft_shape(context, nn, axes, fft_padding='minimal', rfft=False,
+                  fft_backend=None):
+
+    '''
+    Returns the shape of the FFT workspace of a solver.
+
+    Args:
+        context (XfContext): Context of the solver.
+        nn (tuple): Number of cells along each axis of the workspace.
+        axes (tuple): Transformed axes, which are padded to at least twice
+            their number of cells (free-space convolution).
+        fft_padding (str): ``minimal`` pads the transformed axes to exactly
+            twice their number of cells, ``smooth`` to the next 2,3,5-smooth
+            size and ``autotune`` chooses between the two by timing the
+            transforms (see :class:`FFTShapeTuner`).
+        rfft (bool): If ``True`` the solver uses real-to-complex transforms.
+        fft_backend (FFTBackendCpu): FFT backend of the solver, if any.
+    Returns:
+        (tuple): Shape of the workspace.
+    '''
+
+    if fft_padding not in ('minimal', 'smooth', 'autotune'):
+        raise ValueError(f'fft_padding {fft_padding} not recognized')
+
+    shape = list(nn)
+    if fft_padding == 'autotune':
+        # The axes that are not transformed do not change the choice
+        chosen = fft_shape_tuner.tune(context,
+                [(2*nn[aa], next_smooth_size(2*nn[aa])) for aa in axes],
+                rfft=rfft, fft_backend=fft_backend)
+        for aa, mm in zip(axes, chosen):
+            shape[aa] = mm
+    else:
+        for aa in axes:
+            shape[aa] = 2*nn[aa]
+            if fft_padding == 'smooth':
+                shape[aa] = next_smooth_size(shape[aa])
+
+    return tuple(shape)
+
+
+def _synchronize(context):
+    if isinstance(context, xo.ContextCupy):
+        import cupy
+        cupy.cuda.get_current_stream().synchronize()
+    elif isinstance(context, xo.ContextPyopencl):
+        context.queue.finish()
@@ -3,19 +3,22 @@
 # Copyright (c) CERN, 2021.                   #
 # ########################################### #
 
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+import scipy.fft
 from scipy.constants import epsilon_0
 from numpy import pi
 
 from .base import Solver
+from .green_function_cache import default_green_function_cache
+from .fft_padding import get_fft_shape
+from .fft_backends import FFTBackendCpu, pyfftw_available
 
+import xobjects as xo
 from xobjects import context_default
 
-class FFTSolver2D(Solver):
-
-    def solve(self, rho):
-        pass
-
 class FFTSolver3D(Solver):
 
     '''
@@ -31,65 +34,129 @@ class FFTSolver3D(Solver):
         dz (float): Longitudinal cell size in meters.
         context (XfContext): identifies the :doc:`context <contexts>`
             on which the computation is executed.
+        rfft (bool): If ``True`` real-to-complex transforms are used, so that
+            only half of the spectrum of rho and of the Green function is
+            computed and stored. Available only on CPU contexts. The default
+            is ``False``.
+        share_workspace (bool): If ``True`` the preallocated workspace is
+            shared with the other solvers having the same grid created with
+            ``share_workspace=True``, hence the potential returned by
+            ``solve`` is overwritten when any of them is called. The default
+            is ``False``.
+        use_green_function_cache (bool): If ``True`` the transformed Green
+            function is taken from (or stored in) the process-wide
+            ``default_green_function_cache`` (and from its on-disk cache,
+            if enabled), so that it is shared with the other solvers having
+            the same grid. The default is ``True``.
+        compact_green_function (bool): If ``True`` only the real, non-redundant
+            octant of the transformed Green function is stored (the Green
+            function is even along each axis, hence so is its transform),
+            which reduces its memory footprint by up to a factor 16. The
+            mirrored octants are applied through views during ``solve``. Not
+            available on pyopencl contexts. The default is ``False``.
+        green_function_memory_budget (int): Maximum size in bytes of the
+            temporary arrays used to build the Green function, which is
+            computed in slabs along z. The default is 256 MB.
+        green_function_n_threads (int): Number of threads used to build the
+            Green function. The default is 1.
+        fft_padding (str): Defines the size of the padded arrays that are
+            transformed. ``minimal`` uses twice the number of cells along
+            each axis, ``smooth`` enlarges it to the next 2,3,5-smooth size
+            (the FFT of sizes having large prime factors can be several
+            times slower) and ``autotune`` times both options once per grid
+            and keeps the fastest (see :class:`FFTShapeTuner`). The larger
+            padding does not change the solution. The default is
+            ``minimal``.
+        fft_backend (FFTBackendCpu): If provided, the FFTs are performed by
+            this backend (e.g. a multithreaded FFT library) instead of the
+            plans of the context. Available only on CPU contexts. The
+            default is ``None``.
     Returns:
         (FFTSolver3D): Poisson solver object.
     '''
 
-    def __init__(self, dx, dy, dz, nx, ny, nz, context=None, fftplan=None):
+    supports_phi_out = True
+
+    def __init__(self, dx, dy, dz, nx, ny, nz, context=None, fftplan=None,
+                 rfft=False, share_workspace=False,
+                 use_green_function_cache=True, compact_green_function=False,
+                 green_function_memory_budget=2**28,
+                 green_function_n_threads=1, fft_padding='minimal',
+                 fft_backend=None):
 
         if context is None:
             context = context_default
 
-        self.context = context
+        if rfft:
+            _assert_rfft_available(context)
 
-        # Prepare arrays
-        workspace_dev = context.nparray_to_context_array(
-                    np.zeros((2*nx, 2*ny, 2*nz), dtype=np.complex128, order='F'))
+        if fft_backend is not None:
+            _assert_fft_backend_available(context)
 
+        if compact_green_function and isinstance(context, xo.ContextPyopencl):
+            raise NotImplementedError(
+                'Compact green functions are not available on pyopencl '
+                'contexts (negative strides are not supported)')
 
-        # Build grid for primitive function
-        xg_F = np.arange(0, nx+2) * dx - dx/2
-        yg_F = np.arange(0, ny+2) * dy - dy/2
-        zg_F = np.arange(0, nz+2) * dz - dz/2
-        XX_F, YY_F, ZZ_F = np.meshgrid(xg_F, yg_F, zg_F, indexing='ij')
-
-        # Compute primitive
-        F_temp = primitive_func_3d(XX_F, YY_F, ZZ_F)
-
-        # Integrated Green Function (I will transform inplace)
-        gint_rep= np.zeros((2*nx, 2*ny, 2*nz), dtype=np.complex128, order='F')
-        gint_rep[:nx+1, :ny+1, :nz+1] = (F_temp[ 1:,  1:,  1:]
-                                       - F_temp[:-1,  1:,  1:]
-                                       - F_temp[ 1:, :-1,  1:]
-                                       + F_temp[:-1, :-1,  1:]
-                                       - F_temp[ 1:,  1:, :-1]
-                                       + F_temp[:-1,  1:, :-1]
-                                       + F_temp[ 1:, :-1, :-1]
-                                       - F_temp[:-1, :-1, :-1])
-
-        # Replicate
-        # To define how to make the replicas I have a look at:
-        # np.abs(np.fft.fftfreq(10))*10
-        # = [0., 1., 2., 3., 4., 5., 4., 3., 2., 1.]
-        gint_rep[nx+1:, :ny+1, :nz+1] = gint_rep[nx-1:0:-1, :ny+1,     :nz+1    ]
-        gint_rep[:nx+1, ny+1:, :nz+1] = gint_rep[:nx+1,     ny-1:0:-1, :nz+1    ]
-        gint_rep[nx+1:, ny+1:, :nz+1] = gint_rep[nx-1:0:-1, ny-1:0:-1, :nz+1    ]
-        gint_rep[:nx+1, :ny+1, nz+1:] = gint_rep[:nx+1,     :ny+1,     nz-1:0:-1]
-        gint_rep[nx+1:, :ny+1, nz+1:] = gint_rep[nx-1:0:-1, :ny+1,     nz-1:0:-1]
-        gint_rep[:nx+1, ny+1:, nz+1:] = gint_rep[:nx+1,     ny-1:0:-1, nz-1:0:-1]
-        gint_rep[nx+1:, ny+1:, nz+1:] = gint_rep[nx-1:0:-1, ny-1:0:-1, nz-1:0:-1]
+        self.context = context
+        self.rfft = rfft
+        self.compact_green_function = compact_green_function
+        self.green_function_memory_budget = green_function_memory_budget
+        self.green_function_n_threads = green_function_n_threads
+        self.fft_backend = fft_backend
 
-        self._gint_rep = gint_rep.copy()
+        fft_shape = get_fft_shape(context, (nx, ny, nz), axes=(0, 1, 2),
+                                  fft_padding=fft_padding, rfft=rfft,
+                                  fft_backend=fft_backend)
+        if compact_green_function and fft_shape != (2*nx, 2*ny, 2*nz):
+            # The octant of the transform is computed as a type-I DCT
+            raise ValueError('Compact green functions require the minimal '
+                             'FFT padding')
 
-        # Tranasfer to device
-        gint_rep_dev = context.nparray_to_context_array(gint_rep)
+        # Prepare arrays
+        if rfft:
+            dtype_workspace = np.float64
+        else:
+            dtype_workspace = np.complex128
+        workspace_dev = _get_workspace(context, fft_shape,
+                                       dtype_workspace, share_workspace)
 
         # Prepare fft plan
         if fftplan is None:
-            fftplan = context.plan_FFT(workspace_dev, axes=(0,1,2))
+            fftplan = _plan_fft(context, workspace_dev, axes=(0,1,2),
+                                rfft=rfft, fft_backend=fft_backend)
+        else:
+            _check_fftplan(fftplan, workspace_dev)
+
+        if rfft:
+            spectrum_dev = _get_workspace(context, fftplan.spectrum_shape,
+                                          np.complex128, share_workspace)
+        else:
+            spectrum_dev = None
 
-        # Transform the green function (in place)
-        fftplan.transform(gint_rep_dev)
+        # Solvers with the same grid share the transformed green function
+        if compact_green_function:
+            # Does not depend on the fft mode
+            cache_key = ('FFTSolver3D', dx, dy, dz, nx, ny, nz, 'compact')
+        else:
+            cache_key = ('FFTSolver3D', dx, dy, dz, nx, ny, nz, rfft)
+            if fft_shape != (2*nx, 2*ny, 2*nz):
+                cache_key += (fft_shape,)
+        gint_rep_dev = None
+        if use_green_function_cache:
+            gint_rep_dev = default_green_function_cache.get(context,
+                                                            cache_key)
+
+        if gint_rep_dev is None:
+            if compact_green_function:
+                gint_rep_dev = self._compute_gint_octant_transf(
+                                                    dx, dy, dz, nx, ny, nz)
+            else:
+                gint_rep_dev = self._compute_gint_rep_transf(
+                        dx, dy, dz, nx, ny, nz, fftplan, workspace_dev)
+            if use_green_function_cache:
+                default_green_function_cache.put(context, cache_key,
+                                                 gint_rep_dev)
 
         self.dx = dx
         self.dy = dy
@@ -97,43 +164,250 @@ class FFTSolver3D(Solver):
         self.nx = nx
         self.ny = ny
         self.nz = nz
+        self.fft_padding = fft_padding
+        self.fft_shape = fft_shape
+        self.share_workspace = share_workspace
         self._workspace_dev = workspace_dev
+        self._spectrum_dev = spectrum_dev
+        self._batch_workspaces = {}
         self._gint_rep_transf_dev = gint_rep_dev
         self.fftplan = fftplan
+        self._fft_axes = (0, 1, 2)
+
+    def _compute_gint_octant_transf(self, dx, dy, dz, nx, ny, nz):
+
+        # Integrated Green Function (first octant only)
+        gint_octant = integrated_green_function_3d(dx, dy, dz, nx, ny, nz,
+                memory_budget=self.green_function_memory_budget,
+                n_threads=self.green_function_n_threads)
+
+        # The FFT of the replicated (even) green function is real and even,
+        # its first octant is the type-I DCT of the first octant
+        gint_octant_transf = np.asfortranarray(
+                                 scipy.fft.dctn(gint_octant, type=1))
+
+        # Transfer to GPU (if needed)
+        return self.context.nparray_to_context_array(gint_octant_transf)
+
+    def _compute_gint_rep_transf(self, dx, dy, dz, nx, ny, nz, fftplan,
+                                 workspace_dev):
+
+        context = self.context
+        rfft = self.rfft
+
+        # Integrated Green Function (I will transform inplace)
+        gint_rep= np.zeros(workspace_dev.shape, dtype=workspace_dev.dtype,
+                           order='F')
+        integrated_green_function_3d(dx, dy, dz, nx, ny, nz,
+                out=gint_rep[:nx+1, :ny+1, :nz+1],
+                memory_budget=self.green_function_memory_budget,
+                n_threads=self.green_function_n_threads)
+
+        # Replicate
+        # To define how to make the replicas I have a look at:
+        # np.abs(np.fft.fftfreq(10))*10
+        # = [0., 1., 2., 3., 4., 5., 4., 3., 2., 1.]
+        # With a larger padding the distances that are not used (between nx
+        # and mx - nx) are left to zero
+        mx, my, mz = workspace_dev.shape
+        rx, ry, rz = mx-nx+1, my-ny+1, mz-nz+1
+        gint_rep[rx:,   :ny+1, :nz+1] = gint_rep[nx-1:0:-1, :ny+1,     :nz+1    ]
+        gint_rep[:nx+1, ry:,   :nz+1] = gint_rep[:nx+1,     ny-1:0:-1, :nz+1    ]
+        gint_rep[rx:,   ry:,   :nz+1] = gint_rep[nx-1:0:-1, ny-1:0:-1, :nz+1    ]
+        gint_rep[:nx+1, :ny+1, rz:  ] = gint_rep[:nx+1,     :ny+1,     nz-1:0:-1]
+        gint_rep[rx:,   :ny+1, rz:  ] = gint_rep[nx-1:0:-1, :ny+1,     nz-1:0:-1]
+        gint_rep[:nx+1, ry:,   rz:  ] = gint_rep[:nx+1,     ny-1:0:-1, nz-1:0:-1]
+        gint_rep[rx:,   ry:,   rz:  ] = gint_rep[nx-1:0:-1, ny-1:0:-1, nz-1:0:-1]
+
+        if rfft:
+            # Transform the green function (only the non-redundant half)
+            gint_rep_dev = np.zeros(fftplan.spectrum_shape,
+                                    dtype=np.complex128, order='F')
+            fftplan.transform(gint_rep, out=gint_rep_dev)
+        else:
+            # Tranasfer to device (the plan might be bound to the workspace)
+            workspace_dev.T[:, :, :] = context.nparray_to_context_array(
+                                                                  gint_rep.T)
+
+            # Transform the green function (in place)
+            fftplan.transform(workspace_dev)
+            gint_rep_dev = workspace_dev.copy()
+
+        return gint_rep_dev
 
     #@profile
-    def solve(self, rho):
+    def solve(self, rho, phi_out=None):
 
         '''
         Solves Poisson's equation in free space for a given charge density.
+        The computation is performed in the preallocated workspace, hence
+        the returned potential is overwritten by the next call (or by the
+        next call of a solver sharing the same workspace), unless ``phi_out``
+        is provided.
 
         Args:
             rho (float64 array): charge density at the grid points in
                 Coulomb/m^3.
+            phi_out (float64 array): If provided, the potential is written
+                directly from the workspace into this array (e.g. the ``phi``
+                of a field map), which is returned.
         Returns:
             phi (float64 array): electric potential at the grid points in Volts.
         '''
 
-        nz_alloc = self.nz
-        if self._gint_rep_transf_dev.shape[2] > 1:
-            nz_alloc = self._gint_rep_transf_dev.shape[2]
-        _workspace_dev = self.context.zeros(
-                (2*self.nx, 2*self.ny, nz_alloc), dtype=np.complex128, order='F')
+        if self.rfft:
+            return self._solve_rfft(rho, phi_out)
+
+        _workspace_dev = self._workspace_dev
+        self._clear_padding(_workspace_dev)
 
         # The transposes make it faster in cupy (C-contigous arrays)
         _workspace_dev.T[:self.nz, :self.ny, :self.nx] = rho.T
         self.fftplan.transform(_workspace_dev) # rho_rep_hat
 
+        self._multiply_by_gint(_workspace_dev) # phi_rep_hat
+
+        self.fftplan.itransform(_workspace_dev) #phi_rep
+        return _copy_to_phi_out(
+                _workspace_dev.real[:self.nx, :self.ny, :self.nz], phi_out)
+
+    def _solve_rfft(self, rho, phi_out):
+
+        _workspace_dev = self._workspace_dev
+        _spectrum_dev = self._spectrum_dev
+        self._clear_padding(_workspace_dev)
+
+        _workspace_dev.T[:self.nz, :self.ny, :self.nx] = rho.T
+        self.fftplan.transform(_workspace_dev, out=_spectrum_dev) # rho_rep_hat
+
+        self._multiply_by_gint(_spectrum_dev) # phi_rep_hat
+
+        self.fftplan.itransform(_spectrum_dev, out=_workspace_dev) #phi_rep
+        return _copy_to_phi_out(
+                _workspace_dev[:self.nx, :self.ny, :self.nz], phi_out)
+
+    def solve_batch(self, rho_batch, phi_out=None):
+
+        '''
+        Solves Poisson's equation in free space for a batch of charge
+        densities defined on the same grid (e.g. the different bunches of a
+        train), using a single batched FFT and a single multiplication by the
+        Green function. The computation is performed in a preallocated
+        workspace (one for each batch size), hence the returned potentials
+        are overwritten by the next call with the same batch size.
+
+        Args:
+            rho_batch (float64 array or sequence of float64 arrays): charge
+                densities at the grid points in Coulomb/m^3, with shape
+                (n_batch, nx, ny, nz).
+            phi_out (sequence of float64 arrays): If provided, the potentials
+                are written directly from the workspace into these arrays,
+                which are returned.
+        Returns:
+            phi_batch (float64 array): electric potentials at the grid points
+            in Volts, with shape (n_batch, nx, ny, nz).
+        '''
+
+        n_batch = len(rho_batch)
+        workspace, spectrum, fftplan = self._get_batch_workspace(n_batch)
+
+        self._clear_padding(workspace)
+        for ib in range(n_batch):
+            workspace.T[ib, :self.nz, :self.ny, :self.nx] = rho_batch[ib].T
+
+        if self.rfft:
+            fftplan.transform(workspace, out=spectrum) # rho_rep_hat
+            self._multiply_by_gint(spectrum) # phi_rep_hat
+            fftplan.itransform(spectrum, out=workspace) #phi_rep
+            phi = workspace[:self.nx, :self.ny, :self.nz, :]
+        else:
+            fftplan.transform(workspace) # rho_rep_hat
+            self._multiply_by_gint(workspace) # phi_rep_hat
+            fftplan.itransform(workspace) #phi_rep
+            phi = workspace.real[:self.nx, :self.ny, :self.nz, :]
+
+        if phi_out is not None:
+            assert len(phi_out) == n_batch
+            for ib in range(n_batch):
+                _copy_to_phi_out(phi[:, :, :, ib], phi_out[ib])
+            return phi_out
+
+        return phi.transpose(3, 0, 1, 2)
+
+    def _get_batch_workspace(self, n_batch):
+
+        # The batch index is the slowest (last) axis of the workspace, hence
+        # each element of the batch is a contiguous workspace
+        if n_batch not in self._batch_workspaces:
+            context = self.context
+            shape = self._workspace_dev.shape + (n_batch,)
+            workspace = _get_workspace(context, shape,
+                                       self._workspace_dev.dtype,
+                                       self.share_workspace)
+            if isinstance(context, xo.ContextCpu):
+                fftplan = BatchFFTPlanCpu(workspace, axes=self._fft_axes,
+                                          rfft=self.rfft, context=context,
+                                          fft_backend=self.fft_backend)
+            else:
+                fftplan = context.plan_FFT(workspace, axes=self._fft_axes)
+            if self.rfft:
+                spectrum = _get_workspace(context, fftplan.spectrum_shape,
+                                          np.complex128, self.share_workspace)
+            else:
+                spectrum = None
+            self._batch_workspaces[n_batch] = (workspace, spectrum, fftplan)
+
+        return self._batch_workspaces[n_batch]
+
+    def _multiply_by_gint(self, spectrum):
+
+        if self.compact_green_function:
+            self._multiply_by_gint_octant(spectrum)
+            return
+
+        gint = self._gint_rep_transf_dev
+        if spectrum.ndim == 4: # batch
+            gint = gint[..., None]
+
         try:
-            _workspace_dev.T[:,:,:] *= (
-                        self._gint_rep_transf_dev.T) # phi_rep_hat
+            # The transposes make it faster in cupy (C-contigous arrays)
+            spectrum.T[...] *= gint.T
         except Exception: # pyopencl does not support array broadcasting (used in 2.5D)
+            if spectrum.ndim == 4:
+                for ib in range(spectrum.shape[3]):
+                    self._multiply_by_gint(spectrum[:, :, :, ib])
+                return
             for ii in range(self.nz):
-                _workspace_dev.T[ii,:,:] *= (
-                        self._gint_rep_transf_dev.T[0, :, :]) # phi_rep_hat
+                spectrum.T[ii,:,:] *= gint.T[0, :, :]
 
-        self.fftplan.itransform(_workspace_dev) #phi_rep
-        return _workspace_dev.real[:self.nx, :self.ny, :self.nz]
+    def _multiply_by_gint_octant(self, spectrum):
+
+        # The other octants are mirrored copies of the stored one, i.e. for
+        # each axis [0, 1, ..., n, n-1, ..., 1]. In rfft mode the last axis
+        # of the spectrum is already limited to the first n+1 elements.
+        gint = self._gint_rep_transf_dev
+        nx, ny, nz = self.nx, self.ny, self.nz
+
+        def halves(n, n_spectrum):
+            out = [(slice(0, n+1), slice(None))]
+            if n_spectrum > n+1:
+                out.append((slice(n+1, None), slice(n-1, 0, -1)))
+            return out
+
+        for sx, gx in halves(nx, spectrum.shape[0]):
+            for sy, gy in halves(ny, spectrum.shape[1]):
+                for sz, gz in halves(nz, spectrum.shape[2]):
+                    if spectrum.ndim == 4: # batch
+                        spectrum[sx, sy, sz, :] *= gint[gx, gy, gz, None]
+                    else:
+                        spectrum[sx, sy, sz] *= gint[gx, gy, gz]
+
+    def _clear_padding(self, workspace):
+        # The region holding rho is overwritten at each call, only the
+        # padding needs to be cleared
+        workspace.T[..., self.nx:] = 0
+        workspace.T[..., self.ny:, :self.nx] = 0
+        workspace.T[..., self.nz:, :self.ny, :self.nx] = 0
 
 class FFTSolver2p5D(FFTSolver3D):
 
@@ -150,15 +424,111 @@ class FFTSolver2p5D(FFTSolver3D):
         dz (float): Longitudinal cell size in meters.
         context (XfContext): identifies the :doc:`context <contexts>`
             on which the computation is executed.
+        rfft (bool): If ``True`` real-to-complex transforms are used, so that
+            only half of the spectrum of rho and of the Green function is
+            computed and stored. Available only on CPU contexts. The default
+            is ``False``.
+        share_workspace (bool): If ``True`` the preallocated workspace is
+            shared with the other solvers having the same grid created with
+            ``share_workspace=True``, hence the potential returned by
+            ``solve`` is overwritten when any of them is called. The default
+            is ``False``.
+        use_green_function_cache (bool): If ``True`` the transformed Green
+            function is taken from (or stored in) the process-wide
+            ``default_green_function_cache`` (and from its on-disk cache,
+            if enabled), so that it is shared with the other solvers having
+            the same grid. The default is ``True``.
+        fft_padding (str): Defines the size of the padded transverse arrays
+            that are transformed (``minimal``, ``smooth`` or ``autotune``,
+            see :class:`FFTSolver3D`). The default is ``minimal``.
+        fft_backend (FFTBackendCpu): If provided, the FFTs are performed by
+            this backend instead of the plans of the context (see
+            :class:`FFTSolver3D`). The default is ``None``.
     Returns:
         (FFTSolver3D): Poisson solver object.
     '''
 
-    def __init__(self, dx, dy, dz, nx, ny, nz, context=None, fftplan=None):
+    def __init__(self, dx, dy, dz, nx, ny, nz, context=None, fftplan=None,
+                 rfft=False, share_workspace=False,
+                 use_green_function_cache=True, fft_padding='minimal',
+                 fft_backend=None):
 
         if context is None:
             context = context_default
+
+        if rfft:
+            _assert_rfft_available(context)
+
+        if fft_backend is not None:
+            _assert_fft_backend_available(context)
+
         self.context = context
+        self.rfft = rfft
+        self.compact_green_function = False
+        self.fft_backend = fft_backend
+
+        fft_shape = get_fft_shape(context, (nx, ny, nz), axes=(0, 1),
+                                  fft_padding=fft_padding, rfft=rfft,
+                                  fft_backend=fft_backend)
+
+        # Prepare arrays
+        if rfft:
+            dtype_workspace = np.float64
+        else:
+            dtype_workspace = np.complex128
+        workspace_dev = _get_workspace(context, fft_shape,
+                                       dtype_workspace, share_workspace)
+
+        # Prepare fft plan
+        if fftplan is None:
+            fftplan = _plan_fft(context, workspace_dev, axes=(0,1),
+                                rfft=rfft, fft_backend=fft_backend)
+        else:
+            _check_fftplan(fftplan, workspace_dev)
+
+        if rfft:
+            spectrum_dev = _get_workspace(context, fftplan.spectrum_shape,
+                                          np.complex128, share_workspace)
+        else:
+            spectrum_dev = None
+
+        # Solvers with the same transverse grid share the transformed green
+        # function (it does not depend on the longitudinal grid)
+        cache_key = ('FFTSolver2p5D', dx, dy, nx, ny, rfft)
+        if fft_shape[:2] != (2*nx, 2*ny):
+            cache_key += (fft_shape[:2],)
+        gint_rep_transf_dev = None
+        if use_green_function_cache:
+            gint_rep_transf_dev = default_green_function_cache.get(
+                                                        context, cache_key)
+
+        if gint_rep_transf_dev is None:
+            gint_rep_transf_dev = self._compute_gint_rep_transf(
+                                    dx, dy, nx, ny, fft_shape[0], fft_shape[1])
+            if use_green_function_cache:
+                default_green_function_cache.put(context, cache_key,
+                                                 gint_rep_transf_dev)
+
+        self.dx = dx
+        self.dy = dy
+        self.dz = dz
+        self.nx = nx
+        self.ny = ny
+        self.nz = nz
+        self.fft_padding = fft_padding
+        self.fft_shape = fft_shape
+        self.share_workspace = share_workspace
+        self._workspace_dev = workspace_dev
+        self._spectrum_dev = spectrum_dev
+        self._batch_workspaces = {}
+        self._gint_rep_transf_dev = gint_rep_transf_dev
+        self.fftplan = fftplan
+        self._fft_axes = (0, 1)
+
+    def _compute_gint_rep_transf(self, dx, dy, nx, ny, mx, my):
+
+        context = self.context
+        rfft = self.rfft
 
         # Build grid for primitive function
         xg_F = np.arange(0, nx+2) * dx - dx/2
@@ -169,7 +539,10 @@ class FFTSolver2p5D(FFTSolver3D):
         F_temp = primitive_func_2p5d(XX_F, YY_F)
 
         # Integrated Green Function (I will transform inplace)
-        gint_rep= np.zeros((2*nx, 2*ny), dtype=np.complex128, order='F')
+        if rfft:
+            gint_rep= np.zeros((mx, my), dtype=np.float64, order='F')
+        else:
+            gint_rep= np.zeros((mx, my), dtype=np.complex128, order='F')
         gint_rep[:nx+1, :ny+1] = (F_temp[ 1:,  1:]
                                 - F_temp[:-1,  1:]
                                 - F_temp[ 1:, :-1]
@@ -179,33 +552,561 @@ class FFTSolver2p5D(FFTSolver3D):
         # To define how to make the replicas I have a look at:
         # np.abs(np.fft.fftfreq(10))*10
         # = [0., 1., 2., 3., 4., 5., 4., 3., 2., 1.]
-        gint_rep[nx+1:, :ny+1] = gint_rep[nx-1:0:-1, :ny+1]
-        gint_rep[:nx+1, ny+1:] = gint_rep[:nx+1, ny-1:0:-1]
-        gint_rep[nx+1:, ny+1:] = gint_rep[nx-1:0:-1, ny-1:0:-1]
-
-
-        # Prepare fft plan
-        if fftplan is None:
-            temp_dev = context.zeros((2*nx, 2*ny, nz),
-                                    dtype=np.complex128, order='F')
-            fftplan = context.plan_FFT(temp_dev, axes=(0,1))
-            del(temp_dev)
+        # With a larger padding the distances that are not used (between nx
+        # and mx - nx) are left to zero
+        rx, ry = mx-nx+1, my-ny+1
+        gint_rep[rx:, :ny+1] = gint_rep[nx-1:0:-1, :ny+1]
+        gint_rep[:nx+1, ry:] = gint_rep[:nx+1, ny-1:0:-1]
+        gint_rep[rx:, ry:] = gint_rep[nx-1:0:-1, ny-1:0:-1]
 
         # Transform the green function
-        gint_rep_transf = np.fft.fftn(gint_rep, axes=(0,1))
+        if self.fft_backend is not None:
+            gint_rep_transf = self.fft_backend.fftn(gint_rep, axes=(0,1),
+                                                    rfft=rfft)
+        elif rfft:
+            gint_rep_transf = np.fft.rfftn(gint_rep, axes=(0,1))
+        else:
+            gint_rep_transf = np.fft.fftn(gint_rep, axes=(0,1))
 
         # Transfer to GPU (if needed)
         gint_rep_transf_dev = context.nparray_to_context_array(
                                        np.atleast_3d(gint_rep_transf))
 
-        self.dx = dx
-        self.dy = dy
-        self.dz = dz
-        self.nx = nx
-        self.ny = ny
+        return gint_rep_transf_dev
+
+
+class FFTSolver2D(FFTSolver2p5D):
+
+    '''
+    Creates a Poisson solver object that solves the 2D Poisson equation
+    using the FFT method (free space), e.g. for coasting beams. Only the
+    transverse grid is allocated and transformed.
+
+    Args:
+        nx (int): Number of cells in the horizontal direction.
+        ny (int): Number of cells in the vertical direction.
+        dx (float): Horizontal cell size in meters.
+        dy (float): Vertical cell size in meters.
+        context (XfContext): identifies the :doc:`context <contexts>`
+            on which the computation is executed.
+        rfft (bool): If ``True`` real-to-complex transforms are used, so that
+            only half of the spectrum of rho and of the Green function is
+            computed and stored. Available only on CPU contexts. The default
+            is ``False``.
+        share_workspace (bool): If ``True`` the preallocated workspace is
+            shared with the other solvers having the same grid created with
+            ``share_workspace=True``, hence the potential returned by
+            ``solve`` is overwritten when any of them is called. The default
+            is ``False``.
+        use_green_function_cache (bool): If ``True`` the transformed Green
+            function is taken from (or stored in) the process-wide
+            ``default_green_function_cache``. It is the same as for
+            :class:`FFTSolver2p5D` with the same transverse grid. The default
+            is ``True``.
+        fft_padding (str): Defines the size of the padded arrays that are
+            transformed (``minimal``, ``smooth`` or ``autotune``, see
+            :class:`FFTSolver3D`). The default is ``minimal``.
+        fft_backend (FFTBackendCpu): If provided, the FFTs are performed by
+            this backend instead of the plans of the context (see
+            :class:`FFTSolver3D`). The default is ``None``.
+    Returns:
+        (FFTSolver2D): Poisson solver object.
+    '''
+
+    def __init__(self, dx, dy, nx, ny, context=None, fftplan=None,
+                 rfft=False, share_workspace=False,
+                 use_green_function_cache=True, fft_padding='minimal',
+                 fft_backend=None, dz=1., nz=1):
+
+        # dz and nz are accepted for uniformity with the other solvers
+        assert nz == 1, 'FFTSolver2D is defined on a single slice (nz=1)'
+
+        super().__init__(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=1,
+                         context=context, fftplan=fftplan, rfft=rfft,
+                         share_workspace=share_workspace,
+                         use_green_function_cache=use_green_function_cache,
+                         fft_padding=fft_padding, fft_backend=fft_backend)
+
+    def solve(self, rho, phi_out=None):
+
+        '''
+        Solves Poisson's equation in free space for a given charge density.
+        The computation is performed in the preallocated workspace, hence
+        the returned potential is overwritten by the next call, unless
+        ``phi_out`` is provided.
+
+        Args:
+            rho (float64 array): charge density at the grid points in
+                Coulomb/m^3, with shape (nx, ny) or (nx, ny, 1).
+            phi_out (float64 array): If provided, the potential is written
+                directly from the workspace into this array, which is
+                returned.
+        Returns:
+            phi (float64 array): electric potential at the grid points in
+            Volts, with the same shape as ``rho``.
+        '''
+
+        shape_3d = (self.nx, self.ny, 1)
+        if phi_out is not None:
+            super().solve(rho.reshape(shape_3d, order='F'),
+                          phi_out=phi_out.reshape(shape_3d, order='F'))
+            return phi_out
+
+        phi = super().solve(rho.reshape(shape_3d, order='F'))
+        if rho.ndim == 2:
+            phi = phi[:, :, 0]
+        return phi
+
+    def solve_batch(self, rho_batch, phi_out=None):
+
+        '''
+        Solves Poisson's equation in free space for a batch of charge
+        densities defined on the same grid, using a single batched FFT (see
+        :meth:`FFTSolver3D.solve_batch`).
+
+        Args:
+            rho_batch (float64 array or sequence of float64 arrays): charge
+                densities at the grid points in Coulomb/m^3, with shape
+                (n_batch, nx, ny) or (n_batch, nx, ny, 1).
+            phi_out (sequence of float64 arrays): If provided, the potentials
+                are written directly from the workspace into these arrays,
+                which are returned.
+        Returns:
+            phi_batch (float64 array): electric potentials at the grid points
+            in Volts, with the same shape as ``rho_batch``.
+        '''
+
+        shape_3d = (self.nx, self.ny, 1)
+        rho_batch_3d = [rr.reshape(shape_3d, order='F') for rr in rho_batch]
+        if phi_out is not None:
+            super().solve_batch(rho_batch_3d, phi_out=[
+                    pp.reshape(shape_3d, order='F') for pp in phi_out])
+            return phi_out
+
+        phi_batch = super().solve_batch(rho_batch_3d)
+        if rho_batch[0].ndim == 2:
+            phi_batch = phi_batch[:, :, :, 0]
+        return phi_batch
+
+
+class FFTSolver2p5DSliced(FFTSolver2p5D):
+
+    '''
+    Creates a Poisson solver object that solves Poisson's equation in the
+    2.5D approximation using the FFT method (free space), like
+    :class:`FFTSolver2p5D`, but processing the z-slices in small batches
+    (sized to fit in cache) and transforming only the slices having a
+    non-negligible charge. The potential is set to zero in the skipped
+    slices. This is convenient for bunches with long tails, which leave most
+    of the slices empty.
+
+    Args:
+        nx (int): Number of cells in the horizontal direction.
+        ny (int): Number of cells in the vertical direction.
+        nz (int): Number of cells in the longitudinal direction.
+        dx (float): Horizontal cell size in meters.
+        dy (float): Vertical cell size in meters.
+        dz (float): Longitudinal cell size in meters.
+        context (XfContext): identifies the :doc:`context <contexts>`
+            on which the computation is executed. Not available on pyopencl
+            contexts.
+        rfft (bool): If ``True`` real-to-complex transforms are used. Available
+            only on CPU contexts. The default is ``False``.
+        share_workspace (bool): If ``True`` the preallocated workspace is
+            shared with the other solvers having the same grid created with
+            ``share_workspace=True``, hence the potential returned by
+            ``solve`` is overwritten when any of them is called. The default
+            is ``False``.
+        use_green_function_cache (bool): If ``True`` the transformed Green
+            function is shared through the
+            ``default_green_function_cache``. The default is ``True``.
+        n_slices_per_batch (int): Number of slices transformed together. If
+            ``None`` it is chosen such that the batch workspace takes about
+            ``batch_bytes``. The default is ``None``.
+        batch_bytes (int): Target size in bytes of the batch workspace, used
+            if ``n_slices_per_batch`` is ``None``. The default is 4 MB.
+        slice_charge_threshold (float): Slices whose total absolute charge is
+            not larger than this fraction of the largest one are skipped. The
+            default is ``0.``, i.e. only empty slices are skipped.
+        fft_padding (str): Defines the size of the padded transverse arrays
+            that are transformed (``minimal``, ``smooth`` or ``autotune``,
+            see :class:`FFTSolver3D`). The default is ``minimal``.
+        fft_backend (FFTBackendCpu): If provided, the FFTs are performed by
+            this backend instead of the plans of the context (see
+            :class:`FFTSolver3D`). The default is ``None``.
+    Returns:
+        (FFTSolver2p5DSliced): Poisson solver object.
+    '''
+
+    def __init__(self, dx, dy, dz, nx, ny, nz, context=None, fftplan=None,
+                 rfft=False, share_workspace=False,
+                 use_green_function_cache=True,
+                 n_slices_per_batch=None, batch_bytes=2**22,
+                 slice_charge_threshold=0., fft_padding='minimal',
+                 fft_backend=None):
+
+        if context is None:
+            context = context_default
+
+        if isinstance(context, xo.ContextPyopencl):
+            raise NotImplementedError(
+                'FFTSolver2p5DSliced is not available on pyopencl contexts')
+
+        if n_slices_per_batch is None:
+            itemsize = 8 if rfft else 16
+            n_slices_per_batch = batch_bytes // (4 * nx * ny * itemsize)
+        n_slices_per_batch = int(max(1, min(n_slices_per_batch, nz)))
+
+        # The green function does not depend on the longitudinal grid, the
+        # workspace and the plan are built for a single batch of slices (a
+        # plan provided by the user needs to be built for the batch
+        # workspace, e.g. taken from another sliced solver)
+        super().__init__(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny,
+                         nz=n_slices_per_batch, context=context,
+                         fftplan=fftplan, rfft=rfft,
+                         share_workspace=share_workspace,
+                         use_green_function_cache=use_green_function_cache,
+                         fft_padding=fft_padding, fft_backend=fft_backend)
+
         self.nz = nz
-        self._gint_rep_transf_dev = gint_rep_transf_dev
-        self.fftplan = fftplan
+        self.n_slices_per_batch = n_slices_per_batch
+        self.slice_charge_threshold = slice_charge_threshold
+        self._phi_dev = context.zeros((nx, ny, nz), dtype=np.float64,
+                                      order='F')
+
+    def solve(self, rho, phi_out=None):
+
+        '''
+        Solves Poisson's equation in free space for a given charge density.
+        The returned potential is stored in a preallocated array, which is
+        overwritten by the next call, unless ``phi_out`` is provided.
+
+        Args:
+            rho (float64 array): charge density at the grid points in
+                Coulomb/m^3.
+            phi_out (float64 array): If provided, the potential of each slice
+                is written directly from the workspace into this array, which
+                is returned.
+        Returns:
+            phi (float64 array): electric potential at the grid points in Volts.
+        '''
+
+        nx, ny, nb = self.nx, self.ny, self.n_slices_per_batch
+        workspace = self._workspace_dev
+        phi = self._phi_dev if phi_out is None else phi_out
+
+        # Only the (small) array of the slice charges is moved to the host
+        slice_charge = self.context.nparray_from_context_array(
+                                                abs(rho).sum(axis=(0, 1)))
+        active = slice_charge > self.slice_charge_threshold*slice_charge.max()
+        active_slices = np.where(active)[0]
+        for iz in np.where(~active)[0]:
+            phi[:, :, iz] = 0
+
+        for i_start in range(0, len(active_slices), nb):
+            batch = active_slices[i_start:i_start+nb]
+            self._clear_padding(workspace)
+            for ib, iz in enumerate(batch):
+                workspace[:nx, :ny, ib] = rho[:, :, iz]
+
+            if self.rfft:
+                self.fftplan.transform(workspace, out=self._spectrum_dev)
+                self._multiply_by_gint(self._spectrum_dev)
+                self.fftplan.itransform(self._spectrum_dev, out=workspace)
+                phi_batch = workspace
+            else:
+                self.fftplan.transform(workspace)
+                self._multiply_by_gint(workspace)
+                self.fftplan.itransform(workspace)
+                phi_batch = workspace.real
+
+            for ib, iz in enumerate(batch):
+                phi[:, :, iz] = phi_batch[:nx, :ny, ib]
+
+        return phi
+
+    def solve_batch(self, rho_batch, phi_out=None):
+
+        '''
+        Solves Poisson's equation for a batch of charge densities, one after
+        the other (the slices are already processed in batches).
+
+        Args:
+            rho_batch (float64 array or sequence of float64 arrays): charge
+                densities at the grid points in Coulomb/m^3, with shape
+                (n_batch, nx, ny, nz).
+            phi_out (sequence of float64 arrays): If provided, the potentials
+                are written directly into these arrays, which are returned.
+        Returns:
+            phi_batch (float64 array): electric potentials at the grid points
+            in Volts, with shape (n_batch, nx, ny, nz).
+        '''
+
+        n_batch = len(rho_batch)
+        if phi_out is not None:
+            assert len(phi_out) == n_batch
+            for ib in range(n_batch):
+                self.solve(rho_batch[ib], phi_out=phi_out[ib])
+            return phi_out
+
+        if n_batch not in self._batch_workspaces:
+            self._batch_workspaces[n_batch] = self.context.zeros(
+                    (self.nx, self.ny, self.nz, n_batch), dtype=np.float64,
+                    order='F')
+        phi_batch = self._batch_workspaces[n_batch]
+
+        for ib in range(n_batch):
+            phi_batch[:, :, :, ib] = self.solve(rho_batch[ib])
+
+        return phi_batch.transpose(3, 0, 1, 2)
+
+    def _clear_padding(self, workspace):
+        # The slices of the batch are all overwritten, only the transverse
+        # padding needs to be cleared
+        workspace.T[..., self.nx:] = 0
+        workspace.T[..., self.ny:, :self.nx] = 0
+
+
+class RFFTPlanCpu:
+
+    '''
+    Real-to-complex FFT plan for CPU contexts. It mirrors the plans generated
+    by ``context.plan_FFT``, but the transforms cannot be performed in place:
+    the forward transform maps a real array onto the non-redundant half of
+    its spectrum (the last transformed axis is halved) and the inverse
+    transform maps it back. The transforms are executed by an FFT backend
+    (see :class:`FFTBackendCpu`). By default FFTW is used on a single thread
+    if the ``pyfftw`` package is available, which writes the result directly
+    into the output array; otherwise scipy is used, which needs a temporary
+    array for the result.
+
+    Args:
+        data (np.ndarray): Real array having the shape for which the FFT
+            needs to be planned.
+        axes (sequence of ints): Axes along which the FFT needs to be
+            performed.
+        fft_backend (FFTBackendCpu): Backend executing the transforms. If
+            ``None`` the default backend described above is used.
+    Returns:
+        (RFFTPlanCpu): FFT plan object.
+    '''
+
+    def __init__(self, data, axes, fft_backend=None):
+
+        if fft_backend is None:
+            fft_backend = _get_default_rfft_backend()
+
+        self._plan = fft_backend.plan(data, axes=axes, rfft=True)
+        self.axes = self._plan.axes
+        self.shape = self._plan.shape
+        self.spectrum_shape = self._plan.spectrum_shape
+
+    def transform(self, data, out):
+        self._plan.transform(data, out=out)
+
+    def itransform(self, data, out):
+        self._plan.itransform(data, out=out)
+
+
+_default_rfft_backend = None
+
+def _get_default_rfft_backend():
+    global _default_rfft_backend
+    if _default_rfft_backend is None:
+        library = 'pyfftw' if pyfftw_available else 'scipy'
+        # Single threaded, as the plans of the context
+        _default_rfft_backend = FFTBackendCpu(library=library, n_threads=1,
+                                              planner_effort='FFTW_ESTIMATE')
+    return _default_rfft_backend
+
+
+class BatchFFTPlanCpu:
+
+    '''
+    FFT plan for a batch of arrays stacked along the last axis, for CPU
+    contexts. Each element of the batch is transformed separately, which on
+    CPU is faster than a single transform of the whole batch (the temporary
+    arrays of each transform fit better in cache).
+
+    Args:
+        data (np.ndarray): Batch workspace, with the batch along the last axis
+            (the plans are bound to it).
+        axes (sequence of ints): Axes along which the FFT needs to be
+            performed.
+        rfft (bool): If ``True`` real-to-complex transforms are used
+            (see :class:`RFFTPlanCpu`).
+        context (XfContext): CPU context used to generate the complex plans.
+        fft_backend (FFTBackendCpu): If provided, the plans are generated by
+            this backend instead of the context. The default is ``None``.
+    Returns:
+        (BatchFFTPlanCpu): FFT plan object.
+    '''
+
+    def __init__(self, data, axes, rfft, context, fft_backend=None):
+
+        self.rfft = rfft
+        self.data = data
+        self._views = [data[..., ib] for ib in range(data.shape[-1])]
+
+        self._plans = [_plan_fft(context, vv, axes=axes, rfft=rfft,
+                                 fft_backend=fft_backend)
+                       for vv in self._views]
+        if rfft:
+            self.spectrum_shape = (self._plans[0].spectrum_shape
+                                   + (data.shape[-1],))
+
+    def transform(self, data, out=None):
+        self._apply('transform', data, out)
+
+    def itransform(self, data, out=None):
+        self._apply('itransform', data, out)
+
+    def _apply(self, name, data, out):
+        if self.rfft:
+            for ib, plan in enumerate(self._plans):
+                getattr(plan, name)(data[..., ib], out=out[..., ib])
+        else:
+            # In place, the plans might be bound to the views
+            assert data is self.data
+            for vv, plan in zip(self._views, self._plans):
+                getattr(plan, name)(vv)
+
+
+def _copy_to_phi_out(phi, phi_out):
+    # The potential is copied from the workspace only if an output array is
+    # provided, otherwise the view on the workspace is returned
+    if phi_out is None:
+        return phi
+    # The transposes make it faster in cupy (C-contigous arrays)
+    phi_out.T[:, :, :] = phi.T
+    return phi_out
+
+
+# Workspaces are registered with weak references, so that they are released
+# together with the last solver using them
+_workspaces = weakref.WeakValueDictionary()
+
+def _get_workspace(context, shape, dtype, share):
+
+    key = (context, tuple(shape), np.dtype(dtype))
+
+    if not share:
+        return context.zeros(shape, dtype=dtype, order='F')
+
+    workspace = _workspaces.get(key)
+    if workspace is not None:
+        return workspace
+
+    workspace = context.zeros(shape, dtype=dtype, order='F')
+    try:
+        _workspaces.setdefault(key, workspace)
+    except TypeError: # arrays not supporting weak references are not shared
+        pass
+
+    return workspace
+
+
+def _assert_rfft_available(context):
+    if not isinstance(context, xo.ContextCpu):
+        raise NotImplementedError(
+                'Real-to-complex FFTs are available only on CPU contexts')
+
+
+def _assert_fft_backend_available(context):
+    if not isinstance(context, xo.ContextCpu):
+        raise NotImplementedError(
+                'FFT backends are available only on CPU contexts')
+
+
+def _plan_fft(context, data, axes, rfft, fft_backend=None):
+    if fft_backend is not None:
+        return fft_backend.plan(data, axes=axes, rfft=rfft)
+    if rfft:
+        return RFFTPlanCpu(data, axes=axes)
+    plan = context.plan_FFT(data, axes=axes)
+    # Recorded to check the plans passed to other solvers
+    plan.shape = data.shape
+    return plan
+
+
+def _check_fftplan(fftplan, workspace):
+
+    # Plans provided by the user need to be built for the workspace of the
+    # solver (the shape is not known for plans generated directly by the
+    # context, unless they are bound to an array)
+    data = getattr(fftplan, 'data', None)
+    shape = getattr(fftplan, 'shape', None)
+    if shape is None and data is not None:
+        shape = data.shape
+    if shape is not None and tuple(shape) != tuple(workspace.shape):
+        raise ValueError(f'The FFT plan was built for arrays of shape '
+                         f'{tuple(shape)}, the workspace of the solver has '
+                         f'shape {tuple(workspace.shape)}')
+    if data is not None and data is not workspace:
+        raise ValueError('The FFT plan is bound to a different array than '
+                         'the workspace of the solver')
+
+
+def integrated_green_function_3d(dx, dy, dz, nx, ny, nz, out=None,
+                                 memory_budget=2**28, n_threads=1):
+
+    '''
+    Computes the integrated Green function on the first octant of the
+    replicated grid, i.e. at the (nx+1, ny+1, nz+1) grid points with
+    non-negative distance from the origin. The primitive function is
+    evaluated on broadcast 1D grids, in slabs along z, so that the size of
+    the temporary arrays stays within the given budget.
+
+    Args:
+        dx (float): Horizontal cell size in meters.
+        dy (float): Vertical cell size in meters.
+        dz (float): Longitudinal cell size in meters.
+        nx (int): Number of cells in the horizontal direction.
+        ny (int): Number of cells in the vertical direction.
+        nz (int): Number of cells in the longitudinal direction.
+        out (np.ndarray): Array with shape (nx+1, ny+1, nz+1) in which the
+            result is stored. If ``None`` a new float64 array is allocated.
+        memory_budget (int): Maximum size in bytes of the temporary arrays
+            (summed over the threads).
+        n_threads (int): Number of threads over which the slabs are
+            distributed.
+    Returns:
+        (np.ndarray): Integrated Green function.
+    '''
+
+    if out is None:
+        out = np.zeros((nx+1, ny+1, nz+1), dtype=np.float64, order='F')
+    assert out.shape == (nx+1, ny+1, nz+1)
+
+    # Grid for primitive function (broadcast, no meshgrid needed)
+    xg_F = (np.arange(0, nx+2) * dx - dx/2)[:, None, None]
+    yg_F = (np.arange(0, ny+2) * dy - dy/2)[None, :, None]
+    zg_F = (np.arange(0, nz+2) * dz - dz/2)[None, None, :]
+
+    # The primitive and the differences need about 8 temporary arrays having
+    # the size of the slab
+    bytes_per_plane = 8 * 8 * (nx+2) * (ny+2)
+    n_planes = max(1, int(memory_budget // (n_threads * bytes_per_plane)) - 1)
+    slabs = [(iz, min(iz + n_planes, nz+1))
+             for iz in range(0, nz+1, n_planes)]
+
+    def compute_slab(slab):
+        iz_start, iz_end = slab
+        F_temp = primitive_func_3d(xg_F, yg_F, zg_F[:, :, iz_start:iz_end+1])
+        # The integral over each cell is the third order difference of the
+        # primitive along the three axes
+        out[:, :, iz_start:iz_end] = np.diff(np.diff(np.diff(
+                                        F_temp, axis=0), axis=1), axis=2)
+
+    if n_threads > 1 and len(slabs) > 1:
+        # numpy releases the GIL in the ufuncs
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            list(executor.map(compute_slab, slabs))
+    else:
+        for slab in slabs:
+            compute_slab(slab)
+
+    return out
 
 
 def primitive_func_3d(x,y,z):
@@ -0,0 +1,299 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import hashlib
+import json
+import os
+import tempfile
+import weakref
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+import xobjects as xo
+
+
+class GreenFunctionCache:
+
+    '''
+    Process-wide cache of the transformed Green functions used by the FFT
+    solvers, so that solvers defined on the same grid (e.g. many space-charge
+    or electron-cloud elements in a lattice) share a single array instead of
+    recomputing and storing their own.
+
+    The cache only holds weak references to the arrays used by the solvers,
+    which are freed together with the last solver using them. In addition,
+    the most recently used arrays are kept alive by the cache itself (e.g.
+    for solvers that are rebuilt at each step) up to a total size of
+    ``max_bytes``, the least recently used ones are released beyond it.
+
+    Args:
+        max_bytes (int): Maximum total size in bytes of the arrays kept alive
+            by the cache. The default is 64 MB.
+        disk_cache (GreenFunctionDiskCache): Optional on-disk cache, used
+            when an entry is not available in memory and updated when an entry
+            is stored. The default is ``None``.
+    Returns:
+        (GreenFunctionCache): Cache object.
+    '''
+
+    def __init__(self, max_bytes=2**26, disk_cache=None):
+        self.max_bytes = max_bytes
+        self.disk_cache = disk_cache
+        self._entries = OrderedDict()
+        self._refs = weakref.WeakValueDictionary()
+
+    @property
+    def nbytes(self):
+        '''
+        Total size in bytes of the arrays kept alive by the cache.
+        '''
+        return sum(_nbytes(vv) for vv in self._entries.values())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, context, key):
+
+        '''
+        Returns the cached Green function for a given context and key, or
+        ``None`` if it is not available.
+        '''
+
+        kk = (context, key)
+        gint_transf = self._entries.get(kk)
+        if gint_transf is None:
+            # Still used by a solver
+            gint_transf = self._refs.get(kk)
+        if gint_transf is None:
+            if self.disk_cache is None:
+                return None
+            gint_transf = self.disk_cache.load(context, key)
+            if gint_transf is None:
+                return None
+
+        self._put(kk, gint_transf)
+        return gint_transf
+
+    def put(self, context, key, gint_transf):
+
+        '''
+        Stores a Green function for a given context and key, releasing the
+        least recently used entries if needed. Arrays larger than
+        ``max_bytes`` are only weakly referenced.
+        '''
+
+        if self.disk_cache is not None:
+            self.disk_cache.save(context, key, gint_transf)
+
+        self._put((context, key), gint_transf)
+
+    def _put(self, kk, gint_transf):
+
+        try:
+            self._refs[kk] = gint_transf
+        except TypeError: # arrays not supporting weak references
+            pass
+
+        if _nbytes(gint_transf) > self.max_bytes:
+            self._entries.pop(kk, None)
+            return
+
+        self._entries[kk] = gint_transf
+        self._entries.move_to_end(kk)
+        self.evict()
+
+    def evict(self):
+
+        '''
+        Releases the least recently used entries until the total size of the
+        arrays kept alive by the cache is within ``max_bytes``.
+        '''
+
+        while self._entries and self.nbytes > self.max_bytes:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+
+        '''
+        Removes all the entries from the cache.
+        '''
+
+        self._entries.clear()
+        self._refs.clear()
+
+
+class GreenFunctionDiskCache:
+
+    '''
+    On-disk cache of the transformed Green functions, meant to be shared by
+    many jobs using the same grids. Each entry is stored as a ``.npy`` file
+    named after a hash of the solver type and grid parameters, together with
+    a ``.json`` file containing the parameters, the shape and type of the
+    data and a checksum of the data. When an entry is loaded its parameters,
+    shape and type are checked (mismatching entries are discarded), the
+    checksum is verified only if requested, as it requires reading the whole
+    entry. On CPU contexts the entries are memory-mapped. The least recently
+    used entries are removed when the total size exceeds ``max_bytes``.
+
+    The cache is opt-in, it can be enabled with:
+
+    .. code-block:: python
+
+        xf.solvers.default_green_function_cache.disk_cache = (
+            xf.solvers.GreenFunctionDiskCache('/path/to/cache'))
+
+    Args:
+        directory (str or Path): Directory in which the entries are stored.
+            It is created if it does not exist.
+        max_bytes (int): Maximum total size in bytes of the stored entries.
+        verify_checksums (bool): If ``True`` the checksum of each entry is
+            verified when it is loaded (corrupted entries are discarded). The
+            default is ``False``.
+    Returns:
+        (GreenFunctionDiskCache): Cache object.
+    '''
+
+    _format_version = 2
+
+    def __init__(self, directory, max_bytes=16*2**30, verify_checksums=False):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.verify_checksums = verify_checksums
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _paths(self, key):
+        key_repr = repr((self._format_version, key))
+        name = hashlib.sha256(key_repr.encode()).hexdigest()
+        return (key_repr, self.directory / (name + '.npy'),
+                self.directory / (name + '.json'))
+
+    @property
+    def nbytes(self):
+        '''
+        Total size in bytes of the stored entries.
+        '''
+        return sum(ff.stat().st_size for ff in self.directory.glob('*.npy'))
+
+    def load(self, context, key, verify_checksum=None):
+
+        '''
+        Returns the stored Green function for a given key, transferred to the
+        given context, or ``None`` if it is not available or does not pass
+        the integrity checks. If ``verify_checksum`` is ``None`` the checksum
+        is verified according to ``verify_checksums``.
+        '''
+
+        key_repr, fname_data, fname_meta = self._paths(key)
+
+        try:
+            with open(fname_meta, 'r') as fid:
+                meta = json.load(fid)
+            gint_transf = np.load(fname_data, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+
+        if verify_checksum is None:
+            verify_checksum = self.verify_checksums
+
+        if (meta.get('key') != key_repr
+                or meta.get('shape') != list(gint_transf.shape)
+                or meta.get('dtype') != gint_transf.dtype.str
+                or (verify_checksum
+                    and meta.get('sha256') != _sha256(gint_transf))):
+            self._remove(fname_data, fname_meta)
+            return None
+
+        # Mark as recently used
+        os.utime(fname_data)
+
+        if isinstance(context, xo.ContextCpu):
+            return gint_transf
+        return context.nparray_to_context_array(np.array(gint_transf))
+
+    def save(self, context, key, gint_transf):
+
+        '''
+        Stores a Green function for a given key and evicts the least recently
+        used entries if needed.
+        '''
+
+        key_repr, fname_data, fname_meta = self._paths(key)
+
+        gint_transf = context.nparray_from_context_array(gint_transf)
+        meta = {'key': key_repr, 'shape': list(gint_transf.shape),
+                'dtype': gint_transf.dtype.str,
+                'sha256': _sha256(gint_transf)}
+
+        # Written to temporary files and renamed, so that concurrent jobs never
+        # see partially written entries
+        for fname, write in [
+                (fname_data, lambda fid: np.save(fid, gint_transf)),
+                (fname_meta, lambda fid: fid.write(json.dumps(meta).encode()))]:
+            fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as fid:
+                    write(fid)
+                os.replace(tmpname, fname)
+            except BaseException:
+                os.unlink(tmpname)
+                raise
+
+        self.evict()
+
+    def evict(self):
+
+        '''
+        Removes the least recently used entries until the total size is within
+        ``max_bytes``.
+        '''
+
+        entries = []
+        for ff in self.directory.glob('*.npy'):
+            try:
+                stat = ff.stat()
+            except OSError: # removed by another job
+                continue
+            entries.append((stat.st_mtime, stat.st_size, ff))
+        entries.sort()
+
+        nbytes = sum(ee[1] for ee in entries)
+        for _, size, ff in entries:
+            if nbytes <= self.max_bytes:
+                break
+            self._remove(ff, ff.with_suffix('.json'))
+            nbytes -= size
+
+    def clear(self):
+
+        '''
+        Removes all the entries from the cache.
+        '''
+
+        for ff in self.directory.glob('*.npy'):
+            self._remove(ff, ff.with_suffix('.json'))
+
+    @staticmethod
+    def _remove(*fnames):
+        for ff in fnames:
+            try:
+                os.unlink(ff)
+            except OSError:
+                pass
+
+
+def _sha256(array):
+    # Hashed in memory order, to avoid copying memory-mapped arrays
+    if not array.flags.c_contiguous and array.flags.f_contiguous:
+        array = array.T
+    return hashlib.sha256(np.ascontiguousarray(array).data).hexdigest()
+
+
+def _nbytes(array):
+    return array.size * array.dtype.itemsize
+
+
+default_green_function_cache = GreenFunctionCache()
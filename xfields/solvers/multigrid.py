@@ -0,0 +1,359 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+from scipy.constants import epsilon_0
+
+from .base import Solver
+
+import xobjects as xo
+from xobjects import context_default
+
+
+class MultigridSolver3D(Solver):
+
+    '''
+    Creates a Poisson solver object that solves the full 3D Poisson equation
+    with a geometric multigrid method (V-cycles with damped Jacobi smoothing
+    and Galerkin coarse-grid operators). The potential is set to zero one
+    cell outside the grid and at the grid points outside the (optional)
+    chamber mask, i.e. the grid box and the chamber are perfectly
+    conducting.
+
+    The solution of the previous call is used as initial guess (warm start),
+    which is usually close to the new solution when the solver is called
+    turn after turn, hence only a few V-cycles are needed.
+
+    Args:
+        nx (int): Number of cells in the horizontal direction.
+        ny (int): Number of cells in the vertical direction.
+        nz (int): Number of cells in the longitudinal direction.
+        dx (float): Horizontal cell size in meters.
+        dy (float): Vertical cell size in meters.
+        dz (float): Longitudinal cell size in meters.
+        context (XfContext): identifies the :doc:`context <contexts>`
+            on which the computation is executed. Only CPU contexts are
+            supported.
+        chamber_mask (np.ndarray): Boolean array with shape (nx, ny), which
+            is ``True`` at the grid points inside the chamber (see
+            :func:`elliptical_chamber_mask` and
+            :func:`rectangular_chamber_mask`). If ``None`` the chamber is the
+            grid box. The default is ``None``.
+        warm_start (bool): If ``True`` the previous solution is used as
+            initial guess. The default is ``True``.
+        tol (float): Target ratio between the norm of the residual and the
+            norm of the right-hand side. The default is ``1e-6``.
+        max_cycles (int): Maximum number of V-cycles per call. The default is
+            ``50``.
+        n_smooth (int): Number of smoothing iterations before and after the
+            coarse grid correction. The default is ``2``.
+    Returns:
+        (MultigridSolver3D): Poisson solver object.
+    '''
+
+    supports_phi_out = True
+    _laplacian_axes = (0, 1, 2)
+
+    def __init__(self, dx, dy, dz, nx, ny, nz, context=None,
+                 chamber_mask=None, warm_start=True, tol=1e-6, max_cycles=50,
+                 n_smooth=2):
+
+        if context is None:
+            context = context_default
+
+        if not isinstance(context, xo.ContextCpu):
+            raise NotImplementedError(
+                    'Multigrid solvers are available only on CPU contexts')
+
+        self.context = context
+        self.dx = dx
+        self.dy = dy
+        self.dz = dz
+        self.nx = nx
+        self.ny = ny
+        self.nz = nz
+        self.warm_start = warm_start
+        self.tol = tol
+        self.max_cycles = max_cycles
+        self.n_smooth = n_smooth
+
+        mask = np.ones((nx, ny, nz), dtype=bool)
+        if chamber_mask is not None:
+            assert chamber_mask.shape == (nx, ny)
+            mask &= np.asarray(chamber_mask, dtype=bool)[:, :, None]
+
+        self._levels = _build_levels(shape=(nx, ny, nz), h=(dx, dy, dz),
+                                     mask=mask, axes=self._laplacian_axes)
+        self._active = np.where(mask.ravel(order='F'))[0]
+        self._inactive = np.where(~mask.ravel(order='F'))[0]
+
+        self._phi = np.zeros((nx, ny, nz), order='F')
+        self._phi_active = np.zeros(len(self._active))
+        self.n_cycles_last = 0
+
+    #@profile
+    def solve(self, rho, phi_out=None):
+
+        '''
+        Solves Poisson's equation for a given charge density, with the
+        potential set to zero on the boundaries. The returned potential is
+        stored in the solver, unless ``phi_out`` is provided (the unknowns
+        inside the chamber are always kept to warm start the next call).
+
+        Args:
+            rho (float64 array): charge density at the grid points in
+                Coulomb/m^3.
+            phi_out (float64 array): If provided, the potential is written
+                directly into this array, which is returned.
+        Returns:
+            phi (float64 array): electric potential at the grid points in
+                Volts.
+        '''
+
+        level = self._levels[0]
+        phi = self._phi_active
+
+        rhs = np.asarray(rho).ravel(order='F')[self._active] / epsilon_0
+
+        if not self.warm_start:
+            phi[:] = 0
+
+        norm_rhs = np.linalg.norm(rhs)
+        n_cycles = 0
+        if norm_rhs > 0:
+            while n_cycles < self.max_cycles:
+                if (np.linalg.norm(level.residual(phi, rhs))
+                        <= self.tol * norm_rhs):
+                    break
+                _v_cycle(self._levels, 0, phi, rhs, self.n_smooth)
+                n_cycles += 1
+        else:
+            phi[:] = 0
+        self.n_cycles_last = n_cycles
+
+        if phi_out is None:
+            self._phi.ravel(order='F')[self._active] = phi
+            return self._phi
+
+        if phi_out.flags.f_contiguous:
+            # The unknowns are scattered directly into the output array
+            phi_flat = phi_out.ravel(order='F')
+            phi_flat[self._inactive] = 0
+            phi_flat[self._active] = phi
+        else:
+            self._phi.ravel(order='F')[self._active] = phi
+            phi_out[:, :, :] = self._phi
+        return phi_out
+
+
+class MultigridSolver2p5D(MultigridSolver3D):
+
+    '''
+    Creates a Poisson solver object that solves Poisson's equation in the
+    2.5D approximation (independent 2D problems for the different z-slices)
+    with a geometric multigrid method. Boundaries and warm start are as in
+    :class:`MultigridSolver3D`.
+
+    Args:
+        nx (int): Number of cells in the horizontal direction.
+        ny (int): Number of cells in the vertical direction.
+        nz (int): Number of cells in the longitudinal direction.
+        dx (float): Horizontal cell size in meters.
+        dy (float): Vertical cell size in meters.
+        dz (float): Longitudinal cell size in meters.
+        context (XfContext): identifies the :doc:`context <contexts>`
+            on which the computation is executed. Only CPU contexts are
+            supported.
+        chamber_mask (np.ndarray): Boolean array with shape (nx, ny), which
+            is ``True`` at the grid points inside the chamber. If ``None``
+            the chamber is the grid box. The default is ``None``.
+        warm_start (bool): If ``True`` the previous solution is used as
+            initial guess. The default is ``True``.
+        tol (float): Target ratio between the norm of the residual and the
+            norm of the right-hand side. The default is ``1e-6``.
+        max_cycles (int): Maximum number of V-cycles per call. The default is
+            ``50``.
+        n_smooth (int): Number of smoothing iterations before and after the
+            coarse grid correction. The default is ``2``.
+    Returns:
+        (MultigridSolver2p5D): Poisson solver object.
+    '''
+
+    _laplacian_axes = (0, 1)
+
+
+def elliptical_chamber_mask(x_grid, y_grid, a, b, x_center=0., y_center=0.):
+
+    '''
+    Returns the mask of the grid points inside an elliptical chamber, to be
+    used with the multigrid solvers.
+
+    Args:
+        x_grid (np.ndarray): Horizontal grid points.
+        y_grid (np.ndarray): Vertical grid points.
+        a (float): Horizontal semi-axis in meters.
+        b (float): Vertical semi-axis in meters.
+        x_center (float): Horizontal position of the center of the chamber.
+        y_center (float): Vertical position of the center of the chamber.
+    Returns:
+        (np.ndarray): Boolean array with shape (nx, ny).
+    '''
+
+    xx = (np.asarray(x_grid)[:, None] - x_center) / a
+    yy = (np.asarray(y_grid)[None, :] - y_center) / b
+    return xx**2 + yy**2 < 1.
+
+
+def rectangular_chamber_mask(x_grid, y_grid, x_aper, y_aper,
+                             x_center=0., y_center=0.):
+
+    '''
+    Returns the mask of the grid points inside a rectangular chamber, to be
+    used with the multigrid solvers.
+
+    Args:
+        x_grid (np.ndarray): Horizontal grid points.
+        y_grid (np.ndarray): Vertical grid points.
+        x_aper (float): Horizontal half-aperture in meters.
+        y_aper (float): Vertical half-aperture in meters.
+        x_center (float): Horizontal position of the center of the chamber.
+        y_center (float): Vertical position of the center of the chamber.
+    Returns:
+        (np.ndarray): Boolean array with shape (nx, ny).
+    '''
+
+    xx = np.abs(np.asarray(x_grid)[:, None] - x_center)
+    yy = np.abs(np.asarray(y_grid)[None, :] - y_center)
+    return (xx < x_aper) & (yy < y_aper)
+
+
+class _Level:
+
+    # Level of the multigrid hierarchy. The unknowns are the grid points
+    # inside the mask, stored in Fortran order. The operators of the coarse
+    # levels are obtained as P^T A P (Galerkin), which accounts for the
+    # chamber boundary on all levels.
+
+    def __init__(self, lap, omega):
+        self.lap = scipy.sparse.csr_matrix(lap)
+        self.omega_inv_diag = omega / self.lap.diagonal()
+        self.prolongation = None
+        self.restriction = None
+        self._lu = None
+
+    def smooth(self, phi, rhs, n_iter):
+        # Damped Jacobi
+        for _ in range(n_iter):
+            phi += self.omega_inv_diag * (rhs - self.lap @ phi)
+
+    def residual(self, phi, rhs):
+        return rhs - self.lap @ phi
+
+    def factorize(self):
+        self._lu = scipy.sparse.linalg.splu(scipy.sparse.csc_matrix(self.lap))
+
+    def solve_direct(self, phi, rhs):
+        phi[:] = self._lu.solve(rhs)
+
+
+def _laplacian_1d(n, h):
+    return scipy.sparse.diags([-np.ones(n-1), 2*np.ones(n), -np.ones(n-1)],
+                              [-1, 0, 1]) / h**2
+
+
+def _prolongation_1d(n_fine):
+    # Linear interpolation, coarse point j is on fine point 2j+1 and the
+    # potential is zero one cell outside the grid
+    n_coarse = n_fine // 2
+    rows, cols, vals = [], [], []
+    for ii in range(n_fine):
+        if ii % 2 == 1:
+            rows.append(ii); cols.append((ii - 1)//2); vals.append(1.)
+        else:
+            for jj in (ii//2 - 1, ii//2):
+                if 0 <= jj < n_coarse:
+                    rows.append(ii); cols.append(jj); vals.append(0.5)
+    return scipy.sparse.csr_matrix((vals, (rows, cols)),
+                                   shape=(n_fine, n_coarse))
+
+
+def _kron3(ops):
+    # Fortran order: the first index is the fastest
+    return scipy.sparse.kron(ops[2], scipy.sparse.kron(ops[1], ops[0]))
+
+
+def _build_levels(shape, h, mask, axes, max_coarse_points=4096):
+
+    omega = 2*len(axes) / (2*len(axes) + 1)
+
+    # Operator of the finest grid, restricted to the points inside the mask
+    lap = 0
+    for aa in axes:
+        lap = lap + _kron3([_laplacian_1d(shape[ii], h[ii]) if ii == aa
+                            else scipy.sparse.identity(shape[ii])
+                            for ii in range(3)])
+    active = np.where(mask.ravel(order='F'))[0]
+    lap = scipy.sparse.csr_matrix(lap)[active][:, active]
+
+    levels = [_Level(lap, omega)]
+    level_shape = list(shape)
+    level_h = list(h)
+    while lap.shape[0] > max_coarse_points:
+
+        # Coarsen the axes having enough points and a strong coupling (semi-
+        # coarsening is needed for anisotropic cells)
+        h_min = min(level_h[aa] for aa in axes)
+        coarsened = [aa in axes and level_shape[aa] >= 4
+                     and level_h[aa]**2 <= 2 * h_min**2 for aa in range(3)]
+        if not any(coarsened):
+            break
+
+        prolongation = _kron3([_prolongation_1d(level_shape[aa])
+                               if coarsened[aa]
+                               else scipy.sparse.identity(level_shape[aa])
+                               for aa in range(3)])
+        level_shape = [nn//2 if cc else nn
+                       for nn, cc in zip(level_shape, coarsened)]
+        level_h = [2*hh if cc else hh for hh, cc in zip(level_h, coarsened)]
+
+        # Only the coarse points connected to the fine unknowns are kept
+        prolongation = scipy.sparse.csr_matrix(prolongation)[active]
+        active_coarse = np.where(
+                np.asarray(abs(prolongation).sum(axis=0)).ravel() > 0)[0]
+        prolongation = scipy.sparse.csr_matrix(
+                        prolongation[:, active_coarse])
+
+        fine = levels[-1]
+        fine.prolongation = prolongation
+        fine.restriction = scipy.sparse.csr_matrix(prolongation.T)
+        lap = fine.restriction @ fine.lap @ prolongation
+        levels.append(_Level(lap, omega))
+
+        # Indices of the coarse unknowns with respect to the full coarse grid
+        active = active_coarse
+
+    levels[-1].factorize()
+
+    return levels
+
+
+def _v_cycle(levels, i_level, phi, rhs, n_smooth):
+
+    level = levels[i_level]
+
+    if i_level == len(levels) - 1:
+        level.solve_direct(phi, rhs)
+        return
+
+    level.smooth(phi, rhs, n_iter=n_smooth)
+
+    rhs_coarse = level.restriction @ level.residual(phi, rhs)
+    err_coarse = np.zeros_like(rhs_coarse)
+    _v_cycle(levels, i_level + 1, err_coarse, rhs_coarse, n_smooth)
+    phi += level.prolongation @ err_coarse
+
+    level.smooth(phi, rhs, n_iter=n_smooth)